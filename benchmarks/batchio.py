@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+
+'''Micro-benchmark for gcoaptest.batchio on loopback. Measures packets/second
+to send a burst of small datagrams, and to drain the same burst from a socket,
+with a call per datagram and with BatchSocketIO, both with recvmmsg/sendmmsg
+and with its per-datagram fallback.
+
+Options:
+
+-b <size>  -- Batch size; defaults to 32
+-n <count> -- Datagrams per burst; defaults to 2000
+-r <count> -- Bursts per measurement; defaults to 20
+
+Example:
+
+$ PYTHONPATH=.. ./batchio.py -b 64
+'''
+from __future__ import print_function
+import socket
+import time
+from   gcoaptest.batchio import BatchSocketIO
+
+PAYLOAD = b'\x50\x01\x12\x34\xb3ver'
+
+def makeSockets():
+    recvSock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    recvSock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    recvSock.bind(('::1', 0))
+    recvSock.setblocking(False)
+    sendSock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    sendSock.setblocking(False)
+    return recvSock, sendSock
+
+def sendPlain(sock, addr, count):
+    for i in range(count):
+        sock.sendto(PAYLOAD, addr)
+
+def sendBatch(batchIO, addr, count):
+    for i in range(count):
+        batchIO.queue(PAYLOAD, addr)
+    batchIO.flush()
+
+def drainPlain(sock, count):
+    received = 0
+    while received < count:
+        try:
+            sock.recvfrom(1152)
+            received += 1
+        except (BlockingIOError, InterruptedError):
+            break
+    return received
+
+def drainBatch(batchIO, count):
+    received = 0
+    while received < count:
+        batch = batchIO.receive()
+        if not batch:
+            break
+        received += len(batch)
+    return received
+
+def measure(name, batchSize, count, rounds, useBatch, useMmsg):
+    recvSock, sendSock = makeSockets()
+    addr    = recvSock.getsockname()
+    sendIO  = BatchSocketIO(sendSock, batchSize, useMmsg=useMmsg)
+    recvIO  = BatchSocketIO(recvSock, batchSize, useMmsg=useMmsg)
+    sendSecs = recvSecs = 0.0
+    received = 0
+    for r in range(rounds):
+        start = time.time()
+        if useBatch:
+            sendBatch(sendIO, addr, count)
+        else:
+            sendPlain(sendSock, addr, count)
+        sendSecs += time.time() - start
+
+        start = time.time()
+        if useBatch:
+            received += drainBatch(recvIO, count)
+        else:
+            received += drainPlain(recvSock, count)
+        recvSecs += time.time() - start
+    recvSock.close()
+    sendSock.close()
+
+    total = count * rounds
+    print('{0:<16} send {1:>9.0f} pps   receive {2:>9.0f} pps   ({3} of {4} received)'.format(
+          name, total / sendSecs, received / recvSecs, received, total))
+
+def main(batchSize, count, rounds):
+    measure('per-packet', batchSize, count, rounds, False, False)
+    measure('batch fallback', batchSize, count, rounds, True, False)
+    probe = BatchSocketIO(socket.socket(socket.AF_INET6, socket.SOCK_DGRAM), 1)
+    if probe.mmsg:
+        measure('batch mmsg', batchSize, count, rounds, True, True)
+    else:
+        print('recvmmsg/sendmmsg not available')
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    # read command line
+    parser = OptionParser()
+    parser.add_option('-b', type='int', dest='batchSize', default=32)
+    parser.add_option('-n', type='int', dest='count', default=2000)
+    parser.add_option('-r', type='int', dest='rounds', default=20)
+
+    (options, args) = parser.parse_args()
+
+    main(options.batchSize, options.count, options.rounds)
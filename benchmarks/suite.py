@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+
+'''Benchmark suite for the tester and observer hot paths, on loopback. Writes
+results as JSON, and compares them with a baseline from an earlier run.
+
+Benchmarks:
+
+* tester.ver, tester.toobig -- GET throughput and latency from a tester
+  process, with a closed loop of NON requests from gcoaptest.loadgen
+* observer.non, observer.con -- Rate at which GcoapObserver._responseClient
+  handles load mode notifications, called directly; a CON notification also
+  sends an ACK
+* coap.encode -- Cost to encode a GET request header and Uri-Path
+* coap.decode, coap.view -- Cost to read a notification with coap.decode(),
+  and with coap.HeaderView plus the Observe option lookup
+
+Each result is a metric with a value and unit, and whether higher or lower is
+better. A metric regresses if it is worse than the baseline by more than the
+tolerance.
+
+Options:
+
+-b <backend> -- Transport engine for the tester benchmarks; defaults to
+                asyncore where available
+-d <secs>    -- Duration of each tester run; defaults to 5
+-n <count>   -- Requests outstanding in a tester run; defaults to 32
+-i <count>   -- Iterations for the in-process benchmarks; defaults to 100000
+-p <port>    -- Tester port; the observer uses the next two ports. Defaults
+                to 5783.
+-k <list>    -- Comma separated prefixes of benchmarks to run, like
+                'tester,coap'; defaults to all
+-o <file>    -- Writes results as JSON
+-c <file>    -- Compares results with a baseline JSON file from -o; exits
+                with status 1 on a regression
+-T <percent> -- Tolerance for the comparison; defaults to 10
+
+Example:
+
+$ PYTHONPATH="../../soscoap/repo:.." ./suite.py -o baseline.json
+# after a change
+$ PYTHONPATH="../../soscoap/repo:.." ./suite.py -c baseline.json
+'''
+from __future__ import print_function
+import json
+import os
+import platform
+import socket
+import struct
+import subprocess
+import sys
+import time
+from   soscoap  import CodeClass
+from   soscoap  import MessageType
+from   soscoap  import OptionType
+from   soscoap  import RequestCode
+from   gcoaptest import coap
+from   gcoaptest import engine
+from   gcoaptest.loadgen  import LoadGenerator
+from   gcoaptest.observer import GcoapObserver
+
+def metric(value, unit, better='higher'):
+    return {'value': value, 'unit': unit, 'better': better}
+
+def startTester(port, backend):
+    '''Starts a tester process, and waits until it answers a CoAP ping.'''
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen([sys.executable, '-m', 'gcoaptest.tester',
+                                   '-p', str(port), '-b', backend,
+                                   '--log-level', 'warning'],
+                                  stdout=devnull, env=os.environ)
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    sock.settimeout(0.2)
+    ping = coap.encodeHeader(MessageType.CON, CodeClass.Empty, 0, 1, b'')
+    try:
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            sock.sendto(ping, ('::1', port))
+            try:
+                sock.recv(64)
+                return server
+            except socket.timeout:
+                pass
+    finally:
+        sock.close()
+    server.terminate()
+    server.wait()
+    raise RuntimeError('tester did not start on port {0}'.format(port))
+
+def benchTester(port, backend, duration, concurrency):
+    '''Returns metrics for GET /ver and /toobig from a tester process.'''
+    results = {}
+    server  = startTester(port, backend)
+    try:
+        for path in ('ver', 'toobig'):
+            generator = LoadGenerator('::1', port, backend, path='/' + path)
+            generator.run(duration, concurrency=concurrency)
+            summary = generator.summary()
+            prefix  = 'tester.{0}.'.format(path)
+            results[prefix + 'rate'] = metric(round(summary['rate']), 'resp/s')
+            results[prefix + 'loss'] = metric(summary['loss'], 'ratio', 'lower')
+            for key in ('p50', 'p99'):
+                results[prefix + key] = metric(summary[key], 'ms', 'lower')
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+def _notification(messageType, messageId, token, observe):
+    '''Returns an encoded 2.05 notification with an Observe option.'''
+    return (coap.encodeHeader(messageType, CodeClass.Success, 5, messageId, token)
+            + coap.encodeOptions([coap.Option(OptionType.Observe, observe),
+                                  coap.Option(coap.OPTION_CONTENT_FORMAT,
+                                              coap.MEDIA_TEXT_PLAIN)])
+            + b'\xFFcount: 1234')
+
+def benchObserver(port, iterations):
+    '''Returns the rate at which the observer handles notifications. Builds
+    the datagrams ahead, so the measurement includes the HeaderView, as the
+    engine creates for each datagram, and the handler.
+    '''
+    results  = {}
+    observer = GcoapObserver('::1', port, port + 1)
+    try:
+        tokens = [struct.pack('!I', i) for i in range(1, 101)]
+        for token in tokens:
+            observer._addRegistration('stats', token, observer._client, load=True)
+        # ACKs go to a closed port on loopback
+        address = ('::1', port, 0, 0)
+
+        for name, messageType in (('non', MessageType.NON), ('con', MessageType.CON)):
+            datagrams = [_notification(messageType, i & 0xFFFF, tokens[i % len(tokens)],
+                                       i + 1)
+                         for i in range(iterations)]
+            start = time.time()
+            for data in datagrams:
+                observer._responseClient(coap.HeaderView(data, address))
+            elapsed = time.time() - start
+            results['observer.{0}.rate'.format(name)] = metric(
+                    round(iterations / elapsed), 'notif/s')
+    finally:
+        observer.close()
+    return results
+
+def _timePerCall(func, iterations):
+    '''Returns nanoseconds per call of func.'''
+    start = time.time()
+    for i in range(iterations):
+        func()
+    return round((time.time() - start) * 1e9 / iterations, 1)
+
+def benchCoap(iterations):
+    '''Returns the cost to encode and decode messages.'''
+    path  = [coap.Option(OptionType.UriPath, 'ver')]
+    token = b'\x01\x02\x03\x04'
+    notif = _notification(MessageType.NON, 1, token, 1234)
+
+    def encode():
+        return (coap.encodeHeader(MessageType.NON, CodeClass.Request, RequestCode.GET,
+                                  1, token) + coap.encodeOptions(path))
+    def decode():
+        return coap.decode(notif).findOption(OptionType.Observe)
+    def view():
+        return coap.HeaderView(notif).findOption(OptionType.Observe)
+
+    return {'coap.encode': metric(_timePerCall(encode, iterations), 'ns', 'lower'),
+            'coap.decode': metric(_timePerCall(decode, iterations), 'ns', 'lower'),
+            'coap.view':   metric(_timePerCall(view, iterations), 'ns', 'lower')}
+
+def compare(results, baseline, tolerance):
+    '''Prints each metric against the baseline.
+
+    :param tolerance: float Percent a metric may be worse than the baseline
+    :return: list:string Names of regressed metrics
+    '''
+    regressed = []
+    for name in sorted(results):
+        current = results[name]
+        base    = baseline.get(name)
+        if not base or not base['value'] or current['value'] is None:
+            print('{0:<24} {1:>12}'.format(name, current['value']))
+            continue
+        change = (current['value'] - base['value']) * 100.0 / base['value']
+        worse  = change if current['better'] == 'lower' else -change
+        status = ''
+        if worse > tolerance:
+            status = 'REGRESSED'
+            regressed.append(name)
+        print('{0:<24} {1:>12} {2:>12} {3:>+8.1f}% {4}'.format(name, current['value'],
+                                                               base['value'], change,
+                                                               status))
+    return regressed
+
+def main(options):
+    kinds   = options.kinds.split(',') if options.kinds else None
+    def selected(name):
+        return not kinds or any(name.startswith(kind) for kind in kinds)
+
+    results = {}
+    if selected('tester'):
+        results.update(benchTester(options.port, options.backend, options.duration,
+                                   options.concurrency))
+    if selected('observer'):
+        results.update(benchObserver(options.port + 1, options.iterations))
+    if selected('coap'):
+        results.update(benchCoap(options.iterations))
+
+    report = {'python':  platform.python_version(),
+              'backend': options.backend,
+              'time':    time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+    if options.outFile:
+        with open(options.outFile, 'w') as outFile:
+            json.dump(report, outFile, indent=2, sort_keys=True)
+
+    baseline = {}
+    if options.baseFile:
+        with open(options.baseFile) as baseFile:
+            baseline = json.load(baseFile)['results']
+        print('{0:<24} {1:>12} {2:>12} {3:>9}'.format('Metric', 'Current', 'Baseline',
+                                                      'Change'))
+    regressed = compare(results, baseline, options.tolerance)
+    if regressed:
+        print('\n{0} regression(s) beyond {1}%'.format(len(regressed), options.tolerance))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    # read command line
+    parser = OptionParser()
+    parser.add_option('-b', type='choice', dest='backend', choices=engine.BACKENDS,
+                      default=engine.DEFAULT_BACKEND)
+    parser.add_option('-d', type='float', dest='duration', default=5)
+    parser.add_option('-n', type='int', dest='concurrency', default=32)
+    parser.add_option('-i', type='int', dest='iterations', default=100000)
+    parser.add_option('-p', type='int', dest='port', default=5783)
+    parser.add_option('-k', type='string', dest='kinds', default=None)
+    parser.add_option('-o', type='string', dest='outFile', default=None)
+    parser.add_option('-c', type='string', dest='baseFile', default=None)
+    parser.add_option('-T', type='float', dest='tolerance', default=10.0)
+
+    (options, args) = parser.parse_args()
+    sys.exit(main(options))
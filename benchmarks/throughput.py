@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+
+'''Compares GET /ver throughput of the gcoaptest server across transport engine
+backends on loopback. For each backend, starts a tester process, and keeps a
+window of NON requests outstanding for a fixed period.
+
+Options:
+
+-b <list>  -- Comma separated backends to compare; defaults to all available
+-d <secs>  -- Duration of each run; defaults to 5
+-p <port>  -- Server port; defaults to 5783
+-w <count> -- Requests outstanding at once; defaults to 32
+
+Example:
+
+$ PYTHONPATH="../../soscoap/repo:.." ./throughput.py -b asyncore,asyncio
+'''
+from __future__ import print_function
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import time
+from   soscoap  import CodeClass
+from   soscoap  import MessageType
+from   soscoap  import OptionType
+from   soscoap  import RequestCode
+from   gcoaptest import coap
+from   gcoaptest import engine
+
+def waitForServer(sock, addr, timeout=5):
+    '''Pings the server until it responds.'''
+    deadline = time.time() + timeout
+    sock.settimeout(0.2)
+    while time.time() < deadline:
+        sock.sendto(coap.encodeHeader(MessageType.CON, CodeClass.Empty, 0,
+                                      random.randint(0, 65535), b''), addr)
+        try:
+            sock.recv(1152)
+            return True
+        except socket.timeout:
+            pass
+    return False
+
+def runLoad(addr, duration, window):
+    '''Sends GET /ver requests for duration seconds, keeping window requests
+    outstanding.
+
+    :return: int Count of responses received
+    '''
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    if not waitForServer(sock, addr):
+        sock.close()
+        return None
+
+    path = coap.encodeOptions([coap.Option(OptionType.UriPath, 'ver')])
+    def request(seq):
+        return coap.encodeHeader(MessageType.NON, CodeClass.Request, RequestCode.GET,
+                                 seq & 0xFFFF, struct.pack('!I', seq)) + path
+
+    seq = 0
+    for i in range(window):
+        sock.sendto(request(seq), addr)
+        seq += 1
+
+    received = 0
+    sock.settimeout(0.5)
+    end = time.time() + duration
+    while time.time() < end:
+        try:
+            sock.recv(1152)
+            received += 1
+        except socket.timeout:
+            # replace lost requests
+            for i in range(window):
+                sock.sendto(request(seq), addr)
+                seq += 1
+            continue
+        sock.sendto(request(seq), addr)
+        seq += 1
+    sock.close()
+    return received
+
+def main(backends, duration, port, window):
+    addr    = ('::1', port)
+    results = []
+    for backend in backends:
+        server = subprocess.Popen([sys.executable, '-m', 'gcoaptest.tester',
+                                   '-p', str(port), '-b', backend],
+                                  stdout=subprocess.DEVNULL, env=os.environ)
+        try:
+            received = runLoad(addr, duration, window)
+        finally:
+            server.terminate()
+            server.wait()
+
+        if received is None:
+            print('{0}: server did not start'.format(backend))
+        else:
+            results.append((backend, received / float(duration)))
+            print('{0}: {1:.0f} responses/sec'.format(backend, results[-1][1]))
+
+    if len(results) > 1:
+        base = results[0][1]
+        for backend, rate in results[1:]:
+            print('{0} vs {1}: {2:.2f}x'.format(backend, results[0][0], rate / base))
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    # read command line
+    parser = OptionParser()
+    parser.add_option('-b', type='string', dest='backends', default=None)
+    parser.add_option('-d', type='int', dest='duration', default=5)
+    parser.add_option('-p', type='int', dest='port', default=5783)
+    parser.add_option('-w', type='int', dest='window', default=32)
+
+    (options, args) = parser.parse_args()
+
+    if options.backends:
+        backends = options.backends.split(',')
+    else:
+        backends = [engine.DEFAULT_BACKEND] if engine.DEFAULT_BACKEND != 'asyncio' else []
+        backends.append('asyncio')
+        try:
+            import uvloop
+            backends.append('uvloop')
+        except ImportError:
+            pass
+
+    main(backends, options.duration, options.port, options.window)
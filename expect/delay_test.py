@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+
+'''Tests that the gcoaptest server delays responses independently for parallel
+requests. Configures the server delay, then sends a burst of GET /ver requests
+from separate client sockets. Passes if all responses arrive in about one delay
+period rather than one period per request.
+
+Options:
+
+-a <addr>  -- Address of gcoaptest server; defaults to ::1
+-p <port>  -- Port of gcoaptest server; defaults to 5683
+-d <secs>  -- Server built-in response delay, in seconds; defaults to 2
+-n <count> -- Number of parallel requests; defaults to 20
+
+Example:
+
+# Start gcoaptest server. See gcoaptest/runtester script.
+
+# Run test
+$ PYTHONPATH="../../soscoap/repo:.." ./delay_test.py -d 2 -n 50
+'''
+from __future__ import print_function
+import random
+import select
+import socket
+import time
+from   soscoap  import CodeClass
+from   soscoap  import MessageType
+from   soscoap  import OptionType
+from   soscoap  import RequestCode
+from   gcoaptest import coap
+
+def buildRequest(addr, port, code, path, payload=None):
+    msg             = coap.Message((addr, port))
+    msg.messageType = MessageType.CON
+    msg.codeClass   = CodeClass.Request
+    msg.codeDetail  = code
+    msg.messageId   = random.randint(0, 65535)
+    msg.token       = bytes(bytearray([random.randint(0, 255), random.randint(0, 255)]))
+    for segment in path.strip('/').split('/'):
+        msg.addOption(coap.Option(OptionType.UriPath, segment))
+    if payload:
+        msg.payload = payload.encode('utf-8')
+    return msg
+
+def exchange(sock, msg, timeout):
+    sock.sendto(msg.encode(), msg.address)
+    sock.settimeout(timeout)
+    return coap.decode(sock.recv(1152))
+
+def main(addr, port, delay, count):
+    print('Test: {0} parallel GET /ver with {1} second server delay'.format(count, delay))
+
+    confSock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    resp = exchange(confSock, buildRequest(addr, port, RequestCode.POST, '/cf/delay',
+                                           str(delay)), delay + 5)
+    print('Server delay set to {0}; code {1}.{2:02d}'.format(delay, resp.codeClass,
+                                                             resp.codeDetail))
+
+    socks = [socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) for i in range(count)]
+    start = time.time()
+    for sock in socks:
+        sock.sendto(buildRequest(addr, port, RequestCode.GET, '/ver').encode(), (addr, port))
+
+    pending  = set(socks)
+    deadline = start + delay * 2 + 5
+    while pending and time.time() < deadline:
+        readable, _, _ = select.select(list(pending), [], [], deadline - time.time())
+        for sock in readable:
+            sock.recv(1152)
+            pending.discard(sock)
+    elapsed = time.time() - start
+
+    exchange(confSock, buildRequest(addr, port, RequestCode.POST, '/cf/delay', '0'), 5)
+    for sock in socks + [confSock]:
+        sock.close()
+
+    if pending:
+        print('*** FAIL ***\n{0} of {1} responses missing'.format(len(pending), count))
+    elif elapsed < delay * 2:
+        print('Success: {0} responses in {1:.2f} seconds'.format(count, elapsed))
+    else:
+        print('*** FAIL ***\n{0} responses took {1:.2f} seconds'.format(count, elapsed))
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    # read command line
+    parser = OptionParser()
+    parser.add_option('-a', type='string', dest='addr', default='::1')
+    parser.add_option('-p', type='int', dest='port', default=5683)
+    parser.add_option('-d', type='int', dest='delay', default=2)
+    parser.add_option('-n', type='int', dest='count', default=20)
+
+    (options, args) = parser.parse_args()
+
+    main(options.addr, options.port, options.delay, options.count)
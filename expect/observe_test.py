@@ -9,13 +9,11 @@
 
 * Observe server -- RIOT gcoap example
 * Observe client -- gcoap-test Observer sends requests to server.
-* Support client/server -- CoAP client and server used to support the Observe
-                           client and server. The support server is used as the
-                           target for CoAP messages sent by the RIOT gcoap
-                           example to trigger its Observe notifications. The
-                           support client is used to send commands to the
-                           gcoap-test Observer client. The support client and
-                           server are provided by libcoap's example apps.
+* Support server -- CoAP server used as the target for CoAP messages sent by
+                    the RIOT gcoap example to trigger its Observe notifications.
+                    Provided by libcoap's example apps.
+* Command client -- In-process CoAP client that sends commands to the
+                    gcoap-test Observer client, and waits for its response.
 
 Options:
 
@@ -53,8 +51,19 @@ Options:
               location of the RIOT gcoap CLI test app (riot-gcoap-test).
 -y <dir>   -- Directory in which to execute the client script; must be the
               location of the gcoap observer Python app.
--z <dir>   -- Directory in which to execute the support client and server
-              scripts; must be the location of the libcoap example apps.
+-z <dir>   -- Directory in which to execute the support server script; must be
+              the location of the libcoap example apps.
+-s <secs>  -- Pause before the test to seed the server's Observe value;
+              defaults to 20.
+-n <iface> -- tap interface for a native RIOT server; defaults to tap0
+-P <port>  -- First of the local ports for the test; defaults to 5683. The
+              support server uses this port, and observer client n uses the
+              next two ports after client n-1, for its source port and command
+              port. So by default, client 1 uses 5684 and 5685.
+
+Steps wait for the state they depend on, like the server reporting no open
+requests, rather than for a fixed time; see waits.py. Prints the time for the
+test when done.
 
 Example:
 
@@ -65,7 +74,7 @@ $ sudo ip link set tap0 up
 $ sudo ip address add fe80::bbbb:1/64 dev tap0
 
 # Run test; uses special riot-gcoap-test app
-$ ./observe_test.py -a fe80::bbbb:2 -t observe -x /home/kbee/dev/riot-gcoap-test/repo -y /home/kbee/dev/gcoap-test/repo -z /home/kbee/dev/libcoap/repo/examples
+$ PYTHONPATH=../../soscoap/repo:.. ./observe_test.py -a fe80::bbbb:2 -t observe -x /home/kbee/dev/riot-gcoap-test/repo -y /home/kbee/dev/gcoap-test/repo -z /home/kbee/dev/libcoap/repo/examples
 
 # tun example
 # Reset samr21 board, *then* set up networking.
@@ -76,15 +85,69 @@ $ sudo ./tunslip6 -s ttyUSB0 -t tun0 bbbb::1/64
 $ sudo ip -6 route add aaaa::/64 dev tun0
 
 # Run test
-$ ./observe_test.py -a bbbb::2 -t observe -x /home/kbee/dev/riot-gcoap-test/repo -y /home/kbee/dev/gcoap-test/repo -z /home/kbee/dev/libcoap/repo/examples
+$ PYTHONPATH=../../soscoap/repo:.. ./observe_test.py -a bbbb::2 -t observe -x /home/kbee/dev/riot-gcoap-test/repo -y /home/kbee/dev/gcoap-test/repo -z /home/kbee/dev/libcoap/repo/examples
 
 '''
 from __future__ import print_function
 import time
 import os
+import random
+import select
 import signal
+import socket
 import pexpect
 import re
+from   soscoap  import CodeClass
+from   soscoap  import MessageType
+from   soscoap  import OptionType
+from   soscoap  import RequestCode
+from   gcoaptest import coap
+from   waits    import waitForShell, pollOutput, waitForIdle, waitForCoap, TestTimer
+
+class CommandClient(object):
+    '''Sends commands to gcoap-test Observer clients from this process, in place
+    of a libcoap coap-client process per command. Sends a non-confirmable POST
+    with token 5a, like 'coap-client -N -m post -T 5a', and waits for the
+    response, so the command has been handled on return.
+
+    Attributes:
+        :_sock: socket Used for all commands
+    '''
+    def __init__(self):
+        self._sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+
+    def post(self, port, path, query=None, timeout=2):
+        '''Posts a command to a client listening on localhost.
+
+        :param port: int Port on which client listens for commands
+        :param path: string Command path, like '/reg/stats'
+        :param query: string Uri-Query value, or None
+        :return: coap.Message Response, or None if timed out
+        '''
+        msg             = coap.Message(('::1', port))
+        msg.messageType = MessageType.NON
+        msg.codeClass   = CodeClass.Request
+        msg.codeDetail  = RequestCode.POST
+        msg.messageId   = random.randint(0, 65535)
+        msg.token       = b'\x5a'
+        for segment in path.strip('/').split('/'):
+            msg.addOption(coap.Option(OptionType.UriPath, segment))
+        if query:
+            msg.addOption(coap.Option(coap.OPTION_URI_QUERY, query))
+        self._sock.sendto(msg.encode(), msg.address)
+
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([self._sock], [], [], remaining)[0]:
+                print('No response from client for {0} command'.format(path))
+                return None
+            response = coap.decode(self._sock.recv(1152))
+            if response.messageId == msg.messageId or response.token == msg.token:
+                return response
+
+    def close(self):
+        self._sock.close()
 
 class ObserveTester(object):
     '''
@@ -94,12 +157,13 @@ class ObserveTester(object):
         :_server: Observe server provided by RIOT gcoap example
         :_client: Observe client provided by gcoap-test observer
         :_supportServer: Provided by libcoap example server
+        :_commandClient: CommandClient for commands to observer clients
         :_serverQualifiedAddr: IP address for server, including any suffixed
                                interface identifier, like '%tap0'
         :_supportServerAddr: IP address for support server
+        :_basePort: int First local port; see _clientPort()
         :_clientDir: Directory in which to run client, or None if pwd
-        :_supportDir: Directory in which to run support client/server, or None
-                      if pwd
+        :_supportDir: Directory in which to run support server, or None if pwd
         :_notifResponse: If not None, observe notifications are sent confirmably.
                       'ack' -- send an ACK response to the notification
                       'ignore' -- ignore the notifications
@@ -112,24 +176,30 @@ class ObserveTester(object):
         3. close() instance; best in a finally block around the first two steps
     '''
 
-    def __init__(self, addr, serverDir, clientDir, supportDir, notifResponse):
+    def __init__(self, addr, serverDir, clientDir, supportDir, notifResponse,
+                 iface='tap0', basePort=5683):
         '''Common setup for running a test
 
         :param addr: string Server address
+        :param iface: string tap interface for a native server
+        :param basePort: int Port for the support server, and first of the
+                             local ports for the test
         :param serverDir: string Directory in which to run server, or None if pwd
         :param clientDir: string Directory in which to run client, or None if pwd
-        :param supportDir: string Directory in which to run support client/server,
-                                 or None if pwd
+        :param supportDir: string Directory in which to run support server, or
+                                 None if pwd
         :param conAction: string Direct server to send notifications confirmably
                                  and either ACK, RST, or ignore the notifications
         '''
         self._clientDir  = clientDir
         self._supportDir = supportDir
         self._notifResponse  = notifResponse
+        self._commandClient  = CommandClient()
+        self._basePort       = basePort
         
         xfaceType = 'tap' if addr[:4] == 'fe80' else 'tun'
         if xfaceType == 'tap':
-            self._serverQualifiedAddr = '{0}%tap0'.format(addr)
+            self._serverQualifiedAddr = '{0}%{1}'.format(addr, iface)
             self._supportServerAddr   = 'fe80::bbbb:1'
         else:
             self._serverQualifiedAddr = addr
@@ -138,12 +208,12 @@ class ObserveTester(object):
 
         # set up server
         if xfaceType == 'tap':
-            self._server = pexpect.spawn('make term', cwd=serverDir)
+            self._server = pexpect.spawn('make term PORT={0}'.format(iface), cwd=serverDir)
             self._server.expect('gcoap CLI test app')
         else:
             self._server = pexpect.spawn('make term BOARD="samr21-xpro"', cwd=serverDir)
             self._server.expect('Welcome to pyterm!')
-        time.sleep(1)
+        waitForShell(self._server)
 
         # configure network interfaces; must use unqualified server address
         if xfaceType == 'tap':
@@ -153,28 +223,43 @@ class ObserveTester(object):
             self._server.sendline('ifconfig 8 add unicast {0}/64'.format(addr))
             self._server.expect('success:')
             self._server.sendline('nib neigh add 8 {0}'.format(self._supportServerAddr))
-            time.sleep(1)
-            self._server.sendline('nib neigh')
-            self._server.expect(self._supportServerAddr)
-        time.sleep(2)
+            pollOutput(self._server, 'nib neigh', self._supportServerAddr, timeout=5)
+        # server answers once its address is usable
+        waitForCoap(self._serverQualifiedAddr, 5683, path='/.well-known/core')
         print('gcoap Server setup OK')
 
         # set up client
         self._clientCmd = 'python -m gcoaptest.observer -s {0} -a {1}'
 
-        self._client = pexpect.spawn(self._clientCmd.format(5684, self._serverQualifiedAddr),
-                               cwd=self._clientDir,
-                               env={'PYTHONPATH': '../../soscoap/repo'})
-        self._client.expect('Starting gcoap observer')
-        time.sleep(1)
+        self._client = self._startClient(self._clientPort(1))
         print('Client setup OK')
 
         # set up support server
-        self._supportServer = pexpect.spawn(self._supportDir + '/coap-server')
-        # No output when start support server
-        self._supportServer.expect(pexpect.TIMEOUT, timeout=2)
+        self._supportServer = pexpect.spawn('{0}/coap-server -p {1}'.format(
+                                            self._supportDir, self._basePort))
+        # No output when start support server; wait until it answers a ping
+        waitForCoap('::1', self._basePort)
         print('Support server setup OK')
 
+    def _clientPort(self, clientNum):
+        '''Returns the source port for an observer client, numbered from 1.
+        The client's command port is the next port.
+        '''
+        return self._basePort + 2*clientNum - 1
+
+    def _startClient(self, sourcePort):
+        '''Starts a gcoap-test observer client, and waits until its command
+        server, at sourcePort + 1, answers.
+
+        :return: spawn Pexpect process for the client
+        '''
+        client = pexpect.spawn(self._clientCmd.format(sourcePort, self._serverQualifiedAddr),
+                               cwd=self._clientDir,
+                               env={'PYTHONPATH': '../../soscoap/repo'})
+        client.expect('Starting gcoap observer')
+        waitForCoap('::1', sourcePort + 1)
+        return client
+
     def runTest(self, testName):
         '''Runs a test
 
@@ -190,21 +275,18 @@ class ObserveTester(object):
             self._triggerNotification(self._server, self._client, 'stats')
             if self._notifResponse == 'ack' or self._notifResponse == None:
                 # normal success cases for confirm, non-confirm
-                time.sleep(4)
+                waitForIdle(self._server)
                 self._triggerNotification(self._server, self._client, 'stats')
                 self._deregisterObserve(self._client, 'stats')
-                time.sleep(4)
+                waitForIdle(self._server)
                 self._verifyNoNotification(self._server, self._client, 'stats')
             else:
                 if self._notifResponse == 'ignore':
                     delay = 95
-                    print('Pause {0} seconds for all retries to timeout'.format(delay))
-                elif self._notifResponse == 'reset' or self._notifResponse == 'reset_non':
-                    delay = 4
+                    print('Wait up to {0} seconds for all retries to timeout'.format(delay))
                 else:
-                    # will error because delay undefined
-                    pass
-                time.sleep(delay)
+                    delay = 10
+                waitForIdle(self._server, timeout=delay)
                 self._verifyNoNotification(self._server, self._client, 'stats')
 
         elif testName == 'toomanymemos':
@@ -214,17 +296,14 @@ class ObserveTester(object):
         elif testName == 'toomany4resource':
             self._registerObserve(self._client, 'stats')
 
+            client2 = None
             try:
-                client2 = pexpect.spawn(self._clientCmd.format(5686,
-                                        self._serverQualifiedAddr),
-                                        cwd=self._clientDir,
-                                        env={'PYTHONPATH': '../../soscoap/repo'})
-                client2.expect('Starting gcoap observer')
-                time.sleep(1)
+                client2 = self._startClient(self._clientPort(2))
                 print('Client 2 setup OK')
 
-                self._registerObserve(client2, 'stats', commandPort=5687,
-                                                  expectsRejection=True)
+                self._registerObserve(client2, 'stats',
+                                      commandPort=self._clientPort(2) + 1,
+                                      expectsRejection=True)
             finally:
                 if client2:
                     client2.close()
@@ -232,23 +311,23 @@ class ObserveTester(object):
         elif testName == 'rereg-same-token':
             self._registerObserve(self._client, 'stats', token='6b7c')
             self._registerObserve(self._client, 'stats', token='6b7c')
-            time.sleep(4)
+            waitForIdle(self._server)
             self._triggerNotification(self._server, self._client, 'stats')
 
         elif testName == 'rereg-new-token':
             self._registerObserve(self._client, 'stats')
             self._registerObserve(self._client, 'stats')
-            time.sleep(4)
+            waitForIdle(self._server)
             self._triggerNotification(self._server, self._client, 'stats')
 
         elif testName == 'rereg-new-resource':
             self._registerObserve(self._client, 'stats', token='6b7c')
             self._registerObserve(self._client, 'core', token='6b7c')
-            time.sleep(4)
+            waitForIdle(self._server)
             self._verifyNoNotification(self._server, self._client, 'stats')
-            time.sleep(4)
+            waitForIdle(self._server)
             self._registerObserve(self._client, 'stats', token='6b7c')
-            time.sleep(4)
+            waitForIdle(self._server)
             self._triggerNotification(self._server, self._client, 'stats')
 
         elif testName == 'rereg-reject-dup-token':
@@ -256,24 +335,21 @@ class ObserveTester(object):
             self._registerObserve(self._client, 'core', token='6b7c')
             self._registerObserve(self._client, 'stats', token='6b7c',
                                   expectsRejection=True)
-            time.sleep(4)
+            waitForIdle(self._server)
             # original registration should still work
             self._triggerNotification(self._server, self._client, 'stats')
 
         elif testName == 'two-observers':
             self._registerObserve(self._client, 'stats')
 
+            client2 = None
             try:
-                client2 = pexpect.spawn(self._clientCmd.format(5686,
-                                        self._serverQualifiedAddr),
-                                        cwd=self._clientDir,
-                                        env={'PYTHONPATH': '../../soscoap/repo'})
-                client2.expect('Starting gcoap observer')
-                time.sleep(1)
+                client2 = self._startClient(self._clientPort(2))
                 print('Client 2 setup OK')
 
-                self._registerObserve(client2, 'core', commandPort=5687,
-                                                 expectsRejection=False)
+                self._registerObserve(client2, 'core',
+                                      commandPort=self._clientPort(2) + 1,
+                                      expectsRejection=False)
             finally:
                 if client2:
                     client2.close()
@@ -281,19 +357,16 @@ class ObserveTester(object):
         elif testName == 'rereg-reject-resource-used':
             self._registerObserve(self._client, 'stats', token='5a6b')
 
+            client2 = None
             try:
-                client2 = pexpect.spawn(self._clientCmd.format(5686,
-                                        self._serverQualifiedAddr),
-                                        cwd=self._clientDir,
-                                        env={'PYTHONPATH': '../../soscoap/repo'})
-                client2.expect('Starting gcoap observer')
-                time.sleep(1)
+                client2 = self._startClient(self._clientPort(2))
                 print('Client 2 setup OK')
 
-                self._registerObserve(client2, 'core', commandPort=5687,
+                self._registerObserve(client2, 'core',
+                                      commandPort=self._clientPort(2) + 1,
                                       token='6b7c', expectsRejection=False)
 
-                time.sleep(2)
+                waitForIdle(self._server)
                 self._registerObserve(self._client, 'core', token='5a6b',
                                       expectsRejection=True)
             finally:
@@ -307,33 +380,26 @@ class ObserveTester(object):
             self._registerObserve(self._client, 'stats')
             self._registerObserve(self._client, 'core')
 
+            client2 = None
+            client3 = None
             try:
-                client3 = None
-                client2 = pexpect.spawn(self._clientCmd.format(5686,
-                                        self._serverQualifiedAddr),
-                                        cwd=self._clientDir,
-                                        env={'PYTHONPATH': '../../soscoap/repo'})
-                client2.expect('Starting gcoap observer')
-                time.sleep(1)
+                client2 = self._startClient(self._clientPort(2))
                 print('Client 2 setup OK')
 
-                self._registerObserve(client2, 'stats2', commandPort=5687,
-                                                         expectsRejection=True)
+                self._registerObserve(client2, 'stats2',
+                                      commandPort=self._clientPort(2) + 1,
+                                      expectsRejection=True)
 
                 self._deregisterObserve(self._client, 'core')
 
                 # Must use a third client becase we want to test the failure
                 # that client2 was not cleared by the deregister step.
-                client3 = pexpect.spawn(self._clientCmd.format(5688,
-                                        self._serverQualifiedAddr),
-                                        cwd=self._clientDir,
-                                        env={'PYTHONPATH': '../../soscoap/repo'})
-                client3.expect('Starting gcoap observer')
-                time.sleep(1)
+                client3 = self._startClient(self._clientPort(3))
                 print('Client 3 setup OK')
 
-                self._registerObserve(client3, 'stats2', commandPort=5689,
-                                                         expectsRejection=False)
+                self._registerObserve(client3, 'stats2',
+                                      commandPort=self._clientPort(3) + 1,
+                                      expectsRejection=False)
             finally:
                 if client2:
                     client2.close()
@@ -359,46 +425,36 @@ class ObserveTester(object):
             self._client.close()
         if self._supportServer:
             self._supportServer.close()
+        self._commandClient.close()
         print('\nServer, client, support server close OK')
         
 
-    def _registerObserve(self, client, resource, commandPort=5685,
+    def _registerObserve(self, client, resource, commandPort=None,
                          token=None, expectsRejection=False):
         '''Registers for Observe notifications for a resource.
 
         :param client: spawn Pexpect process for observer Python client
         :param resource: string Name of the resource on the gcoap server to observe
         :param commandPort: int Port on which client listens for commands from
-                            command client
+                            command client; defaults to the port for client 1
         :param token: string Token to use for registration; must be even-numbered
                              length, where each pair of characters represents a
                              byte, like '5a' or '05e7'
         :param expectsRejection: boolean If true, we expect the client Observe
                                  registration will fail
         '''
-        commandClient = None
+        commandPort = commandPort or self._clientPort(1) + 1
+        print_text = None
         if self._notifResponse == 'ignore' or self._notifResponse == 'reset':
-            responseCmd = '{0}/coap-client -N -m post -U -T 5a coap://[::1]:{1}/notif/con_{2}'
-            commandClient = pexpect.spawn(responseCmd.format(self._supportDir, commandPort,
-                                                             self._notifResponse))
             print_text = 'con_{0}'.format(self._notifResponse)
         elif self._notifResponse == 'reset_non':
-            responseCmd = '{0}/coap-client -N -m post -U -T 5a coap://[::1]:{1}/notif/non_reset'
-            commandClient = pexpect.spawn(responseCmd.format(self._supportDir, commandPort))
             print_text = 'non_reset'
 
-        if commandClient:
-            commandClient.expect('v:1 t:NON c:POST')
-            commandClient.close()
+        if print_text:
+            self._commandClient.post(commandPort, '/notif/{0}'.format(print_text))
             print('Command client sent /notif/{0} command to client'.format(print_text))
-            time.sleep(1)
-
-        tokenOpt = '-O 15,{0}'.format(token) if token else ''
-        regCmd       = '{0}/coap-client -N -m post -U -T 5a {1} coap://[::1]:{2}/reg/{3}'
-        commandClient = pexpect.spawn(regCmd.format(self._supportDir, tokenOpt,
-                                                    commandPort, resource))
-        commandClient.expect('v:1 t:NON c:POST')
-        commandClient.close()
+
+        self._commandClient.post(commandPort, '/reg/{0}'.format(resource), query=token)
         print('Command client sent /reg command to client')
 
         if expectsRejection:
@@ -412,12 +468,9 @@ class ObserveTester(object):
             print('Client registered for {0}; Observe value: {1}'.format(resource,
                                                                          match.group(2)))
 
-    def _deregisterObserve(self, client, resource, commandPort=5685):
-        deregCmd     = '{0}/coap-client -N -m post -U -T 5a coap://[::1]:{1}/dereg/{2}'
-        commandClient = pexpect.spawn(deregCmd.format(self._supportDir, commandPort,
-                                                                        resource))
-        commandClient.expect('v:1 t:NON c:POST')
-        commandClient.close()
+    def _deregisterObserve(self, client, resource, commandPort=None):
+        commandPort = commandPort or self._clientPort(1) + 1
+        self._commandClient.post(commandPort, '/dereg/{0}'.format(resource))
         print('Command client sent /dereg command to client')
 
         client.expect('2\.05; Observe len: 0;')
@@ -429,7 +482,8 @@ class ObserveTester(object):
 
     def _triggerNotification(self, server, client, resource):
         '''Only works for stats resource'''
-        server.sendline('coap get {0} 5683 /time'.format(self._supportServerAddr))
+        server.sendline('coap get {0} {1} /time'.format(self._supportServerAddr,
+                                                         self._basePort))
         # Expects month day time
         server.expect('\w+ \d+ \d+:\d+:\d+\r\n')
 
@@ -441,16 +495,13 @@ class ObserveTester(object):
                                                                             match.group(2)))
 
     def _verifyNoNotification(self, server, client, resource):
-        server.sendline('coap get {0} 5683 /time'.format(self._supportServerAddr))
+        server.sendline('coap get {0} {1} /time'.format(self._supportServerAddr,
+                                                         self._basePort))
         server.expect('\w+ \d+ \d+:\d+:\d+\r\n')
 
         # Send ping post to client so we may examine the output for anything
         # unexpected.
-        commandPort   = 5685
-        pingCmd       = '{0}/coap-client -N -m post -U -T 5a coap://[::1]:{1}/ping'
-        commandClient = pexpect.spawn(pingCmd.format(self._supportDir, commandPort))
-        commandClient.expect('v:1 t:NON c:POST')
-        commandClient.close()
+        self._commandClient.post(self._clientPort(1) + 1, '/ping')
 
         client.expect('Got ping post', timeout=2)
         if re.search('Observe', client.before):
@@ -469,17 +520,23 @@ if __name__ == "__main__":
     parser.add_option('-x', type='string', dest='serverDir', default=None)
     parser.add_option('-y', type='string', dest='clientDir', default=None)
     parser.add_option('-z', type='string', dest='supportDir', default=None)
+    parser.add_option('-s', type='int', dest='seedSecs', default=20)
+    parser.add_option('-n', type='string', dest='iface', default='tap0')
+    parser.add_option('-P', type='int', dest='basePort', default=5683)
 
     (options, args) = parser.parse_args()
 
     tester = None
     try:
         tester = ObserveTester(options.addr, options.serverDir, options.clientDir,
-                               options.supportDir, options.notifResponse)
-        # pause here so tester is instantiated in case must close abruply
-        print('Pause 20 seconds to seed Observe value\n')
-        time.sleep(20)
-        tester.runTest(options.testName)
+                               options.supportDir, options.notifResponse,
+                               options.iface, options.basePort)
+        # pause here so tester is instantiated in case must close abruply;
+        # a deliberate wait rather than for a condition
+        print('Pause {0} seconds to seed Observe value\n'.format(options.seedSecs))
+        time.sleep(options.seedSecs)
+        with TestTimer(options.testName):
+            tester.runTest(options.testName)
     finally:
         if tester:
             tester.close()
@@ -15,10 +15,12 @@ for gcoaptest server, as well as start the server itself. See examples below.
 Options:
 
 -a <addr>  -- Address of server
+-p <port>  -- Port of server; defaults to 5683
+-i <iface> -- tap interface for a native RIOT instance; defaults to tap0
 -c         -- Send message confirmably. For 'repeat-get' test only.
 -d <secs>  -- Server built-in response delay, in seconds
--r <count> -- Number of times to repeat query, with a 1 second wait between
-              response and next request. For 'repeat-get' test only.
+-r <count> -- Number of times to repeat query. The next request is sent once
+              the client reports no open requests. For 'repeat-get' test only.
 -t <test> --- Name of test to run. Options:
                 repeat-get -- Repeats a sinple GET request
                 con-retries -- gcoaptest server ignores requests, to test
@@ -36,6 +38,10 @@ Options:
 -x <dir>   -- Directory in which to execute the script; must be location of
               RIOT gcoap example app.
 
+Steps wait for the state they depend on, like the shell prompt or the client
+reporting no open requests, rather than for a fixed time; see waits.py. Prints
+the time for the test when done.
+
 Example:
 
 # tap example
@@ -72,15 +78,17 @@ import time
 import os
 import signal
 import pexpect
+from   waits    import waitForShell, pollOutput, waitForIdle, WaitTimeout, TestTimer
 
-def main(addr, testName, serverDelay, repeatCount, confirmable):
+def main(addr, testName, serverDelay, repeatCount, confirmable, port=5683,
+         iface='tap0'):
     '''Common setup for all tests
     '''
     xfaceType = 'tap' if addr[:4] == 'fe80' else 'tun'
     print('Setup RIOT client for {0} interface'.format(xfaceType))
 
     if xfaceType == 'tap':
-        child = pexpect.spawn('make term')
+        child = pexpect.spawn('make term PORT={0}'.format(iface))
         # accepts either gcoap example app or riot-gcoap-test app
         child.expect('gcoap .* app')
     else:
@@ -92,14 +100,22 @@ def main(addr, testName, serverDelay, repeatCount, confirmable):
         child.sendline('ifconfig 6 add unicast fe80::bbbb:2/64')
         child.expect('success:')
     else:
-        time.sleep(1)
+        waitForShell(child)
         child.sendline('ifconfig 8 add unicast bbbb::2/64')
         child.expect('success:')
         child.sendline('nib neigh add 8 bbbb::1')
-        time.sleep(1)
-        child.sendline('nib neigh')
-        child.expect('bbbb::1')
+        pollOutput(child, 'nib neigh', 'bbbb::1', timeout=5)
+
+    # commands address the server as '<addr> <port>'
+    server = '{0} {1}'.format(addr, port)
+    with TestTimer(testName):
+        runTest(child, server, testName, serverDelay, repeatCount, confirmable)
 
+def runTest(child, addr, testName, serverDelay, repeatCount, confirmable):
+    '''Runs a test.
+
+    :param addr: string Server address and port, like 'fe80::bbbb:1 5683'
+    '''
     if testName == 'repeat-get':
         runRepeatGet(child, addr, serverDelay, repeatCount, confirmable)
     elif testName == 'con-retries':
@@ -122,28 +138,22 @@ def runRepeatGet(child, addr, serverDelay, repeatCount, confirmable):
     '''Repeats a simple GET request
     '''
     print('Test: Repeat GET /ver')
-    time.sleep(1)
-    child.sendline('coap post {0} 5683 /cf/delay {1}'.format(addr, serverDelay))
+    child.sendline('coap post {0} /cf/delay {1}'.format(addr, serverDelay))
     child.expect('code 2\.04')
     print('Server delay set to {0}\n'.format(serverDelay))
 
     confirmOpt = '-c' if confirmable else ''
     
     for x in range(repeatCount):
-        time.sleep(1)
-        child.sendline('coap get {0} {1} 5683 /ver'.format(confirmOpt, addr))
+        child.sendline('coap get {0} {1} /ver'.format(confirmOpt, addr))
         child.expect('0\.1')
         print('Success: {0}'.format(child.after))
-        
-        child.sendline('coap info')
-        child.expect('open requests.*\n')
-        print(child.after)
+
+        # next request when this one is closed
+        print(waitForIdle(child, timeout=serverDelay + 10))
 
     print('Wait to check open requests')
-    time.sleep(5)
-    child.sendline('coap info')
-    child.expect('open requests.*\n')
-    print(child.after)
+    checkIdle(child)
     # Must force here
     forceClose(child)
 
@@ -153,13 +163,11 @@ def runConRetries(child, addr, retryCount):
     server ignores 5 requests/retries.
     '''
     print('Test: Confirmable retries')
-    time.sleep(1)
-    child.sendline('coap put {0} 5683 /ver/ignores {1}'.format(addr, retryCount))
+    child.sendline('coap put {0} /ver/ignores {1}'.format(addr, retryCount))
     child.expect('code 2\.04')
     print('Server request ignores set to {0}\n'.format(retryCount))
 
-    time.sleep(1)
-    child.sendline('coap get -c {0} 5683 /ver'.format(addr))
+    child.sendline('coap get -c {0} /ver'.format(addr))
     # Uses ACK_RANDOM_FACTOR of 1.5, and adds a couple of extra seconds
     timeout = 3
     for i in range(1, retryCount+1):
@@ -174,17 +182,26 @@ def runConRetries(child, addr, retryCount):
         print('Success: {0}'.format(child.after))
 
     print('Wait to check open requests')
-    time.sleep(5)
-    child.sendline('coap info')
-    child.expect('open requests.*\n')
-    print(child.after)
+    checkIdle(child)
     # Must force here
     forceClose(child)
 
+def checkIdle(child, timeout=5):
+    '''Prints the open requests line once the client has none open, or the
+    last line seen if still open after timeout seconds.
+    '''
+    try:
+        print(waitForIdle(child, timeout=timeout))
+    except WaitTimeout as e:
+        print('*** FAIL ***\n{0}'.format(e))
+        child.sendline('coap info')
+        child.expect('open requests.*\n')
+        print(child.after)
+
 def runToobig(child, addr):
     print('Test: GET /toobig')
 
-    child.sendline('coap get {0} 5683 /toobig'.format(addr))
+    child.sendline('coap get {0} /toobig'.format(addr))
     child.expect(pexpect.TIMEOUT, timeout=5)
     print('Success: <timeout>'.format(child.after))
     child.close()
@@ -192,15 +209,15 @@ def runToobig(child, addr):
 def runToomany(child, addr):
     print('Test: Too many open requests to send another')
 
-    child.sendline('coap get {0} 5683 /ignore'.format(addr))
+    child.sendline('coap get {0} /ignore'.format(addr))
     child.expect('sending msg')
     print('Sent 1')
 
-    child.sendline('coap get {0} 5683 /ignore'.format(addr))
+    child.sendline('coap get {0} /ignore'.format(addr))
     child.expect('sending msg')
     print('Sent 2')
 
-    child.sendline('coap get {0} 5683 /ignore'.format(addr))
+    child.sendline('coap get {0} /ignore'.format(addr))
     child.expect('send failed')
     print('Sent 3; failed as expected')
     child.close()
@@ -210,11 +227,11 @@ def runToomanyConfirm(child, addr):
     # separate.
     print('Test: Too many open confirmable requests to send another')
 
-    child.sendline('coap get -c {0} 5683 /ignore'.format(addr))
+    child.sendline('coap get -c {0} /ignore'.format(addr))
     child.expect('sending msg')
     print('Sent 1')
 
-    child.sendline('coap get -c {0} 5683 /ignore'.format(addr))
+    child.sendline('coap get -c {0} /ignore'.format(addr))
     child.expect('send failed')
     print('Sent 2; failed as expected')
     child.close()
@@ -239,7 +256,7 @@ def runNoHandler(child, addr):
     child.sendline('coap config resp.handler 0'.format(addr))
     child.expect('Response handler disabled')
 
-    child.sendline('coap get {0} 5683 /ver'.format(addr))
+    child.sendline('coap get {0} /ver'.format(addr))
     child.expect('msg not found', timeout=5)
     print('Success: {0}'.format(child.after))
 
@@ -258,6 +275,8 @@ if __name__ == "__main__":
     # read command line
     parser = OptionParser()
     parser.add_option('-a', type='string', dest='addr')
+    parser.add_option('-p', type='int', dest='port', default=5683)
+    parser.add_option('-i', type='string', dest='iface', default='tap0')
     parser.add_option('-c', action='store_true', dest='confirmable', default=False)
     parser.add_option('-d', type='int', dest='serverDelay', default=0)
     parser.add_option('-r', type='int', dest='repeatCount', default=1)
@@ -272,7 +291,7 @@ if __name__ == "__main__":
         os.chdir(options.execDir)
     try:
         main(options.addr, options.testName, options.serverDelay, options.repeatCount,
-             options.confirmable)
+             options.confirmable, options.port, options.iface)
     finally:
         if options.execDir:
             os.chdir(curdir) 
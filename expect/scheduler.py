@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+
+'''Runs riot2gcoaptest and observe_test tests in parallel, each worker with its
+own native RIOT instance, tap interface, and ports, and merges the results into
+one report.
+
+Each worker runs its tests one at a time, so a worker's RIOT instance and
+gcoaptest server never see two tests at once. Workers are isolated in one of
+two ways:
+
+* netns -- Each worker runs in its own Linux network namespace, with its own
+           tap0 at fe80::bbbb:1, so all workers use the default ports. Requires
+           root.
+* tap   -- Worker n uses interface tap<n>, which must already exist, like tap0
+           in the harness examples, and a range of ports from
+           <basePort> + n * <stride>.
+
+For riot2gcoaptest tests, each worker runs its own gcoaptest server, stopped
+before an observe test, which runs its own server on the same port. A test
+passes if the harness exits normally, reports the test as done, and does not
+print '*** FAIL ***'. The output from each test is written to a file in the
+log directory.
+
+Options:
+
+-t <list>  -- Comma separated tests, as <harness>:<test>[:<args>], where harness
+              is 'riot' for riot2gcoaptest or 'observe' for observe_test, and
+              args are extra harness options, like 'riot:repeat-get:-d 1 -r 50'.
+              Defaults to riot:toobig,riot:toomany,riot:cmdargs
+-w <count> -- Workers; defaults to 2
+-m <mode>  -- Worker isolation, netns or tap; defaults to netns
+-u <user>  -- Owner of tap interfaces created in netns mode; defaults to the
+              SUDO_USER, if any
+-P <port>  -- First port in tap mode; defaults to 5683
+-S <count> -- Ports for each worker in tap mode; defaults to 10
+-x <dir>   -- RIOT gcoap example directory, for riot tests
+-X <dir>   -- riot-gcoap-test directory, for observe tests
+-y <dir>   -- gcoap observer directory, for observe tests
+-z <dir>   -- libcoap example apps directory, for observe tests
+-l <dir>   -- Directory for test output; defaults to 'schedlogs'
+-o <file>  -- Also writes the report as JSON to this file
+
+Example:
+
+# Build the native RIOT app first; workers share the binary.
+$ make -C /home/kbee/dev/riot/repo/examples/gcoap
+$ sudo PYTHONPATH="../../soscoap/repo" ./scheduler.py -w 3 -x /home/kbee/dev/riot/repo/examples/gcoap
+'''
+from __future__ import print_function
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from   waits import WaitTimeout, waitForCoap
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+EXPECT_DIR   = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR  = os.path.dirname(EXPECT_DIR)
+HARNESSES    = {'riot': 'riot2gcoaptest.py', 'observe': 'observe_test.py'}
+DEFAULT_TESTS = 'riot:toobig,riot:toomany,riot:cmdargs'
+HOST_ADDR    = 'fe80::bbbb:1'
+SERVER_ADDR  = 'fe80::bbbb:2'
+
+_DONE_PATTERN = re.compile(r'Test \S+ done in ([\d.]+) s')
+
+class TestSpec(object):
+    '''A test to run.
+
+    Attributes:
+        :harness: string 'riot' or 'observe'
+        :name:    string Test name for the harness
+        :args:    list:string Extra harness options
+    '''
+    def __init__(self, text):
+        parts = text.split(':', 2)
+        if len(parts) < 2 or parts[0] not in HARNESSES:
+            raise ValueError('Test must be <harness>:<test>[:<args>]: {0}'.format(text))
+        self.harness = parts[0]
+        self.name    = parts[1]
+        self.args    = shlex.split(parts[2]) if len(parts) > 2 else []
+
+    def label(self):
+        return ' '.join([self.harness + ':' + self.name] + self.args)
+
+class Worker(object):
+    '''Runs tests on its own interface and ports.
+
+    Attributes:
+        :index:     int Worker number, from 0
+        :iface:     string tap interface for the RIOT instance
+        :basePort:  int First port for the worker
+        :namespace: string Network namespace name, or None in tap mode
+        :_options:  Scheduler options
+        :_tester:   Popen gcoaptest server process, or None if not started
+    '''
+    def __init__(self, index, options):
+        self.index    = index
+        self._options = options
+        self._tester  = None
+        if options.mode == 'netns':
+            self.namespace = 'gcoaptest{0}'.format(index)
+            self.iface     = 'tap0'
+            self.basePort  = 5683
+        else:
+            self.namespace = None
+            self.iface     = 'tap{0}'.format(index)
+            self.basePort  = options.basePort + index * options.stride
+
+    def _wrap(self, command):
+        '''Returns a command to run in the worker's namespace.'''
+        if self.namespace:
+            return ['ip', 'netns', 'exec', self.namespace] + command
+        return command
+
+    def setup(self):
+        '''Creates the namespace and its tap interface, in netns mode.'''
+        if not self.namespace:
+            return
+        _run(['ip', 'netns', 'add', self.namespace])
+        _run(self._wrap(['ip', 'link', 'set', 'lo', 'up']))
+        tapCmd = ['ip', 'tuntap', 'add', self.iface, 'mode', 'tap']
+        if self._options.tapUser:
+            tapCmd += ['user', self._options.tapUser]
+        _run(self._wrap(tapCmd))
+        _run(self._wrap(['ip', 'link', 'set', self.iface, 'up']))
+        # no duplicate address detection, so the address is usable at once
+        _run(self._wrap(['sysctl', '-q', '-w',
+                         'net.ipv6.conf.{0}.accept_dad=0'.format(self.iface)]))
+        _run(self._wrap(['ip', 'address', 'add', HOST_ADDR + '/64', 'dev', self.iface]))
+
+    def teardown(self):
+        self._stopTester()
+        if self.namespace:
+            _run(['ip', 'netns', 'delete', self.namespace], check=False)
+
+    def _startTester(self, logDir):
+        '''Starts the worker's gcoaptest server, if not started.'''
+        if self._tester:
+            return
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [PACKAGE_DIR,
+                                                          env.get('PYTHONPATH')]))
+        # tester writes its log to the working directory
+        workDir = os.path.join(logDir, 'worker{0}'.format(self.index))
+        if not os.path.isdir(workDir):
+            os.makedirs(workDir)
+        with open(os.devnull, 'w') as devnull:
+            self._tester = subprocess.Popen(self._wrap([sys.executable, '-m',
+                                                        'gcoaptest.tester',
+                                                        '-p', str(self.basePort),
+                                                        '--log-level', 'info']),
+                                            cwd=workDir, env=env, stdout=devnull,
+                                            stderr=subprocess.STDOUT)
+        try:
+            if self.namespace:
+                self._waitInNamespace()
+            else:
+                waitForCoap('::1', self.basePort)
+        except WaitTimeout:
+            # so the next riot test starts a fresh tester
+            self._stopTester()
+            raise
+
+    def _waitInNamespace(self):
+        '''Waits until the tester answers, with the readiness probe run in the
+        worker's namespace, since the tester is not reachable from here.
+
+        :raises WaitTimeout: If the tester does not answer
+        '''
+        probe = ('import sys; sys.path.insert(0, {0!r}); '
+                 'from waits import waitForCoap; '
+                 "waitForCoap('::1', {1})").format(EXPECT_DIR, self.basePort)
+        with open(os.devnull, 'w') as devnull:
+            status = subprocess.call(self._wrap([sys.executable, '-c', probe]),
+                                     stdout=devnull, stderr=devnull)
+        if status != 0:
+            raise WaitTimeout('Timed out waiting for gcoaptest server in {0}'.format(
+                              self.namespace))
+
+    def _stopTester(self):
+        if self._tester:
+            self._tester.terminate()
+            self._tester.wait()
+            self._tester = None
+
+    def harnessCommand(self, spec):
+        '''Returns the command line to run a test.'''
+        opts    = self._options
+        command = [sys.executable, os.path.join(EXPECT_DIR, HARNESSES[spec.harness]),
+                   '-a', HOST_ADDR if spec.harness == 'riot' else SERVER_ADDR,
+                   '-t', spec.name]
+        if spec.harness == 'riot':
+            command += ['-p', str(self.basePort), '-i', self.iface, '-x', opts.riotDir]
+        else:
+            command += ['-n', self.iface, '-P', str(self.basePort), '-x', opts.serverDir,
+                        '-y', opts.clientDir, '-z', opts.supportDir]
+        return self._wrap(command + spec.args)
+
+    def runTest(self, spec, logDir):
+        '''Runs a test, and returns its result as a dict.'''
+        if spec.harness == 'riot':
+            self._startTester(logDir)
+        else:
+            # an observe test runs its own server on basePort
+            self._stopTester()
+
+        logName = '{0}-{1}-w{2}.log'.format(spec.harness, spec.name, self.index)
+        logPath = os.path.join(logDir, logName)
+        started = time.time()
+        with open(logPath, 'wb') as logFile:
+            status = subprocess.call(self.harnessCommand(spec), stdout=logFile,
+                                     stderr=subprocess.STDOUT)
+        elapsed = time.time() - started
+
+        with open(logPath, 'rb') as logFile:
+            output = logFile.read().decode('utf-8', 'replace')
+        done   = _DONE_PATTERN.search(output)
+        passed = status == 0 and done is not None and '*** FAIL ***' not in output
+        return {'test':     spec.label(),
+                'worker':   self.index,
+                'passed':   passed,
+                'status':   status,
+                'testSecs': float(done.group(1)) if done else None,
+                'elapsed':  round(elapsed, 2),
+                'log':      logPath}
+
+class Scheduler(object):
+    '''Runs tests across workers, and collects the results.
+
+    Attributes:
+        :_workers: list:Worker
+        :_tests:   Queue of TestSpec, for workers to take
+        :results:  list:dict Test results, in order of completion
+    '''
+    def __init__(self, specs, options):
+        self._options = options
+        self._workers = [Worker(i, options) for i in range(options.workers)]
+        self._tests   = queue.Queue()
+        for spec in specs:
+            self._tests.put(spec)
+        self._lock    = threading.Lock()
+        self.results  = []
+
+    def run(self):
+        '''Runs all tests; returns when done.'''
+        if not os.path.isdir(self._options.logDir):
+            os.makedirs(self._options.logDir)
+        threads = []
+        try:
+            for worker in self._workers:
+                worker.setup()
+            for worker in self._workers:
+                thread = threading.Thread(target=self._runWorker, args=(worker,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                while thread.is_alive():
+                    # timeout so Ctrl-C interrupts
+                    thread.join(1)
+        finally:
+            for worker in self._workers:
+                worker.teardown()
+
+    def _runWorker(self, worker):
+        while True:
+            try:
+                spec = self._tests.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = worker.runTest(spec, self._options.logDir)
+            except Exception as e:
+                result = {'test': spec.label(), 'worker': worker.index, 'passed': False,
+                          'status': None, 'testSecs': None, 'elapsed': None,
+                          'log': None, 'error': str(e)}
+            with self._lock:
+                self.results.append(result)
+                print('{0:<5} {1} (worker {2})'.format('ok' if result['passed'] else 'FAIL',
+                                                       result['test'], worker.index))
+
+def formatReport(results, wallSecs):
+    '''Returns the results as a printable table.'''
+    lines = ['{0:<40} {1:>6} {2:>6} {3:>9}'.format('Test', 'Worker', 'Result', 'Test secs')]
+    for result in sorted(results, key=lambda r: r['test']):
+        secs = '-' if result['testSecs'] is None else '{0:.2f}'.format(result['testSecs'])
+        lines.append('{0:<40} {1:>6} {2:>6} {3:>9}'.format(result['test'], result['worker'],
+                                                            'ok' if result['passed'] else 'FAIL',
+                                                            secs))
+    passed = sum(1 for r in results if r['passed'])
+    lines.append('{0} of {1} passed in {2:.2f} s'.format(passed, len(results), wallSecs))
+    return '\n'.join(lines)
+
+def _run(command, check=True):
+    if check:
+        subprocess.check_call(command)
+    else:
+        subprocess.call(command)
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    # read command line
+    parser = OptionParser()
+    parser.add_option('-t', type='string', dest='tests', default=DEFAULT_TESTS)
+    parser.add_option('-w', type='int', dest='workers', default=2)
+    parser.add_option('-m', type='choice', dest='mode', choices=('netns', 'tap'),
+                      default='netns')
+    parser.add_option('-u', type='string', dest='tapUser',
+                      default=os.environ.get('SUDO_USER'))
+    parser.add_option('-P', type='int', dest='basePort', default=5683)
+    parser.add_option('-S', type='int', dest='stride', default=10)
+    parser.add_option('-x', type='string', dest='riotDir', default='')
+    parser.add_option('-X', type='string', dest='serverDir', default='')
+    parser.add_option('-y', type='string', dest='clientDir', default='')
+    parser.add_option('-z', type='string', dest='supportDir', default='')
+    parser.add_option('-l', type='string', dest='logDir', default='schedlogs')
+    parser.add_option('-o', type='string', dest='jsonFile')
+
+    (options, args) = parser.parse_args()
+    try:
+        specs = [TestSpec(text) for text in options.tests.split(',') if text]
+    except ValueError as e:
+        parser.error(str(e))
+    options.logDir = os.path.abspath(options.logDir)
+
+    started   = time.time()
+    scheduler = Scheduler(specs, options)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        print('\nInterrupted; reporting completed tests')
+    wallSecs = time.time() - started
+
+    print()
+    print(formatReport(scheduler.results, wallSecs))
+    if options.jsonFile:
+        with open(options.jsonFile, 'w') as jsonFile:
+            json.dump({'wallSecs': round(wallSecs, 2), 'results': scheduler.results},
+                      jsonFile, indent=2, sort_keys=True)
+
+    sys.exit(0 if all(r['passed'] for r in scheduler.results) else 1)
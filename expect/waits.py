@@ -0,0 +1,138 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+
+'''Readiness and condition waits for the expect test harnesses. Each wait polls
+for the state a step depends on, like a shell prompt, a CoAP endpoint that
+answers, or a RIOT node with no open requests, and returns as soon as it is
+reached. A wait that times out raises WaitTimeout, so a broken step fails
+fast, instead of a fixed sleep hiding the problem until a later step.
+
+Also provides TestTimer, to report the time for each test.
+'''
+from __future__ import print_function
+import random
+import select
+import socket
+import struct
+import time
+import pexpect
+
+class WaitTimeout(Exception):
+    '''A wait did not reach its condition in time.'''
+    pass
+
+def waitFor(condition, timeout, interval=0.1, what='condition'):
+    '''Polls until condition() returns a true value.
+
+    :param condition: callable, with no arguments
+    :param interval: float Seconds between polls
+    :return: The true value from condition()
+    :raises WaitTimeout: If not true within timeout seconds
+    '''
+    deadline = time.time() + timeout
+    while True:
+        result = condition()
+        if result:
+            return result
+        if time.time() >= deadline:
+            raise WaitTimeout('Timed out after {0}s waiting for {1}'.format(timeout, what))
+        time.sleep(interval)
+
+def waitForShell(child, timeout=5):
+    '''Waits for a RIOT shell to accept a command, by sending an empty line and
+    expecting the prompt.
+    '''
+    child.sendline('')
+    child.expect('> ', timeout=timeout)
+
+def pollOutput(child, command, pattern, accept=None, timeout=10, interval=0.25):
+    '''Sends a command to a pexpect child until its output matches pattern,
+    and accept(match) is true.
+
+    :param pattern: string Regular expression for the output of interest
+    :param accept: callable, with the re match; if None, any match is accepted
+    :return: re match for the accepted output
+    :raises WaitTimeout: If not accepted within timeout seconds
+    '''
+    deadline = time.time() + timeout
+    while True:
+        remaining = max(deadline - time.time(), 0.1)
+        child.sendline(command)
+        try:
+            child.expect(pattern, timeout=remaining)
+            if accept is None or accept(child.match):
+                return child.match
+        except pexpect.TIMEOUT:
+            pass
+        if time.time() >= deadline:
+            raise WaitTimeout('Timed out after {0}s waiting for "{1}" from "{2}"'.format(
+                              timeout, pattern, command))
+        time.sleep(interval)
+
+def waitForIdle(child, timeout=10):
+    '''Waits until a RIOT gcoap node reports no open requests, like a
+    confirmable notification or request still waiting for its ACK.
+
+    :return: string Last 'open requests' line
+    '''
+    match = pollOutput(child, 'coap info', r'open requests: (\d+)\s',
+                       accept=lambda m: m.group(1) in ('0', b'0'), timeout=timeout)
+    line  = match.group(0).strip()
+    return line.decode('utf-8') if isinstance(line, bytes) else line
+
+def coapReady(addr, port, path=None, timeout=0.5):
+    '''Returns True if a CoAP endpoint answers. Sends a CoAP ping, an empty
+    confirmable message, which is answered by a reset. If path is given,
+    sends a non-confirmable GET for it instead, for a server that does not
+    answer a ping.
+    '''
+    messageId = random.randint(0, 65535)
+    if path:
+        message = struct.pack('!BBHB', 0x51, 0x01, messageId, 0x5a)
+        lastNum = 0
+        for segment in path.strip('/').split('/'):
+            segment  = segment.encode('utf-8')
+            # Uri-Path option, number 11; segments shorter than 13 bytes
+            message += struct.pack('!B', ((11 - lastNum) << 4) | len(segment)) + segment
+            lastNum  = 11
+    else:
+        message = struct.pack('!BBH', 0x40, 0x00, messageId)
+
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(message, (addr, port))
+        return bool(select.select([sock], [], [], timeout)[0])
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+def waitForCoap(addr, port, path=None, timeout=10):
+    '''Waits until a CoAP endpoint answers; see coapReady().'''
+    waitFor(lambda: coapReady(addr, port, path), timeout, interval=0,
+            what='CoAP endpoint [{0}]:{1}'.format(addr, port))
+
+class TestTimer(object):
+    '''Context manager that prints the time for a test when it completes or
+    fails.
+
+    Usage:
+        with TestTimer('observe'):
+            runTest()
+    '''
+    def __init__(self, name):
+        self.name    = name
+        self.elapsed = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.elapsed = time.time() - self._start
+        result = 'failed' if excType else 'done'
+        print('Test {0} {1} in {2:.2f} s'.format(self.name, result, self.elapsed))
+        return False
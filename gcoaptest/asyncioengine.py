@@ -0,0 +1,164 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Transport engine on an asyncio event loop, via a DatagramProtocol. Runs on the
+standard loop, or on uvloop if requested and installed.
+
+When the loop delivers a datagram, the engine also drains any others already
+queued on the socket, so a burst is handled in one loop wakeup rather than
+one wakeup per datagram.
+'''
+import asyncio
+import logging
+from   gcoaptest.batchio import BatchSocketIO
+from   gcoaptest.engine  import CoapEndpoint, RECV_BUFSIZE, createSocket
+
+log = logging.getLogger(__name__)
+
+# Most datagrams to read from the socket per loop wakeup
+BATCH_SIZE = 64
+
+
+class LoopTimers(object):
+    '''Schedules deferred work directly on an asyncio loop, with the interface
+    of gcoaptest.timer.TimerQueue.
+    '''
+    def __init__(self, loop):
+        self._loop = loop
+
+    def schedule(self, delay, callback, *args):
+        return self._loop.call_later(delay, callback, *args)
+
+    def cancel(self, entry):
+        entry.cancel()
+
+
+class _EngineProtocol(asyncio.DatagramProtocol):
+    '''Receives datagrams for an AsyncioEngine. After the loop delivers a
+    datagram, drains up to BATCH_SIZE more already queued on the socket.
+    '''
+    def __init__(self, engine, sock):
+        self._engine = engine
+        self._sock   = sock
+
+    def datagram_received(self, data, addr):
+        receive = self._engine._receive
+        receive(data, addr)
+        batchIO = self._engine._batchIO
+        if batchIO:
+            for data, addr in batchIO.receive():
+                receive(data, addr)
+            return
+
+        recvfrom = self._sock.recvfrom
+        for i in range(BATCH_SIZE):
+            try:
+                data, addr = recvfrom(RECV_BUFSIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            receive(data, addr)
+
+    def error_received(self, exc):
+        log.debug('Socket error: %s', exc)
+
+
+class AsyncioEngine(CoapEndpoint):
+    '''Transport engine on an asyncio event loop.
+
+    Attributes:
+        :loop: asyncio event loop; may be shared with other engines
+        :_loopUsers: list with the count of open engines on the loop, shared
+                     by those engines. The last engine closed also closes
+                     the loop.
+        :_closed: boolean True once close() has run
+
+    Usage:
+        #. engine = AsyncioEngine(port)
+        #. engine.registerForResourceGet(handler) -- and others
+        #. engine.start() -- Runs the event loop until close()
+    '''
+    def __init__(self, port, useUvloop=False, sharedWith=None, reusePort=False,
+                 batchSize=0):
+        '''Pass in sharedWith to run on the event loop of another AsyncioEngine.
+
+        :param batchSize: int If not zero, receive and send up to this many
+                          datagrams per call with BatchSocketIO. Sends are
+                          queued and flushed once per loop iteration.
+        :raises ImportError: If useUvloop, but uvloop not installed
+        '''
+        if sharedWith:
+            self.loop       = sharedWith.loop
+            self._loopUsers = sharedWith._loopUsers
+        else:
+            if useUvloop:
+                import uvloop
+                self.loop = uvloop.new_event_loop()
+            else:
+                self.loop = asyncio.new_event_loop()
+            self._loopUsers = [0]
+        self._loopUsers[0] += 1
+        self._closed        = False
+        super(AsyncioEngine, self).__init__(LoopTimers(self.loop))
+
+        sock = createSocket(port, reusePort)
+        self._batchIO = BatchSocketIO(sock, batchSize) if batchSize else None
+        endpoint      = self.loop.create_datagram_endpoint(
+                            lambda: _EngineProtocol(self, sock), sock=sock)
+        if self.loop.is_running():
+            # created from a handler on a shared loop; finish on the loop, and
+            # hold sends until then
+            self._transport = None
+            self._pending   = []
+            asyncio.ensure_future(endpoint, loop=self.loop).add_done_callback(
+                self._endpointCreated)
+        else:
+            self._transport, self._protocol = self.loop.run_until_complete(endpoint)
+
+    def _endpointCreated(self, future):
+        self._transport, self._protocol = future.result()
+        for data, address in self._pending:
+            self._sendBytes(data, address)
+        self._pending = None
+
+    def _sendBytes(self, data, address):
+        if self._batchIO:
+            if self._batchIO.queue(data, address):
+                self.loop.call_soon(self._batchIO.flush)
+        elif self._transport:
+            self._transport.sendto(data, address)
+        else:
+            self._pending.append((data, address))
+
+    def start(self):
+        '''Runs the event loop until close(). Closes the loop if all of its
+        engines were closed meanwhile.
+        '''
+        self.loop.run_forever()
+        if not self._loopUsers[0]:
+            self._closeLoop()
+
+    def close(self):
+        '''Stops the event loop. If this is the last open engine on the loop,
+        also closes the loop, now or when start() returns.
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        if self._transport:
+            self._transport.close()
+        self._loopUsers[0] -= 1
+        if self.loop.is_running():
+            self.loop.stop()
+        elif not self._loopUsers[0]:
+            self._closeLoop()
+
+    def _closeLoop(self):
+        '''Closes the loop, after it runs the callbacks that finish closing
+        the transports, so no socket or selector is left for the collector.
+        '''
+        if not self.loop.is_closed():
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
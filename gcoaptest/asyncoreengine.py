@@ -0,0 +1,96 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Transport engine on an asyncore networking loop. asyncore was removed from the
+standard library in Python 3.12; see asyncioengine for a replacement.
+'''
+import asyncore
+import errno
+import socket
+from   gcoaptest.batchio import BatchSocketIO
+from   gcoaptest.engine  import CoapEndpoint, RECV_BUFSIZE, createSocket
+
+# Longest time to block in the networking loop without checking timers
+MAX_POLL_SECS = 30.0
+# Most datagrams to read from the socket per loop wakeup
+BATCH_SIZE = 64
+
+
+class _EngineSocket(asyncore.dispatcher):
+    '''UDP socket for an AsyncoreEngine.'''
+    def __init__(self, sock, receiveFn, socketMap, batchIO=None):
+        asyncore.dispatcher.__init__(self, sock=sock, map=socketMap)
+        self._receiveFn = receiveFn
+        self._batchIO   = batchIO
+
+    def handle_read(self):
+        if self._batchIO:
+            for data, address in self._batchIO.receive():
+                self._receiveFn(data, address)
+            self._batchIO.flush()
+        else:
+            # asyncore polls once per datagram otherwise; drain what is queued
+            recvfrom = self.socket.recvfrom
+            for i in range(BATCH_SIZE):
+                if self.socket.fileno() < 0:
+                    # closed by a handler
+                    break
+                try:
+                    data, address = recvfrom(RECV_BUFSIZE)
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                        break
+                    raise
+                self._receiveFn(data, address)
+
+    def writable(self):
+        return False
+
+
+class AsyncoreEngine(CoapEndpoint):
+    '''Transport engine on an asyncore networking loop.
+
+    Usage:
+        #. engine = AsyncoreEngine(port)
+        #. engine.registerForResourceGet(handler) -- and others
+        #. engine.start() -- Runs the networking loop until close()
+    '''
+    def __init__(self, port, sharedWith=None, reusePort=False, batchSize=0):
+        '''Pass in sharedWith to run on the socket map and timers of another
+        AsyncoreEngine.
+
+        :param batchSize: int If not zero, receive and send up to this many
+                          datagrams per call with BatchSocketIO
+        '''
+        if sharedWith:
+            super(AsyncoreEngine, self).__init__(sharedWith.timers)
+            self._map = sharedWith._map
+        else:
+            super(AsyncoreEngine, self).__init__()
+            self._map = {}
+        sock          = createSocket(port, reusePort)
+        self._batchIO = BatchSocketIO(sock, batchSize) if batchSize else None
+        self._socket  = _EngineSocket(sock, self._receive, self._map, self._batchIO)
+        self._running = False
+
+    def _sendBytes(self, data, address):
+        if self._batchIO:
+            self._batchIO.queue(data, address)
+        else:
+            self._socket.socket.sendto(data, address)
+
+    def start(self):
+        '''Runs the networking loop, servicing timers between socket polls.'''
+        self._running = True
+        while self._running and self._map:
+            asyncore.loop(timeout=self.timers.timeout(MAX_POLL_SECS),
+                          map=self._map, count=1)
+            if self.timers.runDue() and self._batchIO:
+                self._batchIO.flush()
+
+    def close(self):
+        self._running = False
+        self._socket.close()
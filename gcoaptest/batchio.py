@@ -0,0 +1,274 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Batched datagram I/O for a transport engine. Drains a socket with one
+recvmmsg() call into a preallocated ring of buffers, and flushes queued
+datagrams with one sendmmsg() call. Python's socket module does not expose
+these calls, so they are reached through ctypes. Where they are not available,
+like off Linux, falls back to a recvfrom_into()/sendto() call per datagram,
+which still saves the per-datagram buffer allocation and loop wakeup.
+
+Only for an AF_INET6 datagram socket.
+'''
+import ctypes
+import ctypes.util
+import errno
+import logging
+import socket
+import struct
+import sys
+
+log = logging.getLogger(__name__)
+
+_MSG_DONTWAIT     = 0x40
+_SOCKADDR_IN6_LEN = 28
+# Most addresses to remember the encoded sockaddr for
+_MAX_SOCKADDRS    = 4096
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len',  ctypes.c_size_t)]
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name',       ctypes.c_void_p),
+                ('msg_namelen',    ctypes.c_uint32),
+                ('msg_iov',        ctypes.POINTER(_IoVec)),
+                ('msg_iovlen',     ctypes.c_size_t),
+                ('msg_control',    ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags',      ctypes.c_int)]
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr),
+                ('msg_len', ctypes.c_uint)]
+
+def _loadLibc():
+    '''Returns libc if it provides recvmmsg and sendmmsg, otherwise None.'''
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.recvmmsg, libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_libc = _loadLibc()
+
+# Offsets for reading and writing the headers through a flat memoryview
+_MMSG_SIZE       = ctypes.sizeof(_MMsgHdr)
+_MSG_LEN_OFFSET  = _MMsgHdr.msg_len.offset
+_IOVEC_SIZE      = ctypes.sizeof(_IoVec)
+_IOV_LEN_OFFSET  = _IoVec.iov_len.offset
+_UINT    = struct.Struct('=I')
+_SIZE_T  = struct.Struct('N')
+
+
+class BatchSocketIO(object):
+    '''Batched receive and send for a datagram socket.
+
+    The mmsg path keeps its per-datagram work in Python small: the kernel
+    writes into fixed ring slots described by preallocated headers, lengths
+    are read with struct from a flat view of the headers, and a source
+    sockaddr is converted to an address tuple once and then looked up.
+
+    Attributes:
+        :batchSize:  int Most datagrams per receive or send call
+        :mmsg:       boolean True if using recvmmsg/sendmmsg
+        :_ring:      bytearray Receive buffers, batchSize slots of bufSize
+        :_views:     list of memoryview, one per ring slot
+        :_sendRing:  bytearray Send buffers for the mmsg path, like _ring
+        :_sendQueue: list of (bytes, address) waiting for flush()
+        :_addresses: dict of raw sockaddr bytes to address tuple
+        :_sockaddrs: dict of address tuple to packed sockaddr_in6 bytes
+    '''
+    def __init__(self, sock, batchSize=32, bufSize=1152, useMmsg=True):
+        self._sock      = sock
+        self._fd        = sock.fileno()
+        self.batchSize  = batchSize
+        self._bufSize   = bufSize
+        self._ring      = bytearray(batchSize * bufSize)
+        ringView        = memoryview(self._ring)
+        self._views     = [ringView[i*bufSize:(i+1)*bufSize] for i in range(batchSize)]
+        self._sendQueue = []
+        self._addresses = {}
+        self._sockaddrs = {}
+        self.mmsg       = bool(useMmsg and _libc)
+        if self.mmsg:
+            self._initMmsg()
+
+    def _initMmsg(self):
+        '''Preallocates the message headers for recvmmsg and sendmmsg, each
+        over a ring of buffers.
+        '''
+        n = self.batchSize
+        self._sendRing  = bytearray(n * self._bufSize)
+        self._recvNames = ctypes.create_string_buffer(n * _SOCKADDR_IN6_LEN)
+        self._sendNames = ctypes.create_string_buffer(n * _SOCKADDR_IN6_LEN)
+        self._recvMsgs, self._recvRingBuf = self._buildHeaders(self._ring)
+        self._sendMsgs, self._sendRingBuf = self._buildHeaders(self._sendRing)
+
+        # each slot has its own sockaddr, so a batch never refers to memory
+        # the address cache may free
+        for msgs, names in ((self._recvMsgs, self._recvNames),
+                            (self._sendMsgs, self._sendNames)):
+            nameAddr = ctypes.addressof(names)
+            for i in range(n):
+                hdr             = msgs[i].msg_hdr
+                hdr.msg_name    = nameAddr + i * _SOCKADDR_IN6_LEN
+                hdr.msg_namelen = _SOCKADDR_IN6_LEN
+
+        self._recvMsgsView = memoryview(self._recvMsgs).cast('B')
+        self._sendIovView  = memoryview(self._sendIov).cast('B')
+        self._namesView    = memoryview(self._recvNames).cast('B')
+        self._sendNamesView = memoryview(self._sendNames).cast('B')
+
+    def _buildHeaders(self, ring):
+        '''Returns an array of message headers with one iovec for each slot in
+        the ring buffer, and the ctypes buffer that keeps the ring exported.
+        '''
+        n       = self.batchSize
+        ringBuf = (ctypes.c_char * len(ring)).from_buffer(ring)
+        iovs    = (_IoVec * n)()
+        msgs    = (_MMsgHdr * n)()
+        for i in range(n):
+            iovs[i].iov_base = ctypes.addressof(ringBuf) + i * self._bufSize
+            iovs[i].iov_len  = self._bufSize
+            msgs[i].msg_hdr.msg_iov    = ctypes.pointer(iovs[i])
+            msgs[i].msg_hdr.msg_iovlen = 1
+        if ring is self._ring:
+            self._recvIov = iovs
+        else:
+            self._sendIov = iovs
+        return msgs, ringBuf
+
+    def receive(self):
+        '''Reads the datagrams waiting on the socket, up to batchSize.
+
+        :return: list of (memoryview, address); a view is valid only until the
+                 next call
+        '''
+        if self.mmsg:
+            return self._receiveMmsg()
+
+        datagrams = []
+        for view in self._views:
+            try:
+                length, address = self._sock.recvfrom_into(view)
+            except (BlockingIOError, InterruptedError):
+                break
+            datagrams.append((view[:length], address))
+        return datagrams
+
+    def _receiveMmsg(self):
+        count = _libc.recvmmsg(self._fd, self._recvMsgs, self.batchSize,
+                               _MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                raise OSError(err, 'recvmmsg failed')
+            return []
+
+        msgs      = self._recvMsgsView
+        names     = self._namesView
+        addresses = self._addresses
+        views     = self._views
+        datagrams = []
+        for i in range(count):
+            length, = _UINT.unpack_from(msgs, i * _MMSG_SIZE + _MSG_LEN_OFFSET)
+            name    = names[i*_SOCKADDR_IN6_LEN:(i+1)*_SOCKADDR_IN6_LEN].tobytes()
+            address = addresses.get(name)
+            if address is None:
+                if len(addresses) >= _MAX_SOCKADDRS:
+                    addresses.clear()
+                address = addresses[name] = _parseSockaddr(name)
+            datagrams.append((views[i][:length], address))
+        return datagrams
+
+    def queue(self, data, address):
+        '''Queues a datagram for the next flush().
+
+        :return: True if the datagram is the first in the queue
+        '''
+        self._sendQueue.append((data, address))
+        return len(self._sendQueue) == 1
+
+    def flush(self):
+        '''Sends all queued datagrams.'''
+        queue = self._sendQueue
+        if not queue:
+            return
+        self._sendQueue = []
+        if self.mmsg:
+            for start in range(0, len(queue), self.batchSize):
+                self._sendMmsg(queue[start:start+self.batchSize])
+        else:
+            for data, address in queue:
+                self._sendOne(data, address)
+
+    def _sendMmsg(self, batch):
+        '''Copies a batch into the send ring, and sends it.'''
+        ring    = self._sendRing
+        names   = self._sendNamesView
+        iovs    = self._sendIovView
+        bufSize = self._bufSize
+        for i, (data, address) in enumerate(batch):
+            length = len(data)
+            if length > bufSize:
+                # too big for a ring slot; send this batch so far on its own
+                self._sendMmsgCount(i, batch)
+                self._sendOne(data, address)
+                return self._sendMmsg(batch[i+1:])
+            ring[i*bufSize:i*bufSize+length] = data
+            _SIZE_T.pack_into(iovs, i * _IOVEC_SIZE + _IOV_LEN_OFFSET, length)
+            names[i*_SOCKADDR_IN6_LEN:(i+1)*_SOCKADDR_IN6_LEN] = self._sockaddr(address)
+        self._sendMmsgCount(len(batch), batch)
+
+    def _sendMmsgCount(self, count, batch):
+        sent = 0
+        while sent < count:
+            result = _libc.sendmmsg(self._fd, ctypes.byref(self._sendMsgs,
+                                    sent * _MMSG_SIZE), count - sent, 0)
+            if result <= 0:
+                # report the error, like sendto, for the first unsent datagram
+                data, address = batch[sent]
+                self._sendOne(data, address)
+                result = 1
+            sent += result
+
+    def _sendOne(self, data, address):
+        try:
+            self._sock.sendto(data, address)
+        except socket.error as e:
+            log.debug('sendto %s failed: %s', address, e)
+
+    def _sockaddr(self, address):
+        '''Returns a packed sockaddr_in6 for an address tuple.'''
+        name = self._sockaddrs.get(address)
+        if name is None:
+            if len(self._sockaddrs) >= _MAX_SOCKADDRS:
+                self._sockaddrs.clear()
+            if len(address) == 4:
+                host, port, flowinfo, scopeId = address
+            else:
+                # resolves an interface qualified host, like 'fe80::1%tap0'
+                host, port, flowinfo, scopeId = socket.getaddrinfo(address[0],
+                        address[1], socket.AF_INET6, socket.SOCK_DGRAM)[0][4]
+            packed = (struct.pack('=H', socket.AF_INET6)
+                      + struct.pack('!HI', port, flowinfo)
+                      + socket.inet_pton(socket.AF_INET6, host.split('%')[0])
+                      + struct.pack('=I', scopeId))
+            name = self._sockaddrs[address] = packed
+        return name
+
+
+def _parseSockaddr(name):
+    '''Returns the address tuple for a sockaddr_in6, like recvfrom().'''
+    port, flowinfo = struct.unpack_from('!HI', name, 2)
+    scopeId,       = struct.unpack_from('=I', name, 24)
+    host = socket.inet_ntop(socket.AF_INET6, name[8:24])
+    return (host, port, flowinfo, scopeId)
@@ -0,0 +1,398 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Minimal CoAP message codec, used by the gcoaptest transport engines so they
+own the datagram socket and may send a response at a time of their choosing.
+
+Attribute and option names follow soscoap's CoapMessage, so message handlers
+written for soscoap read the same here.
+'''
+import ipaddress
+import struct
+from   soscoap  import CodeClass
+from   soscoap  import MessageType
+from   soscoap  import OptionType
+
+COAP_VERSION = 1
+
+# Option numbers not defined by soscoap.OptionType
+OPTION_CONTENT_FORMAT = 12
+OPTION_MAX_AGE        = 14
+OPTION_URI_QUERY      = 15
+OPTION_BLOCK2         = 23
+OPTION_SIZE2          = 28
+
+# Response codes, as (class, detail)
+CODE_CHANGED               = (2, 4)
+CODE_CONTENT               = (2, 5)
+CODE_BAD_REQUEST           = (4, 0)
+CODE_BAD_OPTION            = (4, 2)
+CODE_NOT_FOUND             = (4, 4)
+CODE_METHOD_NOT_ALLOWED    = (4, 5)
+CODE_INTERNAL_SERVER_ERROR = (5, 0)
+CODE_SERVICE_UNAVAILABLE   = (5, 3)
+
+MEDIA_TEXT_PLAIN = 0
+
+# Options with string and unsigned integer values; others are opaque bytes.
+_STRING_OPTIONS = frozenset([OptionType.UriPath, OPTION_URI_QUERY])
+_UINT_OPTIONS   = frozenset([OptionType.Observe, OPTION_CONTENT_FORMAT,
+                             OPTION_MAX_AGE, OPTION_BLOCK2, OPTION_SIZE2])
+
+_HEADER = struct.Struct('!BBH')
+
+
+class MessageFormatError(Exception):
+    '''Datagram is not a well-formed CoAP message.'''
+    pass
+
+
+class Option(object):
+    '''A CoAP option.
+
+    Attributes:
+        :type:  int Option number
+        :value: Decoded value -- str, int, or bytes depending on the option
+    '''
+    __slots__ = ('type', 'value')
+
+    def __init__(self, optionType, value):
+        self.type  = optionType
+        self.value = value
+
+    def encodeValue(self):
+        '''Returns the option value as bytes for the wire.'''
+        if isinstance(self.value, int):
+            if self.value == 0:
+                return b''
+            length = (self.value.bit_length() + 7) // 8
+            return bytes(bytearray((self.value >> (8*i)) & 0xFF
+                                   for i in reversed(range(length))))
+        elif isinstance(self.value, str):
+            return self.value.encode('utf-8')
+        return bytes(self.value)
+
+
+class Message(object):
+    '''A CoAP message.
+
+    Attributes:
+        :address:     tuple Source address for a received message, or
+                            destination for a message to send
+        :messageType: int soscoap.MessageType
+        :codeClass:   int
+        :codeDetail:  int
+        :messageId:   int
+        :token:       bytes
+        :options:     list of Option, in the order added or received
+        :payload:     bytes
+    '''
+    def __init__(self, address=None):
+        self.address     = address
+        self.messageType = MessageType.NON
+        self.codeClass   = CodeClass.Empty
+        self.codeDetail  = 0
+        self.messageId   = 0
+        self.token       = b''
+        self.options     = []
+        self.payload     = b''
+
+    @property
+    def tokenLength(self):
+        return len(self.token)
+
+    def addOption(self, option):
+        self.options.append(option)
+
+    def findOption(self, optionType):
+        '''Returns a list of the options of the provided type; may be empty.'''
+        return [opt for opt in self.options if opt.type == optionType]
+
+    def pathSegments(self):
+        '''Returns a tuple of the Uri-Path option values.'''
+        return tuple(opt.value for opt in self.options
+                               if opt.type == OptionType.UriPath)
+
+    def encode(self):
+        '''Returns the message as bytes for the wire.'''
+        return encodeHeader(self.messageType, self.codeClass, self.codeDetail,
+                            self.messageId, self.token) \
+               + encodeOptions(self.options) \
+               + (b'\xFF' + bytes(self.payload) if self.payload else b'')
+
+
+def encodeHeader(messageType, codeClass, codeDetail, messageId, token):
+    '''Returns the fixed header and token for a message.'''
+    return _HEADER.pack((COAP_VERSION << 6) | (messageType << 4) | len(token),
+                        (codeClass << 5) | codeDetail,
+                        messageId) + bytes(token)
+
+def _encodeExtended(value):
+    '''Returns the nibble and extended bytes for an option delta or length.'''
+    if value < 13:
+        return value, b''
+    elif value < 269:
+        return 13, struct.pack('!B', value - 13)
+    return 14, struct.pack('!H', value - 269)
+
+def encodeOptions(options):
+    '''Returns the wire encoding for a list of Option, sorted by number.'''
+    parts   = []
+    lastNum = 0
+    # sort is stable, so repeated options keep their order
+    for opt in sorted(options, key=lambda o: o.type):
+        value = opt.encodeValue()
+        deltaNibble,  deltaExt  = _encodeExtended(opt.type - lastNum)
+        lengthNibble, lengthExt = _encodeExtended(len(value))
+        parts.append(struct.pack('!B', (deltaNibble << 4) | lengthNibble))
+        parts.append(deltaExt)
+        parts.append(lengthExt)
+        parts.append(value)
+        lastNum = opt.type
+    return b''.join(parts)
+
+def encodeBlock(num, more, szx):
+    '''Returns the value for a Block2 option, from RFC 7959, sec. 2.2.
+
+    :param num: int Block number
+    :param more: boolean True if more blocks follow
+    :param szx: int Block size exponent; size is 2**(szx + 4)
+    '''
+    return (num << 4) | (0x08 if more else 0) | szx
+
+def decodeBlock(value):
+    '''Returns (num, more, szx) from a Block2 option value.'''
+    return value >> 4, bool(value & 0x08), value & 0x07
+
+def _decodeExtended(nibble, data, pos):
+    if nibble < 13:
+        return nibble, pos
+    elif nibble == 13:
+        return data[pos] + 13, pos + 1
+    elif nibble == 14:
+        return ((data[pos] << 8) | data[pos+1]) + 269, pos + 2
+    raise MessageFormatError('Reserved option nibble')
+
+def decodeOptionValue(optionType, raw):
+    '''Converts raw option bytes to the value type for the option.
+
+    :raises MessageFormatError: If a string option is not UTF-8
+    '''
+    if optionType in _STRING_OPTIONS:
+        try:
+            return bytes(raw).decode('utf-8')
+        except UnicodeDecodeError:
+            raise MessageFormatError('Option {0} not UTF-8'.format(optionType))
+    elif optionType in _UINT_OPTIONS:
+        value = 0
+        for b in bytearray(raw):
+            value = (value << 8) | b
+        return value
+    return bytes(raw)
+
+def decode(data, address=None):
+    '''Builds a Message from a received datagram.
+
+    :param data: bytes-like Datagram contents
+    :param address: tuple Source address
+    :raises MessageFormatError: If datagram is not a valid CoAP message
+    '''
+    data = bytearray(data)
+    if len(data) < 4:
+        raise MessageFormatError('Datagram shorter than header')
+    first, code, messageId = _HEADER.unpack_from(bytes(data[:4]))
+    if first >> 6 != COAP_VERSION:
+        raise MessageFormatError('Unknown version')
+    tokenLength = first & 0x0F
+    if tokenLength > 8 or len(data) < 4 + tokenLength:
+        raise MessageFormatError('Bad token length')
+
+    msg             = Message(address)
+    msg.messageType = (first >> 4) & 0x03
+    msg.codeClass   = code >> 5
+    msg.codeDetail  = code & 0x1F
+    msg.messageId   = messageId
+    msg.token       = bytes(data[4:4+tokenLength])
+
+    pos    = 4 + tokenLength
+    number = 0
+    try:
+        while pos < len(data):
+            if data[pos] == 0xFF:
+                msg.payload = bytes(data[pos+1:])
+                break
+            delta  = data[pos] >> 4
+            length = data[pos] & 0x0F
+            delta,  pos = _decodeExtended(delta,  data, pos+1)
+            length, pos = _decodeExtended(length, data, pos)
+            number += delta
+            msg.options.append(Option(number, decodeOptionValue(number,
+                                                    data[pos:pos+length])))
+            pos += length
+    except IndexError:
+        raise MessageFormatError('Truncated option')
+    return msg
+
+
+# Most hosts to remember in normalizeHost()
+_MAX_HOSTS = 1024
+_hosts     = {}
+
+def normalizeHost(host):
+    '''Returns a host address in one form for comparison, so a host matches
+    however the socket or the user wrote it. Removes an IPv6 scope, like
+    '%tap0', which only some receive paths include, and compresses the
+    address. An IPv4-mapped address becomes the IPv4 address. A name that is
+    not an address is returned without its scope.
+    '''
+    normal = _hosts.get(host)
+    if normal is None:
+        bare = host.partition('%')[0]
+        try:
+            address = ipaddress.ip_address(bare)
+        except ValueError:
+            normal = bare
+        else:
+            mapped = getattr(address, 'ipv4_mapped', None)
+            normal = str(mapped or address)
+        if len(_hosts) >= _MAX_HOSTS:
+            _hosts.clear()
+        _hosts[host] = normal
+    return normal
+
+
+class HeaderView(object):
+    '''Read-only view of a received message, over a memoryview of the datagram.
+    Reads header fields on access, and decodes only the options asked for, so
+    handling a message allocates little beyond the view itself. Provides the
+    read interface of Message.
+
+    The view does not copy the datagram. If the buffer may be reused, like a
+    BatchSocketIO ring slot, copy the fields needed before the handler returns.
+    '''
+    __slots__ = ('address', '_buf', '_tokenEnd')
+
+    def __init__(self, data, address=None):
+        '''
+        :param data: bytes-like Datagram contents
+        :param address: tuple Source address
+        :raises MessageFormatError: If the header is not valid
+        '''
+        buf = memoryview(data)
+        if len(buf) < 4:
+            raise MessageFormatError('Datagram shorter than header')
+        if buf[0] >> 6 != COAP_VERSION:
+            raise MessageFormatError('Unknown version')
+        tokenEnd = 4 + (buf[0] & 0x0F)
+        if tokenEnd > 12 or len(buf) < tokenEnd:
+            raise MessageFormatError('Bad token length')
+        self._buf      = buf
+        self._tokenEnd = tokenEnd
+        self.address   = address
+
+    @property
+    def messageType(self):
+        return (self._buf[0] >> 4) & 0x03
+
+    @property
+    def codeClass(self):
+        return self._buf[1] >> 5
+
+    @property
+    def codeDetail(self):
+        return self._buf[1] & 0x1F
+
+    @property
+    def messageId(self):
+        return (self._buf[2] << 8) | self._buf[3]
+
+    @property
+    def tokenLength(self):
+        return self._tokenEnd - 4
+
+    @property
+    def token(self):
+        return self._buf[4:self._tokenEnd].tobytes()
+
+    def _scanOptions(self):
+        '''Generates (option number, value start, value end) for each option,
+        and finally (None, payload start, end of buffer).
+        '''
+        buf    = self._buf
+        end    = len(buf)
+        pos    = self._tokenEnd
+        number = 0
+        try:
+            while pos < end:
+                if buf[pos] == 0xFF:
+                    yield None, pos + 1, end
+                    return
+                delta,  after = _decodeExtended(buf[pos] >> 4,   buf, pos+1)
+                length, pos   = _decodeExtended(buf[pos] & 0x0F, buf, after)
+                number += delta
+                yield number, pos, pos + length
+                pos += length
+        except IndexError:
+            raise MessageFormatError('Truncated option')
+        yield None, end, end
+
+    def findOption(self, optionType):
+        '''Returns a list of the options of the provided type; may be empty.'''
+        found = []
+        for number, start, end in self._scanOptions():
+            if number is None or number > optionType:
+                break
+            if number == optionType:
+                found.append(Option(number, decodeOptionValue(number,
+                                                    self._buf[start:end])))
+        return found
+
+    @property
+    def options(self):
+        return [Option(number, decodeOptionValue(number, self._buf[start:end]))
+                for number, start, end in self._scanOptions() if number is not None]
+
+    @property
+    def payload(self):
+        for number, start, end in self._scanOptions():
+            if number is None:
+                return self._buf[start:end].tobytes()
+
+
+class ResourceTransfer(object):
+    '''Carries a resource between a transport engine and its request handlers,
+    like soscoap's SosResourceTransfer.
+
+    Attributes:
+        :path:      string Resource path, like '/ver'
+        :segments:  tuple Uri-Path segments, like ('ver',)
+        :method:    int soscoap.RequestCode for the request
+        :pathQuery: string Uri-Query value, or None
+        :type:      string Value type for a response: 'string', or 'bytes'
+                    for a bytes-like value, like a memoryview slice
+        :value:     Value received for a PUT/POST, or to send for a GET
+        :delay:     float Seconds to wait before sending the response; set by
+                    the handler
+        :options:   list of Option to add to the response, like Observe, or
+                    None; set by the handler
+        :request:   Message Request, for a handler that needs more than the
+                    path and query, like the token and source address
+    '''
+    def __init__(self, segments, method=None, pathQuery=None, value=None,
+                 request=None):
+        self.segments  = segments
+        self.method    = method
+        self.pathQuery = pathQuery
+        self.type      = None
+        self.value     = value
+        self.delay     = 0
+        self.options   = None
+        self.request   = request
+
+    @property
+    def path(self):
+        '''Builds the path string on demand; dispatch uses segments.'''
+        return '/' + '/'.join(self.segments)
@@ -0,0 +1,490 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Transport engines for gcoaptest. Replaces soscoap's CoapServer and CoapClient,
+with the same register-for-GET/PUT/POST interface, but sends the response
+itself. A handler may set a delay on the resource, and the engine schedules
+the response on its timers, serviced from the networking loop, so a delayed
+response does not block other requests.
+
+Backends:
+    | asyncore -- AsyncoreEngine; not available from Python 3.12
+    | asyncio  -- AsyncioEngine, on the standard event loop
+    | uvloop   -- AsyncioEngine, on a uvloop event loop; requires uvloop
+'''
+import logging
+import random
+import socket
+import time
+from   soscoap  import CodeClass
+from   soscoap  import MessageType
+from   soscoap  import OptionType
+from   soscoap  import RequestCode
+from   gcoaptest import coap
+from   gcoaptest.coap  import ResourceTransfer
+from   gcoaptest.metrics import OTHER_PATH
+from   gcoaptest.timer import TimerQueue
+
+try:
+    import asyncore
+    DEFAULT_BACKEND = 'asyncore'
+except ImportError:
+    DEFAULT_BACKEND = 'asyncio'
+
+BACKENDS = ('asyncore', 'asyncio', 'uvloop')
+
+log = logging.getLogger(__name__)
+
+# Large enough for any datagram we expect from a gcoap client
+RECV_BUFSIZE = 1152
+
+
+# Content-Format option for a text/plain payload. Encoded, for a response where
+# it is the only option.
+_TEXT_PLAIN        = coap.Option(coap.OPTION_CONTENT_FORMAT, coap.MEDIA_TEXT_PLAIN)
+_TEXT_PLAIN_OPTION = coap.encodeOptions([_TEXT_PLAIN])
+
+# Largest block size exponent for a Block2 response; 2**(6+4) is 1024 bytes.
+# A body longer than this block size is sent blockwise.
+MAX_BLOCK_SZX  = 6
+MAX_BLOCK_SIZE = 1 << (MAX_BLOCK_SZX + 4)
+
+# Request options that make a GET response differ from the cached one
+_UNCACHEABLE_OPTIONS = frozenset((coap.OPTION_BLOCK2, OptionType.Observe))
+
+# Response code for a successful request, by request method
+_SUCCESS_CODES = {RequestCode.GET:  coap.CODE_CONTENT,
+                  RequestCode.PUT:  coap.CODE_CHANGED,
+                  RequestCode.POST: coap.CODE_CHANGED}
+
+
+class IgnoreRequestException(Exception):
+    '''Raised by a request handler to send no response.'''
+    pass
+
+
+class BadRequestException(Exception):
+    '''Raised by a request handler to respond 4.00 Bad Request, like for a
+    malformed query.
+    '''
+    pass
+
+
+class CoapEndpoint(object):
+    '''CoAP request/response logic for a transport engine. A subclass provides
+    the socket and networking loop, and passes each received datagram to
+    _receive().
+
+    Request dispatch first looks up the resource registry, keyed by the tuple
+    of Uri-Path segments. If the path is not registered, the request goes to
+    any handlers registered for all resources with the request method. If
+    there are none, the engine responds 4.04 after running the not found
+    handlers, which may set a delay on the resource.
+
+    A GET response for a resource registered as static is cached, as the
+    encoded bytes following the header and token, along with its delay. A hit
+    skips the handler and only encodes the header and token. Any successful
+    PUT or POST to a registered resource is taken as a configuration change,
+    and clears the cache.
+
+    A GET response body is sent blockwise, with the Block2 option from
+    RFC 7959, if the request includes Block2, or if the body is longer than
+    MAX_BLOCK_SIZE. The engine slices each block from the handler's value, so
+    a handler may provide a large body as a memoryview without copying it.
+    Blockwise responses are not cached.
+
+    If metrics is set, the engine counts requests and responses, and times
+    the handlers. Otherwise the only cost is a test for None.
+
+    If exchanges is set, it deduplicates requests ahead of the handlers, and
+    may acknowledge a CON request once the response is decided, ahead of any
+    delay, and send the response separately.
+    A request ignored by a handler is forgotten, as if lost, so its
+    retransmission is handled again.
+
+    If faults is set, it may drop a request on receipt, ahead of the
+    exchanges, and may delay, duplicate, or reorder the response.
+
+    If pacer is set, it admits a request after the exchanges, and may queue
+    it, to dispatch() later, or respond 5.03 at once.
+
+    Attributes:
+        :timers: TimerQueue Deferred work, serviced by the networking loop
+        :requestCount: int Requests received
+        :pendingResponses: int Delayed responses waiting on the timers
+        :metrics: metrics.EngineMetrics to update, or None
+        :exchanges: exchange.ExchangeLayer for the message layer, or None
+        :faults: faults.FaultInjector to impair requests and responses, or None
+        :pacer: pacing.Pacer to limit the request rate, or None
+        :cacheVersion: Optional function that returns a configuration version;
+                       a change in the version clears the response cache.
+                       Useful when another process may change configuration.
+        :cacheFilter: Optional function of a request; False bypasses the
+                      response cache, for both lookup and store. Useful when
+                      a client has its own configuration.
+        :_resources: dict of path segments tuple to a dict of request method
+                     to handler
+        :_methodHandlers: dict of request method to list of handlers for any
+                          resource not in _resources
+        :_notFoundHandlers: list of handlers for a request for an unknown
+                            resource
+        :_static: set of path segments tuples for static resources
+        :_responseCache: dict of path segments tuple to (code, encoded
+                         options and payload, delay) for a static resource
+        :_cachedVersion: Value from cacheVersion when cache last cleared
+        :_responseHandlers: list of handlers for a received response
+        :_emptyHandlers: list of handlers for a received empty ACK or RST
+        :_nextMessageId: int Message ID for the next NON response
+    '''
+    def __init__(self, timers=None):
+        self.timers = timers if timers else TimerQueue()
+        self.requestCount = 0
+        self.pendingResponses = 0
+        self.metrics      = None
+        self.exchanges    = None
+        self.faults       = None
+        self.pacer        = None
+        self.cacheVersion = None
+        self.cacheFilter  = None
+        self._resources        = {}
+        self._methodHandlers   = {RequestCode.GET: [], RequestCode.PUT: [],
+                                  RequestCode.POST: []}
+        self._notFoundHandlers = []
+        self._static           = set()
+        self._responseCache    = {}
+        self._cachedVersion    = None
+        self._responseHandlers = []
+        self._emptyHandlers    = []
+        self._nextMessageId    = random.randint(0, 65535)
+
+    def registerResource(self, path, handler, methods=(RequestCode.GET,),
+                         static=False):
+        '''Registers a handler for requests to a resource.
+
+        :param path: string Resource path, like '/cf/delay'
+        :param handler: Function that accepts a ResourceTransfer
+        :param methods: Iterable of RequestCode the handler accepts
+        :param static: boolean If True, the GET response does not change until
+                       a configuration change, so it may be cached
+        '''
+        segments = tuple(path.strip('/').split('/'))
+        handlers = self._resources.setdefault(segments, {})
+        for method in methods:
+            handlers[method] = handler
+        if static:
+            self._static.add(segments)
+        else:
+            self._static.discard(segments)
+        self.invalidateCache()
+
+    def invalidateCache(self):
+        '''Clears cached responses for static resources.'''
+        self._responseCache.clear()
+
+    def registerForResourceGet(self, handler):
+        self._methodHandlers[RequestCode.GET].append(handler)
+
+    def registerForResourcePut(self, handler):
+        self._methodHandlers[RequestCode.PUT].append(handler)
+
+    def registerForResourcePost(self, handler):
+        self._methodHandlers[RequestCode.POST].append(handler)
+
+    def registerForNotFound(self, handler):
+        self._notFoundHandlers.append(handler)
+
+    def registerForResponse(self, handler):
+        self._responseHandlers.append(handler)
+
+    def registerForEmpty(self, handler):
+        '''Registers a handler for an empty ACK or RST, like the reply to a
+        notification; the handler accepts the coap.Message.
+        '''
+        self._emptyHandlers.append(handler)
+
+    def send(self, message):
+        '''Sends a coap.Message to message.address.'''
+        self._sendBytes(message.encode(), message.address)
+
+    def sendBytes(self, data, address):
+        '''Sends an already encoded message.'''
+        self._sendBytes(data, address)
+
+    def _sendBytes(self, data, address):
+        raise NotImplementedError
+
+    def start(self):
+        '''Runs the networking loop until closed.'''
+        raise NotImplementedError
+
+    def close(self):
+        '''Releases the socket.'''
+        raise NotImplementedError
+
+    def _receive(self, data, address):
+        '''Handles a received datagram. A response is passed to the response
+        handlers as a coap.HeaderView, which decodes fields only on demand;
+        other messages are fully decoded.
+        '''
+        try:
+            if len(data) > 1 and data[1] >> 5 != CodeClass.Request:
+                message = coap.HeaderView(data, address)
+                for handler in self._responseHandlers:
+                    handler(message)
+                return
+            message = coap.decode(data, address)
+        except coap.MessageFormatError as e:
+            log.debug('Discarding datagram from %s: %s', address, e)
+            return
+
+        if message.codeDetail:
+            self._handleRequest(message)
+        elif message.messageType in (MessageType.ACK, MessageType.RST):
+            if self.exchanges:
+                self.exchanges.emptyReceived(message)
+            for handler in self._emptyHandlers:
+                handler(message)
+        elif message.messageType == MessageType.CON:
+            # CoAP ping
+            self._sendBytes(coap.encodeHeader(MessageType.RST, 0, 0,
+                                              message.messageId, b''),
+                            message.address)
+
+    def _handleRequest(self, request):
+        '''Passes a request through the faults, exchanges, and pacer stages,
+        and dispatches it if admitted.
+        '''
+        if self.faults and not self.faults.admit(request):
+            return
+        if self.exchanges and self.exchanges.isDuplicate(request):
+            return
+        if self.pacer and not self.pacer.admit(request):
+            return
+        self.dispatch(request)
+
+    def dispatch(self, request):
+        '''Runs the handlers for an admitted request, and sends or schedules
+        the response.
+        '''
+        exchanges = self.exchanges
+        self.requestCount += 1
+        method   = request.codeDetail
+        segments = request.pathSegments()
+        metrics  = self.metrics
+        if metrics:
+            metrics.requests[(segments if segments in self._resources else OTHER_PATH,
+                              method)] += 1
+        # a block or an observation needs options the cached response lacks
+        cacheable = (method == RequestCode.GET
+                     and not any(opt.type in _UNCACHEABLE_OPTIONS
+                                 for opt in request.options)
+                     and (not self.cacheFilter or self.cacheFilter(request)))
+        if cacheable:
+            if self.cacheVersion:
+                version = self.cacheVersion()
+                if version != self._cachedVersion:
+                    self._responseCache.clear()
+                    self._cachedVersion = version
+            cached = self._responseCache.get(segments)
+            if cached:
+                self._scheduleResponse(request, *cached)
+                return
+
+        query    = request.findOption(coap.OPTION_URI_QUERY)
+        resource = ResourceTransfer(segments, method=method,
+                                    pathQuery=query[0].value if query else None,
+                                    request=request)
+        code     = _SUCCESS_CODES.get(method, coap.CODE_METHOD_NOT_ALLOWED)
+
+
+        byMethod = self._resources.get(resource.segments)
+        if byMethod is not None:
+            handler  = byMethod.get(method)
+            handlers = (handler,) if handler else ()
+            if not handler:
+                code = coap.CODE_METHOD_NOT_ALLOWED
+        else:
+            handlers = self._methodHandlers.get(method, ())
+            if not handlers:
+                handlers = self._notFoundHandlers
+                code     = coap.CODE_NOT_FOUND
+        started = time.time() if metrics else 0
+        ignored = False
+        try:
+            if method != RequestCode.GET:
+                resource.value = request.payload.decode('utf-8')
+            for handler in handlers:
+                handler(resource)
+        except UnicodeDecodeError:
+            log.info('Payload not UTF-8 for %s', resource.path)
+            code = coap.CODE_BAD_REQUEST
+        except BadRequestException as e:
+            log.info('Bad request for %s: %s', resource.path, e)
+            code = coap.CODE_BAD_REQUEST
+        except IgnoreRequestException:
+            log.info('Ignoring request for %s', resource.path)
+            ignored = True
+        except NotImplementedError:
+            code = coap.CODE_NOT_FOUND
+        except Exception:
+            log.exception('Handler failed for %s', resource.path)
+            code = coap.CODE_INTERNAL_SERVER_ERROR
+        if metrics:
+            metrics.handlerTime.record((time.time() - started) * 1000000)
+            if ignored:
+                metrics.ignored[segments if byMethod is not None else OTHER_PATH] += 1
+        if ignored:
+            if exchanges:
+                exchanges.forget(request)
+            return
+
+        tail = b''
+        if code == coap.CODE_CONTENT and resource.type in ('string', 'bytes'):
+            body  = (resource.value.encode('utf-8') if resource.type == 'string'
+                     else resource.value)
+            block = request.findOption(coap.OPTION_BLOCK2)
+            if block or len(body) > MAX_BLOCK_SIZE:
+                code, tail = _blockTail(body, block[0].value if block else None,
+                                        resource.options)
+            elif resource.options:
+                tail = (coap.encodeOptions(resource.options + [_TEXT_PLAIN])
+                        + b'\xFF' + body)
+            else:
+                tail = _TEXT_PLAIN_OPTION + b'\xFF' + body
+                if cacheable and segments in self._static:
+                    self._responseCache[segments] = (code, tail, resource.delay)
+        elif code == coap.CODE_CHANGED and byMethod:
+            self.invalidateCache()
+
+        self._scheduleResponse(request, code, tail, resource.delay)
+
+    def respond(self, request, code, tail=b''):
+        '''Sends a response without running the handlers, like a 5.03 from
+        the pacer.
+
+        :param tail: bytes Encoded options and payload
+        '''
+        self._scheduleResponse(request, code, tail, 0)
+
+    def _scheduleResponse(self, request, code, tail, delay):
+        exchanges = self.exchanges
+        if exchanges and exchanges.separate and request.messageType == MessageType.CON:
+            exchanges.acknowledge(request)
+        metrics = self.metrics
+        if metrics:
+            metrics.responses[code] += 1
+        if delay > 0:
+            if metrics:
+                metrics.delayed      += 1
+                metrics.delaySeconds += delay
+            self.pendingResponses += 1
+            self.timers.schedule(delay, self._sendDelayedResponse, request, code, tail)
+        else:
+            self._sendResponse(request, code, tail)
+
+    def _sendDelayedResponse(self, request, code, tail):
+        self.pendingResponses -= 1
+        self._sendResponse(request, code, tail)
+
+    def _sendResponse(self, request, code, tail):
+        '''Sends a response to a request; piggybacked for a CON request,
+        unless the exchange layer sends it separately.
+
+        :param tail: bytes Encoded options and payload
+        '''
+        exchanges = self.exchanges
+        if request.messageType == MessageType.CON:
+            if exchanges and exchanges.takeAcknowledged(request):
+                exchanges.sendSeparate(request, code, tail)
+                return
+            data = coap.encodeHeader(MessageType.ACK, code[0], code[1],
+                                     request.messageId, request.token) + tail
+            if exchanges:
+                exchanges.replied(request, data)
+        else:
+            data = coap.encodeHeader(MessageType.NON, code[0], code[1],
+                                     self._newMessageId(), request.token) + tail
+        if self.faults:
+            self.faults.send(request, data)
+        else:
+            self._sendBytes(data, request.address)
+
+
+    def _newMessageId(self):
+        self._nextMessageId = (self._nextMessageId + 1) & 0xFFFF
+        return self._nextMessageId
+
+
+def _blockTail(body, blockValue, extraOptions=None):
+    '''Returns the response code and the encoded options and payload for a
+    block of a body.
+
+    :param body: bytes-like Complete response body
+    :param blockValue: int Block2 option value from the request, or None for
+                       the first block at the largest size
+    :param extraOptions: list of coap.Option from the handler, or None
+    :return: tuple (code, tail); code is 4.02 if the block is past the end
+    '''
+    if blockValue is None:
+        num, szx = 0, MAX_BLOCK_SZX
+    else:
+        num, more, szx = coap.decodeBlock(blockValue)
+        # block size from the client, but no larger than ours, and no BERT;
+        # a smaller size scales the block number, as in RFC 7959, sec. 2.4
+        if szx > MAX_BLOCK_SZX:
+            num <<= szx - MAX_BLOCK_SZX
+            szx   = MAX_BLOCK_SZX
+    size  = 1 << (szx + 4)
+    start = num * size
+    if start and start >= len(body):
+        return coap.CODE_BAD_OPTION, b''
+
+    options = [_TEXT_PLAIN,
+               coap.Option(coap.OPTION_BLOCK2,
+                           coap.encodeBlock(num, start + size < len(body), szx))]
+    if num == 0:
+        options.append(coap.Option(coap.OPTION_SIZE2, len(body)))
+    if extraOptions:
+        options.extend(extraOptions)
+    return (coap.CODE_CONTENT,
+            coap.encodeOptions(options) + b'\xFF' + body[start:start+size])
+
+def createSocket(port, reusePort=False):
+    '''Creates a UDP socket bound to a port on all interfaces.
+
+    :param reusePort: boolean If True, sets SO_REUSEPORT, so several processes
+                      may bind the port and the kernel balances datagrams
+                      among them
+    '''
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    if reusePort:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('::', port))
+    return sock
+
+def createEngine(backend, port, sharedWith=None, reusePort=False, batchSize=0):
+    '''Creates a transport engine listening on a port.
+
+    :param backend: string Name from BACKENDS
+    :param port: int Local port
+    :param sharedWith: Engine from a previous call; if provided, the new engine
+                       runs on the same networking loop, so starting either
+                       engine serves both
+    :param reusePort: boolean If True, other processes may bind the port too
+    :param batchSize: int If not zero, receive and send datagrams in batches
+                      of up to this size, with batchio.BatchSocketIO
+    :raises ValueError: If backend unknown
+    '''
+    if backend == 'asyncore':
+        from gcoaptest.asyncoreengine import AsyncoreEngine
+        return AsyncoreEngine(port, sharedWith=sharedWith, reusePort=reusePort,
+                              batchSize=batchSize)
+    elif backend in ('asyncio', 'uvloop'):
+        from gcoaptest.asyncioengine import AsyncioEngine
+        return AsyncioEngine(port, useUvloop=(backend == 'uvloop'),
+                             sharedWith=sharedWith, reusePort=reusePort,
+                             batchSize=batchSize)
+    raise ValueError('Unknown backend: {0}'.format(backend))
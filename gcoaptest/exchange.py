@@ -0,0 +1,215 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Message layer exchanges for a transport engine, from RFC 7252, sec. 4: request
+deduplication, and piggybacked or separate responses to a confirmable request.
+
+Deduplication remembers each request by (endpoint address, message ID) for
+EXCHANGE_LIFETIME, along with its token. A duplicate is not passed to the
+handlers. A request with a remembered message ID but a different token is new,
+like from a load generator whose message IDs wrap within the lifetime. For a duplicate
+CON request, the ACK sent for the original is sent again, whether it carried a
+piggybacked response or was the empty ACK before a separate response. If the
+response is not sent yet, like a delayed response, the duplicate is dropped,
+and the client retries.
+
+Every request has the same lifetime, so insertion order also is expiry order.
+So the cache is an OrderedDict, expired from the front as requests arrive,
+with no timer for each entry. The cache also is limited to maxExchanges
+entries, which evicts the oldest entry early, so memory is bounded at any
+request rate.
+
+In separate mode, a CON request is acknowledged with an empty ACK once the
+handlers decide to respond, so an ignored request still is not acknowledged.
+The response is sent as a CON message, after any delay, retransmitted with exponential
+backoff until acknowledged, as in sec. 4.2.
+'''
+import collections
+import logging
+import random
+import time
+from   soscoap  import MessageType
+from   gcoaptest import coap
+
+log = logging.getLogger(__name__)
+
+# From RFC 7252, sec. 4.8
+ACK_TIMEOUT       = 2.0
+ACK_RANDOM_FACTOR = 1.5
+MAX_RETRANSMIT    = 4
+EXCHANGE_LIFETIME = 247
+
+# Most requests remembered for deduplication, and most separate responses
+# awaiting an ACK
+MAX_EXCHANGES = 100000
+
+ACK_MODES = ('piggyback', 'separate')
+
+
+class _SeparateResponse(object):
+    '''A CON separate response awaiting its ACK.
+
+    Attributes:
+        :data:     bytes Encoded response
+        :address:  tuple Destination
+        :retries:  int Count of retransmissions
+        :waitSecs: float Time to wait for the ACK to the latest transmission
+        :timer:    Timer entry for the wait
+    '''
+    __slots__ = ('data', 'address', 'retries', 'waitSecs', 'timer')
+
+
+class ExchangeLayer(object):
+    '''Deduplicates requests, and sends separate responses, for an engine.
+
+    Attributes:
+        :separate:     boolean True to send separate responses to CON requests
+        :dedup:        boolean True to deduplicate requests
+        :duplicates:   int Duplicate requests received
+        :evictions:    int Requests evicted from the cache before expiry
+        :retransmits:  int Separate responses retransmitted
+        :_exchanges:   OrderedDict of (address, message ID) to [expiry time,
+                       encoded ACK or None, token], oldest first
+        :_acknowledged: set of (address, message ID) for CON requests with an
+                        empty ACK sent, but no response yet
+        :_separates:   message ID:_SeparateResponse Awaiting an ACK
+
+    Usage:
+        #. engine.exchanges = ExchangeLayer(engine, separate=True)
+    '''
+    def __init__(self, engine, separate=False, dedup=True, lifetime=EXCHANGE_LIFETIME,
+                 maxExchanges=MAX_EXCHANGES, clock=time.time):
+        self._engine       = engine
+        self.separate      = separate
+        self.dedup         = dedup
+        self._lifetime     = lifetime
+        self._maxExchanges = maxExchanges
+        self._clock        = clock
+        self._exchanges    = collections.OrderedDict()
+        self._acknowledged = set()
+        self._separates    = {}
+        self._nextMessageId = random.randint(0, 0xFFFF)
+        self.duplicates    = 0
+        self.evictions     = 0
+        self.retransmits   = 0
+
+    @property
+    def exchangeCount(self):
+        return len(self._exchanges)
+
+    def isDuplicate(self, request):
+        '''Records a new request, or replies to a duplicate.
+
+        :return: boolean True if a duplicate, which needs no further handling
+        '''
+        if not self.dedup:
+            return False
+        now       = self._clock()
+        exchanges = self._exchanges
+        # expire from the front; every entry has the same lifetime
+        while exchanges:
+            key = next(iter(exchanges))
+            if exchanges[key][0] > now:
+                break
+            del exchanges[key]
+
+        key   = (request.address, request.messageId)
+        entry = exchanges.get(key)
+        if entry is not None and entry[2] != request.token:
+            # message ID reused for a new request; re-added at the back
+            del exchanges[key]
+            self._acknowledged.discard(key)
+            entry = None
+        if entry is None:
+            if len(exchanges) >= self._maxExchanges:
+                exchanges.popitem(last=False)
+                self.evictions += 1
+            exchanges[key] = [now + self._lifetime, None, request.token]
+            return False
+
+        self.duplicates += 1
+        if entry[1] is not None and request.messageType == MessageType.CON:
+            self._engine.sendBytes(entry[1], request.address)
+        log.debug('Duplicate request, MID %s', request.messageId)
+        return True
+
+    def forget(self, request):
+        '''Forgets a request, like one ignored to simulate loss, so a
+        retransmission is handled as new.
+        '''
+        key = (request.address, request.messageId)
+        self._exchanges.pop(key, None)
+        self._acknowledged.discard(key)
+
+    def acknowledge(self, request):
+        '''Sends an empty ACK for a CON request, ahead of a separate response.
+        Call once the response is decided, even if it is delayed.
+        '''
+        ack = coap.encodeHeader(MessageType.ACK, 0, 0, request.messageId, b'')
+        self.replied(request, ack)
+        self._acknowledged.add((request.address, request.messageId))
+        self._engine.sendBytes(ack, request.address)
+
+    def replied(self, request, data):
+        '''Remembers the ACK sent for a CON request, to resend for a duplicate.'''
+        entry = self._exchanges.get((request.address, request.messageId))
+        if entry is not None:
+            entry[1] = data
+
+    def takeAcknowledged(self, request):
+        '''Returns True if an empty ACK was sent for a CON request, so its
+        response must be sent separately. Holds even if the mode has changed
+        since the request was received.
+        '''
+        key = (request.address, request.messageId)
+        if key in self._acknowledged:
+            self._acknowledged.remove(key)
+            return True
+        return False
+
+    def sendSeparate(self, request, code, tail):
+        '''Sends a separate response as a CON message, and retransmits it until
+        acknowledged. If MAX_EXCHANGES responses already await an ACK, sends
+        once without retransmission.
+
+        :param tail: bytes Encoded options and payload
+        '''
+        self._nextMessageId = (self._nextMessageId + 1) & 0xFFFF
+        messageId = self._nextMessageId
+        data      = coap.encodeHeader(MessageType.CON, code[0], code[1], messageId,
+                                      request.token) + tail
+        if len(self._separates) < self._maxExchanges:
+            response          = _SeparateResponse()
+            response.data     = data
+            response.address  = request.address
+            response.retries  = 0
+            response.waitSecs = ACK_TIMEOUT * random.uniform(1, ACK_RANDOM_FACTOR)
+            response.timer    = self._engine.timers.schedule(response.waitSecs,
+                                                             self._retransmit, messageId)
+            self._separates[messageId] = response
+        self._engine.sendBytes(data, request.address)
+
+    def _retransmit(self, messageId):
+        response = self._separates.get(messageId)
+        if response is None:
+            return
+        if response.retries >= MAX_RETRANSMIT:
+            del self._separates[messageId]
+            log.debug('No ACK for separate response, MID %s', messageId)
+            return
+        response.retries  += 1
+        response.waitSecs *= 2
+        response.timer     = self._engine.timers.schedule(response.waitSecs,
+                                                          self._retransmit, messageId)
+        self.retransmits  += 1
+        self._engine.sendBytes(response.data, response.address)
+
+    def emptyReceived(self, message):
+        '''Completes a separate response on its ACK or RST.'''
+        response = self._separates.get(message.messageId)
+        if response is not None and response.address == message.address:
+            del self._separates[message.messageId]
+            self._engine.timers.cancel(response.timer)
@@ -0,0 +1,215 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Network impairment for a transport engine, to test a client under loss,
+latency, duplication, and reordering, like a lossy 6LoWPAN link.
+
+A FaultInjector holds a list of rules. Each rule matches requests by path
+prefix and by peer host, and the first match applies:
+
+* drop -- Probability a request is lost on the way in, before deduplication
+  and the handlers, so the client must retransmit
+* latency, jitter, dist -- Added delay for a response. The distribution is
+  uniform over latency +/- jitter, normal with mean latency and standard
+  deviation jitter, or exponential with mean latency; never negative.
+* dup -- Probability a response is sent twice
+* reorder, gap -- Probability a response is held for a further gap seconds,
+  so later responses overtake it
+
+Impaired responses are scheduled on the engine's timers, so the networking
+loop never sleeps, and other requests are served meanwhile. A separate
+response, a notification, or the ACK resent for a duplicate request is not
+impaired.
+
+A peer is compared without any IPv6 scope, so 'fe80::bbbb:2%tap0' and
+'fe80::bbbb:2' match the same client. A rule is text, like:
+
+    /ver * drop=0.1 latency=0.05 jitter=0.02 dup=0.01
+
+The injector sets itself as the engine's faults stage only while it has
+rules, so an unimpaired engine pays only a test for None.
+'''
+import logging
+import random
+from   gcoaptest import coap
+
+log = logging.getLogger(__name__)
+
+# Matches any path or peer
+ANY = '*'
+DISTRIBUTIONS = ('uniform', 'normal', 'exp')
+
+_DEFAULT_GAP = 0.05
+
+
+class FaultRule(object):
+    '''Impairments for requests that match a path prefix and peer.
+
+    Attributes:
+        :segments: tuple Uri-Path prefix to match, or None for any path
+        :peer:     string Host of the peer to match, as normalized by
+                   coap.normalizeHost(), or None for any peer
+        :drop:     float Probability a request is lost
+        :latency:  float Mean added seconds of response delay
+        :jitter:   float Spread of the delay, in seconds
+        :dist:     string Delay distribution, from DISTRIBUTIONS
+        :dup:      float Probability a response is duplicated
+        :reorder:  float Probability a response is held for gap seconds
+        :gap:      float Further delay for a reordered response
+    '''
+    __slots__ = ('segments', 'peer', 'drop', 'latency', 'jitter', 'dist', 'dup',
+                 'reorder', 'gap')
+
+    def __init__(self, path=ANY, peer=ANY):
+        self.segments = None if path == ANY else tuple(path.strip('/').split('/'))
+        self.peer     = None if peer == ANY else coap.normalizeHost(peer)
+        self.drop     = 0.0
+        self.latency  = 0.0
+        self.jitter   = 0.0
+        self.dist     = 'uniform'
+        self.dup      = 0.0
+        self.reorder  = 0.0
+        self.gap      = _DEFAULT_GAP
+
+    def matches(self, segments, host):
+        if self.peer is not None and self.peer != host:
+            return False
+        return (self.segments is None
+                or segments[:len(self.segments)] == self.segments)
+
+    def __str__(self):
+        path = ANY if self.segments is None else '/' + '/'.join(self.segments)
+        return ('{0} {1} drop={2} latency={3} jitter={4} dist={5} dup={6} '
+                'reorder={7} gap={8}').format(path, self.peer or ANY, self.drop,
+                                              self.latency, self.jitter, self.dist,
+                                              self.dup, self.reorder, self.gap)
+
+
+def parseRule(text):
+    '''Returns a FaultRule from text: '<path> <peer> [name=value ...]'.
+
+    :raises ValueError: For an unknown name, or a value out of range
+    '''
+    fields = text.split()
+    if len(fields) < 2:
+        raise ValueError('Fault rule needs a path and peer: {0}'.format(text))
+    rule = FaultRule(fields[0], fields[1])
+    for field in fields[2:]:
+        name, sep, value = field.partition('=')
+        if name == 'dist':
+            if value not in DISTRIBUTIONS:
+                raise ValueError('Unknown delay distribution: {0}'.format(value))
+            rule.dist = value
+        elif name in ('drop', 'dup', 'reorder'):
+            probability = float(value)
+            if not 0 <= probability <= 1:
+                raise ValueError('Probability out of range: {0}'.format(field))
+            setattr(rule, name, probability)
+        elif name in ('latency', 'jitter', 'gap'):
+            seconds = float(value)
+            if seconds < 0:
+                raise ValueError('Negative time: {0}'.format(field))
+            setattr(rule, name, seconds)
+        else:
+            raise ValueError('Unknown fault: {0}'.format(field))
+    return rule
+
+
+class FaultInjector(object):
+    '''Drops requests, and delays, duplicates, and reorders responses, for an
+    engine.
+
+    Attributes:
+        :rules:      list of FaultRule; the first match applies
+        :dropped:    int Requests dropped
+        :delayed:    int Responses delayed
+        :duplicated: int Responses duplicated
+        :reordered:  int Responses reordered
+        :pending:    int Responses scheduled but not yet sent
+        :_random:    random.Random Source for the impairments; seed for a
+                     repeatable run
+
+    Usage:
+        #. faults = FaultInjector(engine)
+        #. faults.configure('/ver * drop=0.2')
+    '''
+    def __init__(self, engine, seed=None):
+        self._engine    = engine
+        self._random    = random.Random(seed)
+        self.rules      = []
+        self.dropped    = 0
+        self.delayed    = 0
+        self.duplicated = 0
+        self.reordered  = 0
+        self.pending    = 0
+
+    def configure(self, text):
+        '''Replaces the rules with those in text, one per line or separated by
+        ';'. Empty text removes all rules.
+
+        :raises ValueError: For a malformed rule; the rules are unchanged
+        '''
+        lines = [line.strip() for line in text.replace(';', '\n').splitlines()]
+        self.rules = [parseRule(line) for line in lines if line]
+        self._engine.faults = self if self.rules else None
+        log.info('Fault rules: %s', '; '.join(str(rule) for rule in self.rules))
+
+    def _match(self, request):
+        segments = request.pathSegments()
+        host     = coap.normalizeHost(request.address[0])
+        for rule in self.rules:
+            if rule.matches(segments, host):
+                return rule
+        return None
+
+    def admit(self, request):
+        '''Returns False if a received request is lost.'''
+        rule = self._match(request)
+        if rule and rule.drop and self._random.random() < rule.drop:
+            self.dropped += 1
+            log.debug('Dropped request, MID %s', request.messageId)
+            return False
+        return True
+
+    def send(self, request, data):
+        '''Sends the encoded response to a request, with any impairments.'''
+        rule = self._match(request)
+        if not rule:
+            self._engine.sendBytes(data, request.address)
+            return
+
+        rand  = self._random
+        delay = 0.0
+        if rule.latency or rule.jitter:
+            if rule.dist == 'normal':
+                delay = rand.gauss(rule.latency, rule.jitter)
+            elif rule.dist == 'exp':
+                delay = rand.expovariate(1.0 / rule.latency) if rule.latency else 0.0
+            else:
+                delay = rand.uniform(rule.latency - rule.jitter,
+                                     rule.latency + rule.jitter)
+            delay = max(delay, 0.0)
+        if rule.reorder and rand.random() < rule.reorder:
+            delay += rule.gap
+            self.reordered += 1
+        copies = 1
+        if rule.dup and rand.random() < rule.dup:
+            copies = 2
+            self.duplicated += 1
+
+        if delay > 0:
+            self.delayed += 1
+            for i in range(copies):
+                self.pending += 1
+                self._engine.timers.schedule(delay, self._sendScheduled, data,
+                                             request.address)
+        else:
+            for i in range(copies):
+                self._engine.sendBytes(data, request.address)
+
+    def _sendScheduled(self, data, address):
+        self.pending -= 1
+        self._engine.sendBytes(data, address)
@@ -0,0 +1,97 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Fixed size histogram of integer values, in the style of HdrHistogram. Buckets
+are log-linear: each power of two range is split into the same number of
+linear sub-buckets, so a recorded value is kept to within a fixed relative
+precision, and recording is a few integer operations with no allocation.
+'''
+import array
+
+
+class Histogram(object):
+    '''Counts of non-negative integer values, like microseconds.
+
+    With subBucketBits 4, a value is kept to within 1/16 (6.25%). Values above
+    the highest value are counted in the last bucket.
+
+    Attributes:
+        :count:    int Count of recorded values
+        :total:    int Sum of recorded values, for the mean
+        :minValue: int Lowest recorded value, or None
+        :maxValue: int Highest recorded value, or None
+        :_counts:  array Count for each bucket
+    '''
+    def __init__(self, highestValue=60*1000*1000, subBucketBits=4):
+        self._subBits   = subBucketBits
+        self._subCount  = 1 << subBucketBits
+        self._lastIndex = self._index(highestValue)
+        self._counts    = array.array('l', [0]) * (self._lastIndex + 1)
+        self.count      = 0
+        self.total      = 0
+        self.minValue   = None
+        self.maxValue   = None
+
+    def _index(self, value):
+        '''Returns the bucket index for a value. Values below _subCount have a
+        bucket each; above, each power of two range has _subCount buckets.
+        '''
+        if value < self._subCount:
+            return value
+        shift = value.bit_length() - self._subBits - 1
+        return ((shift + 1) << self._subBits) + (value >> shift) - self._subCount
+
+    def _lowValue(self, index):
+        '''Returns the lowest value counted in a bucket.'''
+        if index < self._subCount:
+            return index
+        shift = (index >> self._subBits) - 1
+        return (self._subCount + (index & (self._subCount - 1))) << shift
+
+    def record(self, value):
+        value = int(value)
+        if value < 0:
+            value = 0
+        index = self._index(value)
+        self._counts[index if index < self._lastIndex else self._lastIndex] += 1
+        self.count += 1
+        self.total += value
+        if self.minValue is None or value < self.minValue:
+            self.minValue = value
+        if self.maxValue is None or value > self.maxValue:
+            self.maxValue = value
+
+    def add(self, other):
+        '''Adds the counts from another histogram with the same layout.'''
+        for i, n in enumerate(other._counts):
+            if n:
+                self._counts[i] += n
+        self.count += other.count
+        self.total += other.total
+        for value in (other.minValue, other.maxValue):
+            if value is not None:
+                if self.minValue is None or value < self.minValue:
+                    self.minValue = value
+                if self.maxValue is None or value > self.maxValue:
+                    self.maxValue = value
+
+    def percentile(self, percent):
+        '''Returns the value at a percentile, like 99.9, or None if empty. The
+        value is the low end of its bucket, but not less than minValue nor more
+        than maxValue.
+        '''
+        if not self.count:
+            return None
+        target  = max(1, int(round(self.count * percent / 100.0)))
+        running = 0
+        for index, n in enumerate(self._counts):
+            running += n
+            if running >= target:
+                return min(max(self._lowValue(index), self.minValue), self.maxValue)
+        return self.maxValue
+
+    def mean(self):
+        return self.total / float(self.count) if self.count else None
@@ -0,0 +1,370 @@
+#!/usr/bin/python
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+A CoAP load generator, for a GcoapTester or a RIOT gcoap node. Sends a stream
+of GET, PUT, or POST requests from a single socket, and reports the achieved
+rate, loss, retransmissions, and latency percentiles.
+
+In open loop mode, sends at a target rate regardless of responses. In closed
+loop mode, keeps a fixed number of requests outstanding, and sends the next
+request as soon as one completes.
+
+A confirmable request is retransmitted with the exponential backoff from
+RFC 7252, sec. 4.2, and is lost after MAX_RETRANSMIT retransmissions. An
+empty ACK stops retransmission, and the request then waits up to
+MAX_TRANSMIT_WAIT for its separate response. A non-confirmable request is lost
+if no response arrives within the timeout. A RST completes a request as reset.
+Latency is measured from the first transmission.
+
+Options:
+   | -a <hostAddr> -- Host address
+   | -p <port> -- Host port; defaults to 5683
+   | -s <port> -- Source port; defaults to an ephemeral port
+   | -b <backend> -- Transport engine: asyncore, asyncio, or uvloop
+   | -m <method> -- GET, PUT, or POST; defaults to GET
+   | -u <path> -- Request path; defaults to /ver
+   | -d <payload> -- Request payload for PUT or POST
+   | -c -- Send confirmable requests
+   | -r <rate> -- Open loop at <rate> requests/sec
+   | -n <count> -- Closed loop with <count> requests outstanding; the default
+   |              if -r not given, with a count of 1
+   | -t <secs> -- Duration to send requests; defaults to 10
+   | -T <secs> -- Timeout; initial ACK timeout for a confirmable request.
+   |              Defaults to 2.
+
+Run the load generator against a local tester with:
+   ``$ PYTHONPATH=.. python -m gcoaptest.loadgen -a ::1 -r 5000 -t 10``
+'''
+from   __future__ import print_function
+import logging
+import random
+import struct
+import time
+from   soscoap  import MessageType
+from   soscoap  import CodeClass
+from   soscoap  import RequestCode
+from   soscoap  import OptionType
+from   soscoap  import COAP_PORT
+from   gcoaptest import coap
+from   gcoaptest import engine
+from   gcoaptest import logconfig
+from   gcoaptest.exchange  import ACK_RANDOM_FACTOR, MAX_RETRANSMIT
+from   gcoaptest.histogram import Histogram
+
+log = logging.getLogger(__name__)
+
+# Interval between open loop sends; requests due since the last send are sent
+# together
+TICK_SECS = 0.001
+
+METHODS = {'GET': RequestCode.GET, 'PUT': RequestCode.PUT, 'POST': RequestCode.POST}
+
+# From RFC 7252, sec. 4.8.2, as a multiple of the initial timeout
+_MAX_TRANSMIT_WAIT = ((1 << (MAX_RETRANSMIT + 1)) - 1) * ACK_RANDOM_FACTOR
+
+
+class _Exchange(object):
+    '''An outstanding request.
+
+    Attributes:
+        :messageId: int Message ID, reused for retransmissions
+        :token:     bytes Token, which keys the exchange
+        :messageType: int CON or NON
+        :data:      bytes Encoded request
+        :firstSent: float Time of the first transmission
+        :retries:   int Count of retransmissions
+        :waitSecs:  float Time to wait for a response to the latest
+                    transmission
+        :timer:     Timer entry for the wait
+        :acked:     boolean True if an empty ACK was received, so the response
+                    follows separately
+        :context:   Caller's data for the request, or None
+    '''
+    __slots__ = ('messageId', 'token', 'messageType', 'data', 'firstSent', 'retries',
+                 'waitSecs', 'timer', 'acked', 'context')
+
+
+class LoadGenerator(object):
+    '''Sends a stream of requests to a host, and collects the results.
+
+    Attributes:
+        :_client:      Transport engine
+        :_hostTuple:   tuple Address for the requests
+        :_tail:        bytes Encoded options and payload, the same for every
+                       request
+        :_outstanding: bytes:_Exchange, where the key is the token
+        :_messageIds:  int:bytes Token of the outstanding request for a message
+                       ID, to match an empty ACK or RST
+        :_latency:     Histogram Microseconds from first transmission to
+                       response
+        :_sending:     boolean True until the duration has passed
+        :_closedLoop:  boolean True to send a request when one completes
+
+    Usage:
+        #. gen = LoadGenerator(hostAddr, hostPort, backend, ...) -- Create
+        #. gen.run(duration, rate=5000) -- Runs the load; returns when done
+        #. gen.summary() -- Results
+    '''
+    def __init__(self, hostAddr, hostPort=COAP_PORT, backend=engine.DEFAULT_BACKEND,
+                 method='GET', path='/ver', payload=None, confirmable=False,
+                 timeout=2.0, sourcePort=0):
+        self._hostTuple = (hostAddr, hostPort)
+        self._client    = engine.createEngine(backend, sourcePort)
+        self._client.registerForResponse(self._response)
+        self._client.registerForEmpty(self._empty)
+        self._timers    = self._client.timers
+
+        self._code        = METHODS[method]
+        self._messageType = MessageType.CON if confirmable else MessageType.NON
+        self._timeout     = timeout
+        options = [coap.Option(OptionType.UriPath, segment)
+                   for segment in path.strip('/').split('/') if segment]
+        self._tail = coap.encodeOptions(options)
+        if payload:
+            self._tail += b'\xFF' + payload.encode('utf-8')
+
+        self._outstanding = {}
+        self._messageIds  = {}
+        self._latency     = Histogram()
+        self._nextToken   = 0
+        self._nextMessageId = random.randint(0, 0xFFFF)
+        self._sending     = False
+        self._closedLoop  = False
+        self.sent         = 0
+        self.received     = 0
+        self.lost         = 0
+        self.retransmits  = 0
+        self.errors       = 0
+        self.resets       = 0
+        self.elapsed      = 0.0
+
+    def run(self, duration, rate=0, concurrency=1):
+        '''Sends requests for duration seconds, then waits for outstanding
+        requests to complete or time out. Returns when done.
+
+        :param rate: float Open loop requests/sec; if 0, runs a closed loop
+        :param concurrency: int Requests outstanding in a closed loop
+        '''
+        self._sending    = True
+        self._rate       = rate
+        self._closedLoop = not rate
+        self._started    = time.time()
+        self._timers.schedule(duration, self._stopSending)
+        if rate:
+            self._tick()
+        else:
+            for i in range(concurrency):
+                self._sendRequest()
+        self._client.start()
+
+    def _tick(self):
+        '''Sends the open loop requests due since the start.'''
+        if not self._sending:
+            return
+        due = int((time.time() - self._started) * self._rate) - self.sent
+        for i in range(due):
+            self._sendRequest()
+        self._timers.schedule(TICK_SECS, self._tick)
+
+    def _sendRequest(self, code=None, tail=None, messageType=None, context=None):
+        '''Sends a request, by default the configured one.
+
+        :param tail: bytes Encoded options and payload
+        :param context: Stored with the exchange, for _completed()
+        '''
+        self._nextToken     = (self._nextToken + 1) & 0xFFFFFFFF
+        self._nextMessageId = (self._nextMessageId + 1) & 0xFFFF
+        token = struct.pack('!I', self._nextToken)
+
+        exchange             = _Exchange()
+        exchange.messageId   = self._nextMessageId
+        exchange.token       = token
+        exchange.messageType = self._messageType if messageType is None else messageType
+        exchange.data        = coap.encodeHeader(exchange.messageType, CodeClass.Request,
+                                                 code or self._code, exchange.messageId,
+                                                 token) + (self._tail if tail is None else tail)
+        exchange.firstSent   = time.time()
+        exchange.retries     = 0
+        exchange.acked       = False
+        exchange.context     = context
+        if exchange.messageType == MessageType.CON:
+            exchange.waitSecs = self._timeout * random.uniform(1, ACK_RANDOM_FACTOR)
+        else:
+            exchange.waitSecs = self._timeout
+        exchange.timer     = self._timers.schedule(exchange.waitSecs, self._expire,
+                                                   token)
+        self._outstanding[token] = exchange
+        self._messageIds[exchange.messageId] = token
+        self.sent += 1
+        self._client.sendBytes(exchange.data, self._hostTuple)
+
+    def _expire(self, token):
+        '''Retransmits a confirmable request, or records a loss.'''
+        exchange = self._outstanding.get(token)
+        if exchange is None:
+            return
+        if (exchange.messageType == MessageType.CON and not exchange.acked
+                and exchange.retries < MAX_RETRANSMIT):
+            exchange.retries  += 1
+            exchange.waitSecs *= 2
+            exchange.timer     = self._timers.schedule(exchange.waitSecs, self._expire,
+                                                       token)
+            self.retransmits  += 1
+            self._client.sendBytes(exchange.data, self._hostTuple)
+            return
+
+        del self._outstanding[token]
+        self._forgetMessageId(exchange)
+        self.lost += 1
+        log.debug('Lost request, MID %s', exchange.messageId)
+        self._completed(exchange, None)
+
+    def _response(self, message):
+        now      = time.time()
+        exchange = self._outstanding.pop(message.token, None)
+        if message.messageType == MessageType.CON:
+            # separate response
+            self._client.sendBytes(coap.encodeHeader(MessageType.ACK, 0, 0,
+                                                      message.messageId, b''),
+                                    message.address)
+        if exchange is None:
+            # late or duplicate
+            return
+
+        self._timers.cancel(exchange.timer)
+        self._forgetMessageId(exchange)
+        self.received += 1
+        if message.codeClass != CodeClass.Success:
+            self.errors += 1
+        self._latency.record((now - exchange.firstSent) * 1000000)
+        self._completed(exchange, message)
+
+    def _empty(self, message):
+        '''Handles an empty ACK, which stops retransmission of a CON request
+        until its separate response, or a RST, which completes a request.
+        '''
+        token    = self._messageIds.get(message.messageId)
+        exchange = self._outstanding.get(token) if token else None
+        if exchange is None:
+            return
+        if message.messageType == MessageType.ACK:
+            if exchange.messageType == MessageType.CON and not exchange.acked:
+                self._timers.cancel(exchange.timer)
+                exchange.acked = True
+                exchange.timer = self._timers.schedule(self._timeout * _MAX_TRANSMIT_WAIT,
+                                                       self._expire, token)
+            return
+
+        self._timers.cancel(exchange.timer)
+        del self._outstanding[token]
+        self._forgetMessageId(exchange)
+        self.resets += 1
+        log.debug('Reset request, MID %s', exchange.messageId)
+        self._completed(exchange, message)
+
+    def _forgetMessageId(self, exchange):
+        if self._messageIds.get(exchange.messageId) == exchange.token:
+            del self._messageIds[exchange.messageId]
+
+    def _completed(self, exchange, response):
+        '''Sends the next closed loop request, or finishes.
+
+        :param response: coap.HeaderView Response, coap.Message RST, or None
+                         if lost
+        '''
+        if self._sending:
+            if self._closedLoop:
+                self._sendRequest()
+        elif not self._outstanding:
+            self._client.close()
+
+    def _stopSending(self):
+        self._sending = False
+        self.elapsed  = time.time() - self._started
+        if not self._outstanding:
+            self._client.close()
+
+    def summary(self):
+        '''Returns the results as a dict; latencies in milliseconds.'''
+        def ms(percent):
+            value = self._latency.percentile(percent)
+            return None if value is None else value / 1000.0
+
+        elapsed = self.elapsed or (time.time() - self._started)
+        return {
+            'sent':        self.sent,
+            'received':    self.received,
+            'lost':        self.lost,
+            'errors':      self.errors,
+            'resets':      self.resets,
+            'retransmits': self.retransmits,
+            'sendRate':    self.sent / elapsed,
+            'rate':        self.received / elapsed,
+            'loss':        self.lost / float(self.sent) if self.sent else 0.0,
+            'p50':         ms(50),
+            'p99':         ms(99),
+            'p999':        ms(99.9),
+            'max':         ms(100),
+        }
+
+
+def formatSummary(summary):
+    '''Returns the summary from LoadGenerator.summary() as printable text.'''
+    def ms(value):
+        return '-' if value is None else '{0:.3f}'.format(value)
+
+    return ('Sent {sent} at {sendRate:.0f}/s; received {received} at {rate:.0f}/s\n'
+            'Lost {lost} ({lossPct:.2f}%); retransmits {retransmits}; '
+            'error responses {errors}; resets {resets}\n'
+            'Latency ms p50 {0}; p99 {1}; p999 {2}; max {3}').format(
+            ms(summary['p50']), ms(summary['p99']), ms(summary['p999']),
+            ms(summary['max']), lossPct=summary['loss'] * 100, **summary)
+
+# Run the load generator
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    # read command line
+    parser = OptionParser()
+    parser.add_option('-a', type='string', dest='hostAddr')
+    parser.add_option('-p', type='int', dest='hostPort', default=COAP_PORT)
+    parser.add_option('-s', type='int', dest='sourcePort', default=0)
+    parser.add_option('-b', type='choice', dest='backend', choices=engine.BACKENDS,
+                      default=engine.DEFAULT_BACKEND)
+    parser.add_option('-m', type='choice', dest='method', choices=sorted(METHODS),
+                      default='GET')
+    parser.add_option('-u', type='string', dest='path', default='/ver')
+    parser.add_option('-d', type='string', dest='payload')
+    parser.add_option('-c', action='store_true', dest='confirmable', default=False)
+    parser.add_option('-r', type='float', dest='rate', default=0)
+    parser.add_option('-n', type='int', dest='concurrency', default=1)
+    parser.add_option('-t', type='float', dest='duration', default=10)
+    parser.add_option('-T', type='float', dest='timeout', default=2.0)
+    parser.add_option('--log-level', type='choice', dest='logLevel',
+                      choices=logconfig.LEVELS, default='info')
+
+    (options, args) = parser.parse_args()
+    if not options.hostAddr:
+        parser.error('host address (-a) required')
+
+    logconfig.configureLogging('loadgen.log', options.logLevel)
+    generator = None
+    try:
+        generator = LoadGenerator(options.hostAddr, options.hostPort, options.backend,
+                                  options.method, options.path, options.payload,
+                                  options.confirmable, options.timeout,
+                                  options.sourcePort)
+        generator.run(options.duration, options.rate, options.concurrency)
+    except KeyboardInterrupt:
+        pass
+    except:
+        log.exception('Catch-all handler for load generator')
+        print('\nAborting; see log for exception.')
+    finally:
+        if generator and generator.sent:
+            print(formatSummary(generator.summary()))
+        logconfig.stopLogging()
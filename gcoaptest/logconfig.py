@@ -0,0 +1,120 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Logging setup for the tester and observer applications. By default, log
+records go to a bounded queue, and a background thread formats them and writes
+them to the log file, so the networking loop does not wait on the file. When
+the queue is full, the oldest record is dropped, like a ring buffer.
+
+Queued logging needs logging.handlers.QueueHandler, from Python 3.2; on
+Python 2, logs synchronously to the file.
+'''
+import logging
+import signal
+
+try:
+    import queue
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    QueueHandler = None
+
+LEVELS       = ('debug', 'info', 'warning', 'error', 'critical')
+LOG_FORMAT   = '%(asctime)s %(module)s %(message)s'
+# Most records waiting for the writer thread
+QUEUE_SIZE   = 10000
+
+_listener = None
+_config   = None
+
+
+if QueueHandler:
+    class _RingQueueHandler(QueueHandler):
+        '''Queues records without formatting them, and drops the oldest record
+        when the queue is full.
+
+        Attributes:
+            :dropCount: int Count of records dropped
+        '''
+        def __init__(self, recordQueue):
+            super(_RingQueueHandler, self).__init__(recordQueue)
+            self.dropCount = 0
+
+        def prepare(self, record):
+            # The writer thread is in the same process, so the record is
+            # formatted there rather than here.
+            return record
+
+        def enqueue(self, record):
+            while True:
+                try:
+                    self.queue.put_nowait(record)
+                    return
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.dropCount += 1
+                    except queue.Empty:
+                        pass
+
+
+def configureLogging(filename, level='debug', queued=True):
+    '''Sends log records at or above a level to a file; replaces handlers from
+    a previous call.
+
+    :param level: string Name from LEVELS
+    :param queued: boolean If True, writes to the file from a background thread
+    '''
+    global _listener, _config
+    _config = (filename, level, queued)
+    stopLogging()
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(getattr(logging, level.upper()))
+
+    fileHandler = logging.FileHandler(filename)
+    fileHandler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if queued and QueueHandler:
+        recordQueue = queue.Queue(QUEUE_SIZE)
+        _listener   = QueueListener(recordQueue, fileHandler)
+        startBlockingSignals(_listener)
+        root.addHandler(_RingQueueHandler(recordQueue))
+    else:
+        root.addHandler(fileHandler)
+
+def startBlockingSignals(thread):
+    '''Starts a background thread, like the log writer, with SIGINT and SIGTERM
+    blocked, so they are delivered to the main thread, and interrupt its
+    blocking calls.
+
+    :param thread: Object with a start() method that starts the thread
+    '''
+    signals = (signal.SIGINT, signal.SIGTERM)
+    if hasattr(signal, 'pthread_sigmask'):
+        previous = signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+        try:
+            thread.start()
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, previous)
+    else:
+        thread.start()
+
+def restartLogging():
+    '''Restarts logging with the last configuration, in a child process from
+    fork(). The child does not have the parent's writer thread.
+    '''
+    global _listener
+    if _config:
+        _listener = None
+        configureLogging(*_config)
+
+def stopLogging():
+    '''Writes the queued records, and stops the writer thread.'''
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
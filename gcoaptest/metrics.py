@@ -0,0 +1,135 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Request metrics for a transport engine, in the Prometheus text exposition
+format. The engine updates plain counters from the networking loop thread,
+so an update is a dict increment, with no lock. The text is generated only
+when asked, by a CoAP resource or the optional HTTP server here.
+
+With tester worker processes, each worker keeps and reports its own metrics.
+'''
+import collections
+import logging
+import threading
+from   gcoaptest import logconfig
+from   gcoaptest.histogram import Histogram
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+log = logging.getLogger(__name__)
+
+# Path label for requests to a path not registered as a resource, so a flood
+# of random paths does not grow the counters without bound
+OTHER_PATH = ('<other>',)
+
+_METHOD_NAMES = {1: 'GET', 2: 'POST', 3: 'PUT', 4: 'DELETE'}
+_QUANTILES    = (50, 90, 99, 99.9)
+
+
+class EngineMetrics(object):
+    '''Counters and a histogram for the requests handled by an engine.
+
+    Attributes:
+        :requests:     (path segments, method):int Requests received
+        :ignored:      path segments:int Requests ignored by a handler
+        :responses:    (code class, code detail):int Responses sent or
+                       scheduled
+        :delayed:      int Responses scheduled with a delay
+        :delaySeconds: float Sum of the delays
+        :handlerTime:  Histogram Microseconds to run the handlers for a
+                       request; excludes cached responses
+    '''
+    def __init__(self):
+        self.requests     = collections.defaultdict(int)
+        self.ignored      = collections.defaultdict(int)
+        self.responses    = collections.defaultdict(int)
+        self.delayed      = 0
+        self.delaySeconds = 0.0
+        self.handlerTime  = Histogram()
+
+    def exposition(self, gauges=()):
+        '''Returns the metrics as text in the exposition format.
+
+        :param gauges: Iterable of (name, help text, value) for gauges from
+                       the application, like configuration
+        '''
+        lines = []
+        def header(name, helpText, metricType):
+            lines.append('# HELP {0} {1}'.format(name, helpText))
+            lines.append('# TYPE {0} {1}'.format(name, metricType))
+
+        header('gcoap_requests_total', 'Requests received, by path and method',
+               'counter')
+        for (segments, method), count in sorted(dict(self.requests).items()):
+            lines.append('gcoap_requests_total{{path="{0}",method="{1}"}} {2}'.format(
+                         _pathLabel(segments), _METHOD_NAMES.get(method, method), count))
+
+        header('gcoap_ignored_requests_total', 'Requests ignored, by path', 'counter')
+        for segments, count in sorted(dict(self.ignored).items()):
+            lines.append('gcoap_ignored_requests_total{{path="{0}"}} {1}'.format(
+                         _pathLabel(segments), count))
+
+        header('gcoap_responses_total', 'Responses, by code', 'counter')
+        for code, count in sorted(dict(self.responses).items()):
+            lines.append('gcoap_responses_total{{code="{0}.{1:02d}"}} {2}'.format(
+                         code[0], code[1], count))
+
+        header('gcoap_delayed_responses_total', 'Responses sent after a delay',
+               'counter')
+        lines.append('gcoap_delayed_responses_total {0}'.format(self.delayed))
+        header('gcoap_response_delay_seconds_total', 'Sum of response delays',
+               'counter')
+        lines.append('gcoap_response_delay_seconds_total {0}'.format(self.delaySeconds))
+
+        header('gcoap_handler_seconds', 'Time to run the handlers for a request',
+               'summary')
+        histogram = self.handlerTime
+        for quantile in _QUANTILES:
+            value = histogram.percentile(quantile)
+            if value is not None:
+                lines.append('gcoap_handler_seconds{{quantile="{0:g}"}} {1}'.format(
+                             quantile / 100.0, value / 1e6))
+        lines.append('gcoap_handler_seconds_sum {0}'.format(histogram.total / 1e6))
+        lines.append('gcoap_handler_seconds_count {0}'.format(histogram.count))
+
+        for name, helpText, value in gauges:
+            header(name, helpText, 'gauge')
+            lines.append('{0} {1}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+def _pathLabel(segments):
+    return '/' + '/'.join(segments) if segments != OTHER_PATH else OTHER_PATH[0]
+
+
+def serveHttp(port, textFn, host='localhost'):
+    '''Serves metrics text over HTTP from a background thread, for GET of any
+    path. The thread only reads the counters.
+
+    :param textFn: Function that returns the metrics text
+    :return: HTTPServer; call shutdown() to stop
+    '''
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = textFn().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug('Metrics request from %s', self.client_address[0])
+
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    logconfig.startBlockingSignals(thread)
+    log.info('Serving metrics on http://%s:%s/', host, port)
+    return server
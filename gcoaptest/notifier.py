@@ -0,0 +1,179 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Observe server support, from RFC 7641, for a transport engine. A Notifier keeps
+the observers registered for each resource, and sends a notification to all of
+them when the resource changes.
+
+A notification is the same for every observer of a resource except for the
+header's message ID and the token, so the options and payload are encoded once
+per change, and each observer's datagram is its header and token followed by
+the shared tail.
+
+Observers are indexed by (endpoint address, token), which identifies an
+observation, as required by RFC 7641, sec. 4.1. So registration, removal, and
+matching a reset to its observer each are a dict operation, and a fan-out is a
+single pass over the resource's observers.
+
+Confirmable notifications are sent, but not retransmitted. An ACK is counted;
+a RST, for either a CON or NON notification, removes the observer.
+'''
+import logging
+import random
+import struct
+from   soscoap  import MessageType
+from   soscoap  import OptionType
+from   gcoaptest import coap
+
+log = logging.getLogger(__name__)
+
+# Observe values are 24 bits
+_OBSERVE_MASK = 0xFFFFFF
+# Observe option values in a GET request
+_REGISTER   = 0
+_DEREGISTER = 1
+
+_HEADER       = struct.Struct('!BBH')
+# First byte of the header, without the token length, by message type
+_FIRST_BYTE   = {MessageType.CON: coap.COAP_VERSION << 6 | MessageType.CON << 4,
+                 MessageType.NON: coap.COAP_VERSION << 6 | MessageType.NON << 4}
+_CODE_CONTENT = coap.CODE_CONTENT[0] << 5 | coap.CODE_CONTENT[1]
+
+
+class _Observation(object):
+    '''An observer registered for a resource.
+
+    Attributes:
+        :key:       tuple (address, token)
+        :segments:  tuple Uri-Path segments of the resource
+        :lastMessageId: int Message ID of the latest notification, or None
+    '''
+    __slots__ = ('key', 'segments', 'lastMessageId')
+
+    def __init__(self, key, segments):
+        self.key           = key
+        self.segments      = segments
+        self.lastMessageId = None
+
+
+class Notifier(object):
+    '''Registers observers and fans out notifications for an engine.
+
+    Attributes:
+        :_engine:       Transport engine that receives the registrations
+        :_observations: (address, token):_Observation All observers
+        :_byPath:       segments:dict Observers for each resource, keyed like
+                        _observations
+        :_sequence:     segments:int Observe value of the latest notification
+                        for each resource
+        :_byMessageId:  int:(address, token) Observer for the latest
+                        notification to each observer, to match a RST or ACK
+        :notifications: int Notifications sent, counting each observer
+        :acks:          int ACKs received for CON notifications
+        :resets:        int RSTs received, each removing an observer
+
+    Usage:
+        #. notifier = Notifier(engine)
+        #. notifier.handleGet(resource) -- From the resource's GET handler
+        #. notifier.notify(segments, body) -- When the resource changes
+    '''
+    def __init__(self, engine):
+        self._engine       = engine
+        self._observations = {}
+        self._byPath       = {}
+        self._sequence     = {}
+        self._byMessageId  = {}
+        self._nextMessageId = random.randint(0, 0xFFFF)
+        self.notifications = 0
+        self.acks          = 0
+        self.resets        = 0
+        engine.registerForEmpty(self._emptyMessage)
+
+    @property
+    def observerCount(self):
+        return len(self._observations)
+
+    def handleGet(self, resource):
+        '''Registers or deregisters the requester for an Observe GET, from the
+        resource's handler. Adds the Observe option to the response for a
+        registration. A GET without Observe removes any observation with its
+        endpoint and token, like RFC 7641, sec. 4.1.
+        '''
+        request = resource.request
+        key     = (request.address, request.token)
+        observe = request.findOption(OptionType.Observe)
+        if observe and observe[0].value == _REGISTER:
+            observation = self._observations.get(key)
+            if observation and observation.segments != resource.segments:
+                self._remove(key)
+                observation = None
+            if not observation:
+                self._observations[key] = _Observation(key, resource.segments)
+                self._byPath.setdefault(resource.segments, {})[key] = \
+                        self._observations[key]
+                log.debug('Registered observer %s for %s', key, resource.path)
+            resource.options = [coap.Option(OptionType.Observe,
+                                            self._sequence.get(resource.segments, 0))]
+        else:
+            self._remove(key)
+
+    def _remove(self, key):
+        observation = self._observations.pop(key, None)
+        if observation:
+            observers = self._byPath[observation.segments]
+            del observers[key]
+            if not observers:
+                del self._byPath[observation.segments]
+            # after a wrap, the message ID may belong to another observer
+            if self._byMessageId.get(observation.lastMessageId) == key:
+                del self._byMessageId[observation.lastMessageId]
+            log.debug('Removed observer %s', key)
+
+    def notify(self, segments, body, confirmable=False):
+        '''Sends a notification of a text body to the observers of a resource.
+
+        :param segments: tuple Uri-Path segments of the resource
+        :param body: bytes Response payload
+        :return: int Count of observers notified
+        '''
+        sequence = (self._sequence.get(segments, 0) + 1) & _OBSERVE_MASK
+        self._sequence[segments] = sequence
+        observers = self._byPath.get(segments)
+        if not observers:
+            return 0
+
+        # encode once for all observers
+        tail = coap.encodeOptions([coap.Option(OptionType.Observe, sequence),
+                                   coap.Option(coap.OPTION_CONTENT_FORMAT,
+                                               coap.MEDIA_TEXT_PLAIN)]) + b'\xFF' + body
+        first       = _FIRST_BYTE[MessageType.CON if confirmable else MessageType.NON]
+        pack        = _HEADER.pack
+        sendBytes   = self._engine.sendBytes
+        byMessageId = self._byMessageId
+        messageId   = self._nextMessageId
+        for observation in observers.values():
+            address, token = observation.key
+            messageId = (messageId + 1) & 0xFFFF
+            if byMessageId.get(observation.lastMessageId) == observation.key:
+                del byMessageId[observation.lastMessageId]
+            byMessageId[messageId]    = observation.key
+            observation.lastMessageId = messageId
+            sendBytes(pack(first | len(token), _CODE_CONTENT, messageId) + token + tail,
+                      address)
+        self._nextMessageId = messageId
+        self.notifications += len(observers)
+        return len(observers)
+
+    def _emptyMessage(self, message):
+        '''Handles an ACK or RST for a notification.'''
+        key = self._byMessageId.get(message.messageId)
+        if key is None or key[0] != message.address:
+            return
+        if message.messageType == MessageType.RST:
+            self.resets += 1
+            self._remove(key)
+        else:
+            self.acks += 1
@@ -15,44 +15,203 @@ Options:
    |              server periodically sends responses. Also uses <port>+1 to
    |              listen for commands. For example, use of '-s 5682' means
    |              that ports 5682 and 5683 will be used.
+   | -b <backend> -- Transport engine: asyncore, asyncio, or uvloop. Defaults
+   |              to asyncore where available.
+   | -o <path> -- Load mode; at start, registers <count> observers for <path>,
+   |              either a short name like 'stats' or a path like 'cli/stats'
+   | -n <count> -- Load mode observer count; defaults to 1
+   | -k <ports> -- Load mode source port count; observers are spread over
+   |              <ports> sockets, the first at <port> and the rest at
+   |              ephemeral ports. Defaults to 1.
+
+Load mode also may be driven by commands to the observer:
+   | POST /load/reg, payload '<path> <count> [<ports>]' -- register observers
+   | POST /load/dereg -- deregister all load mode observers
+   | GET /load -- summary of notifications received by load mode observers
+
+Profiling:
+   | POST /prof, payload 'on' or 'off' -- start or stop profiling; an empty
+   |              payload toggles. Writes stats to a file when stopped; see
+   |              profiler.py.
+   | --profile -- Profile from start until the observer exits
+
+Notification metrics:
+   | GET /stats -- totals for all registrations, then a line for each
+   |              registration not in load mode
+   | GET /stats?<token> -- the line for a single registration, like '05a6'
 
 Run the observer on POSIX with:
    ``$ PYTHONPATH=../../soscoap/repo ./gcoap_observer.py -s 5682 -a fe80::bbbb:2%tap0``
 '''
 from   __future__ import print_function
 import logging
-import asyncore
 import random
+import struct
 import sys
+import time
 from   soscoap  import CodeClass
 from   soscoap  import MessageType
 from   soscoap  import OptionType
 from   soscoap  import RequestCode
 from   soscoap  import ClientResponseCode
 from   soscoap  import COAP_PORT
-from   soscoap.resource import SosResourceTransfer
-from   soscoap.message  import CoapMessage
-from   soscoap.message  import CoapOption
-from   soscoap.msgsock  import MessageSocket
-from   soscoap.client   import CoapClient
-from   soscoap.server   import CoapServer
-
-logging.basicConfig(filename='observer.log', level=logging.DEBUG, 
-                    format='%(asctime)s %(module)s %(message)s')
+from   gcoaptest import engine
+from   gcoaptest import logconfig
+from   gcoaptest.coap import Message as CoapMessage
+from   gcoaptest.coap import Option as CoapOption
+from   gcoaptest.histogram import Histogram
+from   gcoaptest.profiler import Profiler
+
 log = logging.getLogger(__name__)
 
 VERSION = '0.1'
 
+# Observe sequence numbers are 24 bits; see RFC 7641, sec. 3.4
+_OBSERVE_MOD  = 1 << 24
+_OBSERVE_HALF = 1 << 23
+
+# Uri-Path for the short path names used in commands; any other name is used
+# as the path itself
+PATHS = {
+    'core':   '.well-known/core',
+    'stats':  'cli/stats',
+    'stats2': 'cli/stats2',
+}
+
+class Registration(object):
+    '''An Observe registration made by the observer, with its notification
+    metrics. Times in the histograms are in microseconds.
+
+    Attributes:
+        :path:        string Short name for the observed path, like 'stats'
+        :token:       bytes Token used to register
+        :client:      Transport engine that registered, and receives the
+                      notifications
+        :load:        boolean True if registered in load mode; notifications
+                      are counted but not printed
+        :notifCount:  int Count of notifications received, not including
+                      duplicates
+        :lastObserve: int Observe option value from the latest notification,
+                      or None
+        :lastArrival: float Time of the latest notification, or None
+        :sentAt:      float Time the registration request was sent
+        :rtt:         int Microseconds from the registration request to the
+                      first response, or None
+        :interArrival: Histogram Time between notifications
+        :ackDelay:    Histogram Time from receiving a CON notification to
+                      sending its ACK
+        :gaps:        int Count of Observe sequence numbers skipped
+        :reorders:    int Count of notifications older than a previous one
+        :duplicates:  int Count of CON notifications received again, with the
+                      same message ID, so the server did not see the ACK
+        :_lastMessageId: int Message ID of the latest CON notification
+    '''
+    __slots__ = ('path', 'token', 'client', 'load', 'notifCount', 'lastObserve',
+                 'lastArrival', 'sentAt', 'rtt', 'interArrival', 'ackDelay',
+                 'gaps', 'reorders', 'duplicates', '_lastMessageId')
+
+    def __init__(self, path, token, client, load=False):
+        self.path         = path
+        self.token        = token
+        self.client       = client
+        self.load         = load
+        self.notifCount   = 0
+        self.lastObserve  = None
+        self.lastArrival  = None
+        self.sentAt       = time.time()
+        self.rtt          = None
+        self.interArrival = Histogram()
+        self.ackDelay     = Histogram()
+        self.gaps         = 0
+        self.reorders     = 0
+        self.duplicates   = 0
+        self._lastMessageId = None
+
+    def recordNotification(self, now, observe, messageId, confirmable):
+        '''Updates metrics for a notification, or the response to the
+        registration.
+
+        :param observe: int Observe option value, or None
+        :return: boolean True if a duplicate of the previous CON notification
+        '''
+        if confirmable:
+            if messageId == self._lastMessageId:
+                self.duplicates += 1
+                return True
+            self._lastMessageId = messageId
+
+        self.notifCount += 1
+        if self.lastArrival is None:
+            self.rtt = int((now - self.sentAt) * 1000000)
+        else:
+            self.interArrival.record((now - self.lastArrival) * 1000000)
+        self.lastArrival = now
+
+        if observe is not None:
+            if self.lastObserve is not None:
+                diff = (observe - self.lastObserve) % _OBSERVE_MOD
+                if diff == 0 or diff > _OBSERVE_HALF:
+                    self.reorders += 1
+                    return False
+                self.gaps += diff - 1
+            self.lastObserve = observe
+        return False
+
+    def statsText(self):
+        '''Returns a one line summary of the metrics.'''
+        return '{0} {1}: {2}'.format(_hex(self.token), self.path,
+                                     _metricsText([self]))
+
+
+def _hex(data):
+    return ''.join('{0:02x}'.format(b) for b in bytearray(data))
+
+def _metricsText(registrations):
+    '''Returns the combined metrics for registrations as text; times in ms.'''
+    interArrival = Histogram()
+    ackDelay     = Histogram()
+    rtt          = Histogram()
+    for r in registrations:
+        interArrival.add(r.interArrival)
+        ackDelay.add(r.ackDelay)
+        if r.rtt is not None:
+            rtt.record(r.rtt)
+
+    def ms(histogram, percent):
+        value = histogram.percentile(percent)
+        return '-' if value is None else '{0:.3f}'.format(value / 1000.0)
+
+    return ('notifs {0}; gaps {1}; reorders {2}; dups {3}; '
+            'interval p50/p99/max {4}/{5}/{6}; '
+            'ack delay p50/p99 {7}/{8}; reg rtt p50/max {9}/{10}').format(
+            sum(r.notifCount for r in registrations),
+            sum(r.gaps for r in registrations),
+            sum(r.reorders for r in registrations),
+            sum(r.duplicates for r in registrations),
+            ms(interArrival, 50), ms(interArrival, 99), ms(interArrival, 100),
+            ms(ackDelay, 50), ms(ackDelay, 99), ms(rtt, 50), ms(rtt, 100))
+
+
 class GcoapObserver(object):
     '''Reads statistics from a RIOT gcoap URL.
 
     Attributes:
         :_hostuple: tuple IPv6 address tuple for message destination
-        :_client:    CoapClient Provides CoAP client for server queries
-        :_registeredPaths: string:bytearray, where the key is the short name
-                           for the path, and the value is the token used to
-                           register for Observe notifications for the path
-        :_server:    CoapServer Provides CoAP server for remote client commands
+        :_client:    Transport engine; provides CoAP client for server queries
+        :_registrations: bytes:Registration, where the key is the token used
+                         to register for Observe notifications
+        :_tokensByPath: string:set, where the key is the short name for the
+                        path, and the value is the set of tokens registered
+                        for the path
+        :_server:    Transport engine; provides CoAP server for remote client
+                     commands, on the same networking loop as _client
+        :_loadClients: list of transport engines for load mode observers;
+                       the first is _client, and the others listen on
+                       ephemeral ports on the same networking loop
+        :_profiler:  Profiler for the networking loop
+        :_nextLoadToken: int Sequence for load mode tokens, which are four
+                         bytes long, so they never collide with the two byte
+                         tokens for single registrations
         :_notificationAction: If None, sends a normal 'ACK' response for a
                               confirmable notification.
                               If 'reset', sends a 'RST' response, which directs
@@ -65,55 +224,121 @@ class GcoapObserver(object):
 
     Usage:
         #. sr = StatsReader(hostAddr, hostPort, sourcePort, query)  -- Create instance
-        #. sr.start() -- Starts asyncore networking loop
+        #. sr.start() -- Starts networking loop
         #. sr.close() -- Cleanup
     '''
-    def __init__(self, hostAddr, hostPort, sourcePort):
+    def __init__(self, hostAddr, hostPort, sourcePort, backend=engine.DEFAULT_BACKEND):
         '''Initializes on destination host and source port.
 
         Also uses sourcePort + 1 for the server to receive commands.
+
+        :param backend: string Transport engine name, from engine.BACKENDS
         '''
         self._hostTuple  = (hostAddr, hostPort)
-        self._client     = CoapClient(sourcePort=sourcePort, dest=self._hostTuple)
+        self._backend    = backend
+        self._client     = engine.createEngine(backend, sourcePort)
         self._client.registerForResponse(self._responseClient)
 
-        self._server     = CoapServer(port=sourcePort+1)
+        self._server     = engine.createEngine(backend, sourcePort+1,
+                                               sharedWith=self._client)
+        self._server.registerResource('/stats', self._getStats)
+        self._server.registerResource('/load', self._getLoad)
+        self._server.registerResource('/load/reg', self._postLoadReg,
+                                      methods=(RequestCode.POST,))
+        self._server.registerResource('/load/dereg', self._postLoadDereg,
+                                      methods=(RequestCode.POST,))
+        self._server.registerResource('/prof', self._postProfile,
+                                      methods=(RequestCode.POST,))
         self._server.registerForResourcePost(self._postServerResource)
 
-        self._registeredPaths = {}
+        self._registrations = {}
+        self._tokensByPath  = {}
+        self._loadClients   = [self._client]
+        self._nextLoadToken = 0
         self._notificationAction = None
+        self._profiler      = Profiler('observer')
 
     def _responseClient(self, message):
         '''Reads a response to a request
+
+        :param message: coap.HeaderView Response or notification; decodes the
+                        Observe option only when asked
         '''
-        log.debug('Running client response handler')
-        
-        prefix   = '0' if message.codeDetail < 10 else ''
-        obsList  = message.findOption(OptionType.Observe)
-        obsValue = '<none>' if len(obsList) == 0 else obsList[0].value
-        obsText  = 'len: {0}; val: {1}'.format(len(obsList), obsValue)
-        
-        print('Response code: {0}.{1}{2}; Observe {3}'.format(message.codeClass, prefix,
-                                                              message.codeDetail, obsText))
+        now          = time.time()
+        registration = self._registrations.get(message.token)
+        obsList      = message.findOption(OptionType.Observe)
+
+        if not (registration and registration.load):
+            log.debug('Running client response handler')
+            prefix   = '0' if message.codeDetail < 10 else ''
+            obsValue = '<none>' if len(obsList) == 0 else obsList[0].value
+            obsText  = 'len: {0}; val: {1}'.format(len(obsList), obsValue)
 
-        if message.token in self._registeredPaths.values():
-            if message.messageType == MessageType.CON:
+            print('Response code: {0}.{1}{2}; Observe {3}'.format(message.codeClass, prefix,
+                                                                  message.codeDetail, obsText))
+
+        if registration:
+            isCon = message.messageType == MessageType.CON
+            registration.recordNotification(now, obsList[0].value if obsList else None,
+                                            message.messageId, isCon)
+
+            if isCon:
                 if self._notificationAction == 'reset':
-                    self._sendNotifResponse(message, 'reset')
+                    self._sendNotifResponse(message, 'reset', registration.client)
                 elif self._notificationAction == None:
-                    self._sendNotifResponse(message, 'ack')
+                    self._sendNotifResponse(message, 'ack', registration.client)
+                    registration.ackDelay.record((time.time() - now) * 1000000)
                 else:
                     # no response when _notificationAction is 'ignore'
                     pass
 
             elif message.messageType == MessageType.NON:
                 if self._notificationAction == 'reset_non':
-                    self._sendNotifResponse(message, 'reset')
+                    self._sendNotifResponse(message, 'reset', registration.client)
+
+    def _getStats(self, resource):
+        '''Reports notification metrics; see module docs.'''
+        resource.type = 'string'
+        if resource.pathQuery:
+            registration = None
+            for r in self._registrations.values():
+                if _hex(r.token) == resource.pathQuery.lower():
+                    registration = r
+                    break
+            if not registration:
+                raise NotImplementedError()
+            resource.value = registration.statsText()
+            return
+
+        registrations = list(self._registrations.values())
+        lines = ['all {0}: {1}'.format(len(registrations), _metricsText(registrations))]
+        lines.extend(r.statsText() for r in registrations if not r.load)
+        resource.value = '\n'.join(lines)
+
+    def _getLoad(self, resource):
+        '''Summarizes notifications received by load mode observers.'''
+        resource.type  = 'string'
+        resource.value = self.loadSummary()
+
+    def _postLoadReg(self, resource):
+        '''Registers load mode observers; payload is '<path> <count> [<ports>]'.
+        '''
+        fields = resource.value.split()
+        ports  = int(fields[2]) if len(fields) > 2 else 1
+        self.registerLoad(fields[0], int(fields[1]), ports)
+
+    def _postLoadDereg(self, resource):
+        self.deregisterLoad()
+
+    def _postProfile(self, resource):
+        filename = self._profiler.command(resource.value)
+        if filename:
+            print('Wrote profile {0}'.format(filename))
 
     def _postServerResource(self, resource):
         '''Reads a command
         '''
-        log.debug('Resource path is {0}'.format(resource.path))
+        log.debug('Resource path is %s', resource.path)
         
         observeAction = None
         observePath   = None
@@ -145,16 +370,72 @@ class GcoapObserver(object):
             print('Got ping post')
 
         if observePath:
-            if observeAction == 'reg' and resource.pathQuery:
+            if resource.pathQuery:
                 self._query(observeAction, observePath, tokenText=resource.pathQuery)
-            else:
+            elif observeAction == 'reg':
                 self._query(observeAction, observePath)
+            else:
+                for token in list(self._tokensByPath.get(observePath, ())):
+                    self._query(observeAction, observePath, token=token,
+                                client=self._registrations[token].client)
 
-    def _query(self, observeAction, observePath, tokenText=None):
+    def _addRegistration(self, path, token, client, load=False):
+        '''Records a registration; a token registered for another path moves to
+        this path.
+        '''
+        self._removeRegistration(token)
+        self._registrations[token] = Registration(path, token, client, load)
+        self._tokensByPath.setdefault(path, set()).add(token)
+
+    def _removeRegistration(self, token):
+        registration = self._registrations.pop(token, None)
+        if registration:
+            tokens = self._tokensByPath[registration.path]
+            tokens.discard(token)
+            if not tokens:
+                del self._tokensByPath[registration.path]
+
+    def registerLoad(self, path, count, portCount=1):
+        '''Registers count load mode observers for a path, with distinct tokens,
+        spread round robin over portCount source ports. All ports share the
+        networking loop.
+
+        :param path: string Short name from PATHS, or a path like 'cli/stats'
+        '''
+        while len(self._loadClients) < portCount:
+            client = engine.createEngine(self._backend, 0, sharedWith=self._client)
+            client.registerForResponse(self._responseClient)
+            self._loadClients.append(client)
+
+        for i in range(count):
+            self._nextLoadToken = (self._nextLoadToken + 1) & 0xFFFFFFFF
+            token  = struct.pack('!I', self._nextLoadToken)
+            client = self._loadClients[i % portCount]
+            self._query('reg', path, token=token, client=client, load=True)
+        log.info('Registered %s load observers for %s on %s port(s)',
+                 count, path, portCount)
+
+    def deregisterLoad(self):
+        '''Deregisters all load mode observers.'''
+        for registration in list(self._registrations.values()):
+            if registration.load:
+                self._query('dereg', registration.path, token=registration.token,
+                            client=registration.client)
+
+    def loadSummary(self):
+        '''Returns a one line text summary of load mode notifications.'''
+        counts = [r.notifCount for r in self._registrations.values() if r.load]
+        if not counts:
+            return 'observers: 0'
+        return 'observers: {0}; notifications: {1}; min: {2}; max: {3}; silent: {4}'.format(
+               len(counts), sum(counts), min(counts), max(counts),
+               counts.count(0))
+
+    def _query(self, observeAction, observePath, tokenText=None, token=None,
+               client=None, load=False):
         '''Runs the reader's query.
 
-        Uses a randomly generated two byte token, or the provided string encoded
-        bytes.
+        Uses a randomly generated two byte token, or the provided token.
 
         :param observeAction: string -- reg (register), dereg (deregister);
                               triggers inclusion of Observe option
@@ -162,7 +443,15 @@ class GcoapObserver(object):
         :param tokenText: string String encoding of token bytes; must by an
                                  even-numbered length of characters like '05'
                                  or '05a6'
+        :param token: bytes Token, as an alternative to tokenText
+        :param client: Transport engine to send from; defaults to _client
+        :param load: boolean True for a load mode registration
         '''
+        client = client or self._client
+        if tokenText:
+            token = bytes(bytearray(int(tokenText[2*i:2*(i+1)], base=16)
+                                    for i in range(len(tokenText) // 2)))
+
         # create message
         msg             = CoapMessage(self._hostTuple)
         msg.messageType = MessageType.NON
@@ -170,78 +459,71 @@ class GcoapObserver(object):
         msg.codeDetail  = RequestCode.GET
         msg.messageId   = random.randint(0, 65535)
 
-        if observePath == 'core':
-            msg.addOption( CoapOption(OptionType.UriPath, '.well-known') )
-            msg.addOption( CoapOption(OptionType.UriPath, 'core') )
-        elif observePath == 'stats':
-            msg.addOption( CoapOption(OptionType.UriPath, 'cli') )
-            msg.addOption( CoapOption(OptionType.UriPath, 'stats') )
-        elif observePath == 'stats2':
-            msg.addOption( CoapOption(OptionType.UriPath, 'cli') )
-            msg.addOption( CoapOption(OptionType.UriPath, 'stats2') )
+        for segment in PATHS.get(observePath, observePath).strip('/').split('/'):
+            msg.addOption( CoapOption(OptionType.UriPath, segment) )
 
         if observeAction == 'reg':
             # register
             msg.addOption( CoapOption(OptionType.Observe, 0) )
-            if tokenText:
-                msg.tokenLength = len(tokenText) / 2
-                msg.token       = bytearray(msg.tokenLength)
-                for i in range(0, msg.tokenLength):
-                    msg.token[i] = int(tokenText[2*i:2*(i+1)], base=16)
+            if token:
+                msg.token = token
             else:
-                msg.tokenLength = 2
-                msg.token       = bytearray(2)
-                msg.token[0] = random.randint(0, 255)
-                msg.token[1] = random.randint(0, 255)
-            self._registeredPaths[observePath] = msg.token
+                msg.token = bytes(bytearray([random.randint(0, 255),
+                                             random.randint(0, 255)]))
+            self._addRegistration(observePath, msg.token, client, load)
         elif observeAction == 'dereg':
             # deregister
             msg.addOption( CoapOption(OptionType.Observe, 1) )
-            msg.tokenLength = 2
-            msg.token       = self._registeredPaths[observePath]
+            msg.token       = token
             # assume deregistration will succeed
-            del self._registeredPaths[observePath]
+            self._removeRegistration(token)
 
         # send message
         log.debug('Sending query')
-        self._client.send(msg)
+        client.send(msg)
 
-    def _sendNotifResponse(self, notif, responseType):
+    def _sendNotifResponse(self, notif, responseType, client):
         '''Sends an empty ACK or RST response to a notification
 
-        :param notif: CoapMessage Observe notification from server
+        :param notif: coap.HeaderView Observe notification from server
+        :param client: Transport engine that received the notification
         '''
         msg             = CoapMessage(notif.address)
         msg.codeClass   = CodeClass.Empty
         msg.codeDetail  = ClientResponseCode.Empty
         msg.messageId   = notif.messageId
-        msg.tokenLength = 0
-        msg.token       = None
 
         if responseType == 'reset':
             msg.messageType = MessageType.RST
         else:
             msg.messageType = MessageType.ACK
 
-        log.debug('Sending {0} for notification response'.format(responseType))
-        self._client.send(msg)
+        log.debug('Sending %s for notification response', responseType)
+        client.send(msg)
 
-    def start(self):
+    def start(self, profile=False):
         '''Starts networking; returns when networking is stopped.
 
-        Only need to start client, which automatically starts server, too.
+        Only need to start client, which shares its loop with the server.
+
+        :param profile: boolean If True, profiles until close() or a /prof
+                        command
         '''
+        if profile:
+            self._profiler.start()
         self._client.start()
 
     def close(self):
         '''Releases resources'''
-        self._client.close()
+        self._profiler.stop()
+        if len(self._loadClients) > 1 or self._nextLoadToken:
+            print('Load mode {0}'.format(self.loadSummary()))
+        self._server.close()
+        for client in reversed(self._loadClients):
+            client.close()
 
 # Start the observer
 if __name__ == '__main__':
-    formattedPath = '\n\t'.join(str(p) for p in sys.path)
-    log.info('Running gcoap observer with sys.path:\n\t{0}'.format(formattedPath))
-
     from optparse import OptionParser
 
     # read command line
@@ -249,15 +531,30 @@ if __name__ == '__main__':
     parser.add_option('-a', type='string', dest='hostAddr')
     parser.add_option('-p', type='int', dest='hostPort', default=COAP_PORT)
     parser.add_option('-s', type='int', dest='sourcePort', default=COAP_PORT)
+    parser.add_option('-b', type='choice', dest='backend', choices=engine.BACKENDS,
+                      default=engine.DEFAULT_BACKEND)
+    parser.add_option('-o', type='string', dest='loadPath')
+    parser.add_option('-n', type='int', dest='loadCount', default=1)
+    parser.add_option('-k', type='int', dest='loadPorts', default=1)
+    parser.add_option('--profile', action='store_true', dest='profile', default=False)
+    parser.add_option('--log-level', type='choice', dest='logLevel',
+                      choices=logconfig.LEVELS, default='debug')
 
     (options, args) = parser.parse_args()
+
+    logconfig.configureLogging('observer.log', options.logLevel)
+    formattedPath = '\n\t'.join(str(p) for p in sys.path)
+    log.info('Running gcoap observer with sys.path:\n\t%s', formattedPath)
     
     reader   = None
     observer = None
     try:
-        observer = GcoapObserver(options.hostAddr, options.hostPort, options.sourcePort)
+        observer = GcoapObserver(options.hostAddr, options.hostPort, options.sourcePort,
+                                  options.backend)
+        if options.loadPath:
+            observer.registerLoad(options.loadPath, options.loadCount, options.loadPorts)
         print('Starting gcoap observer')
-        observer.start()
+        observer.start(options.profile)
     except KeyboardInterrupt:
         pass
     except:
@@ -267,5 +564,6 @@ if __name__ == '__main__':
         if observer:
             observer.close()
             log.info('gcoap observer closed')
+        logconfig.stopLogging()
 
 
@@ -0,0 +1,250 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Request pacing for a transport engine, to emulate a constrained upstream when
+many clients share one tester. A request must take a token from the global
+token bucket, and from its client's bucket, keyed by host as normalized by
+coap.normalizeHost(), before it is handled.
+
+An excess request waits in a bounded FIFO queue until both buckets have a
+token. If the queue is full, or has no room at all, the request is answered
+with 5.03 Service Unavailable, and a Max-Age of the seconds until a token is
+expected, as a client's hint to retry, from RFC 7252, sec. 5.9.3.5. Once a
+request is queued, later requests queue behind it, so a client limited by its
+own bucket also holds up the others, like a single slow upstream.
+
+Pacing follows deduplication, so a retransmission does not take a token. The
+queue is serviced from the engine's timers. Requests to exempt paths, like
+configuration, always are admitted, so pacing may be changed under load.
+
+A configuration is text of name=value fields, like:
+
+    rate=100 burst=10 client=5 clientburst=2 queue=50
+
+A rate of 0 leaves that bucket unlimited.
+'''
+import collections
+import logging
+import math
+import time
+from   gcoaptest import coap
+from   gcoaptest.histogram import Histogram
+
+log = logging.getLogger(__name__)
+
+# Most client buckets kept; beyond this, full buckets are discarded, since a
+# full bucket is the same as a new one. If none are full, all are discarded.
+MAX_CLIENTS = 10000
+
+_FIELDS = ('rate', 'burst', 'client', 'clientburst', 'queue')
+
+
+class TokenBucket(object):
+    '''Tokens refilled at a rate up to a burst size.
+
+    Attributes:
+        :rate:   float Tokens added per second
+        :burst:  float Most tokens held
+        :tokens: float Tokens held at stamp
+        :stamp:  float Time of the latest refill
+    '''
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate   = rate
+        self.burst  = burst
+        self.tokens = burst
+        self.stamp  = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp  = now
+
+    def waitSecs(self):
+        '''Returns seconds until a token is available, as of stamp.'''
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class Pacer(object):
+    '''Admits requests at the configured rates, and queues or rejects the
+    excess.
+
+    Attributes:
+        :rate:        float Global requests per second, or 0 for unlimited
+        :burst:       float Global bucket size
+        :clientRate:  float Requests per second for each client, or 0 for
+                      unlimited
+        :clientBurst: float Client bucket size
+        :queueLimit:  int Most requests queued; 0 rejects all excess
+        :queued:      int Requests queued
+        :rejected:    int Requests answered with 5.03
+        :maxDepth:    int Highest queue depth
+        :waitTime:    Histogram Microseconds each queued request waited
+        :_queue:      deque of (request, time queued)
+        :_global:     TokenBucket, or None if unlimited
+        :_clients:    host:TokenBucket for each client
+        :_timer:      Timer entry to service the queue, or None
+        :_exempt:     tuple of Uri-Path prefixes, as segments tuples, always
+                      admitted
+
+    Usage:
+        #. pacer = Pacer(engine, exempt=('/cf',))
+        #. pacer.configure('rate=100 queue=50')
+    '''
+    def __init__(self, engine, exempt=(), clock=time.time):
+        self._engine     = engine
+        self._exempt     = tuple(tuple(path.strip('/').split('/')) for path in exempt)
+        self._clock      = clock
+        self.rate        = 0.0
+        self.burst       = 1.0
+        self.clientRate  = 0.0
+        self.clientBurst = 1.0
+        self.queueLimit  = 0
+        self.queued      = 0
+        self.rejected    = 0
+        self.maxDepth    = 0
+        self.waitTime    = Histogram()
+        self._queue      = collections.deque()
+        self._global     = None
+        self._clients    = {}
+        self._timer      = None
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def configure(self, text):
+        '''Sets the rates from name=value fields in text; a field not given
+        takes its default. Empty text, or no rates, turns off pacing, and
+        handles any queued requests at once.
+
+        :raises ValueError: For an unknown field, or a negative value
+        '''
+        values = {'rate': 0.0, 'burst': 1.0, 'client': 0.0, 'clientburst': 1.0,
+                  'queue': 0}
+        for field in text.split():
+            name, sep, value = field.partition('=')
+            if name not in _FIELDS:
+                raise ValueError('Unknown rate field: {0}'.format(field))
+            values[name] = int(value) if name == 'queue' else float(value)
+            if values[name] < 0:
+                raise ValueError('Negative rate field: {0}'.format(field))
+
+        if self._timer:
+            self._engine.timers.cancel(self._timer)
+            self._timer = None
+        now              = self._clock()
+        self.rate        = values['rate']
+        self.burst       = max(values['burst'], 1.0)
+        self.clientRate  = values['client']
+        self.clientBurst = max(values['clientburst'], 1.0)
+        self.queueLimit  = values['queue']
+        self._global     = TokenBucket(self.rate, self.burst, now) if self.rate else None
+        self._clients    = {}
+        log.info('Pacing: rate %s/%s, client %s/%s, queue %s', self.rate, self.burst,
+                 self.clientRate, self.clientBurst, self.queueLimit)
+
+        if self.rate or self.clientRate:
+            self._engine.pacer = self
+            self._service()
+        else:
+            self._engine.pacer = None
+            while self._queue:
+                self._dispatch(*self._queue.popleft())
+
+    def admit(self, request):
+        '''Returns True if a request may be handled now. Otherwise queues the
+        request, to be handled later, or responds 5.03.
+        '''
+        if self._exempt:
+            segments = request.pathSegments()
+            for prefix in self._exempt:
+                if segments[:len(prefix)] == prefix:
+                    return True
+        now  = self._clock()
+        host = coap.normalizeHost(request.address[0])
+        if not self._queue and self._takeToken(host, now):
+            return True
+
+        if len(self._queue) < self.queueLimit:
+            self._queue.append((request, now))
+            self.queued  += 1
+            self.maxDepth = max(self.maxDepth, len(self._queue))
+            if not self._timer:
+                self._schedule(now)
+        else:
+            self.rejected += 1
+            maxAge = int(math.ceil(self._waitSecs(host, now)
+                                   + len(self._queue) / max(self.rate, self.clientRate)))
+            self._engine.respond(request, coap.CODE_SERVICE_UNAVAILABLE,
+                                 coap.encodeOptions([coap.Option(coap.OPTION_MAX_AGE,
+                                                                 max(maxAge, 1))]))
+        return False
+
+    def _clientBucket(self, host, now):
+        bucket = self._clients.get(host)
+        if bucket is None:
+            if len(self._clients) >= MAX_CLIENTS:
+                for key, old in list(self._clients.items()):
+                    old.refill(now)
+                    if old.tokens >= old.burst:
+                        del self._clients[key]
+                if len(self._clients) >= MAX_CLIENTS:
+                    self._clients.clear()
+            bucket = TokenBucket(self.clientRate, self.clientBurst, now)
+            self._clients[host] = bucket
+        return bucket
+
+    def _takeToken(self, host, now):
+        '''Takes a token from the global and client buckets, if both have one.'''
+        globalBucket = self._global
+        if globalBucket:
+            globalBucket.refill(now)
+            if globalBucket.tokens < 1:
+                return False
+        if self.clientRate:
+            bucket = self._clientBucket(host, now)
+            bucket.refill(now)
+            if bucket.tokens < 1:
+                return False
+            bucket.tokens -= 1
+        if globalBucket:
+            globalBucket.tokens -= 1
+        return True
+
+    def _waitSecs(self, host, now):
+        '''Returns seconds until both buckets for a host have a token.'''
+        wait = 0.0
+        if self._global:
+            self._global.refill(now)
+            wait = self._global.waitSecs()
+        if self.clientRate:
+            bucket = self._clientBucket(host, now)
+            bucket.refill(now)
+            wait = max(wait, bucket.waitSecs())
+        return wait
+
+    def _schedule(self, now):
+        request, queuedAt = self._queue[0]
+        host        = coap.normalizeHost(request.address[0])
+        self._timer = self._engine.timers.schedule(self._waitSecs(host, now),
+                                                   self._service)
+
+    def _service(self):
+        '''Handles queued requests while tokens are available.'''
+        self._timer = None
+        now = self._clock()
+        while self._queue:
+            request, queuedAt = self._queue[0]
+            if not self._takeToken(coap.normalizeHost(request.address[0]), now):
+                self._schedule(now)
+                return
+            self._queue.popleft()
+            self._dispatch(request, queuedAt)
+
+    def _dispatch(self, request, queuedAt):
+        self.waitTime.record((self._clock() - queuedAt) * 1000000)
+        self._engine.dispatch(request)
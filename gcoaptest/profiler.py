@@ -0,0 +1,83 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Runtime profiling for the tester and observer applications. A Profiler runs
+cProfile over the networking loop, and is turned on and off by a command
+resource, so a running process may be profiled under load without a restart.
+When profiling stops, the stats are written to a file for pstats or snakeviz,
+along with a text summary of the top functions by cumulative time.
+'''
+import cProfile
+import logging
+import os
+import pstats
+
+log = logging.getLogger(__name__)
+
+# Functions listed in the text summary
+SUMMARY_LINES = 30
+
+
+class Profiler(object):
+    '''Turns cProfile on and off for the current thread.
+
+    Attributes:
+        :_prefix:  string Start of the stats filename, like 'tester'
+        :_profile: cProfile.Profile while profiling, otherwise None
+        :_runs:    int Count of profiling runs, for the filename
+    '''
+    def __init__(self, prefix):
+        self._prefix  = prefix
+        self._profile = None
+        self._runs    = 0
+
+    @property
+    def active(self):
+        return self._profile is not None
+
+    def start(self):
+        '''Starts profiling; no effect if already profiling.'''
+        if self._profile:
+            return
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        log.info('Profiling started')
+
+    def stop(self):
+        '''Stops profiling, and writes the stats.
+
+        :return: string Stats filename, or None if not profiling
+        '''
+        if not self._profile:
+            return None
+        profile       = self._profile
+        self._profile = None
+        profile.disable()
+
+        self._runs += 1
+        filename = '{0}-{1}-{2}.prof'.format(self._prefix, os.getpid(), self._runs)
+        profile.dump_stats(filename)
+        with open(filename[:-len('.prof')] + '.txt', 'w') as textFile:
+            stats = pstats.Stats(profile, stream=textFile)
+            stats.sort_stats('cumulative').print_stats(SUMMARY_LINES)
+        log.info('Profiling stopped; wrote %s', filename)
+        return filename
+
+    def command(self, text):
+        '''Runs a command from a resource: 'on' starts, 'off' stops, and an
+        empty command toggles profiling.
+
+        :return: string Stats filename if stopped, otherwise None
+        :raises ValueError: For an unknown command
+        '''
+        text = text.strip().lower()
+        if text == 'on' or (not text and not self.active):
+            self.start()
+        elif text == 'off' or not text:
+            return self.stop()
+        else:
+            raise ValueError('Unknown profile command: {0}'.format(text))
+        return None
@@ -0,0 +1,259 @@
+#!/usr/bin/python
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Replays a capture of CoAP requests against a GcoapTester or a RIOT node,
+keeping the original time between requests, or scaled by a speed multiplier.
+Writes an outcome record for each request.
+
+The capture is JSON lines, one request per line, like:
+   ``{"t": 12.5, "method": "POST", "path": "/cf/delay", "payload": "1"}``
+
+   | t -- float Seconds; only the difference from the first record is used.
+   |      If absent, the request follows the previous one immediately.
+   | method -- GET, PUT, or POST; defaults to GET
+   | path -- Request path; a line without a path is skipped
+   | query -- Uri-Query value, optional
+   | payload -- Request payload, optional
+   | con -- boolean True for a confirmable request; defaults to false
+
+Outcome records, in order of completion, are like:
+   ``{"seq": 3, "t": 1.25, "sent": 1.2504, "method": "GET", "path": "/ver",
+   "outcome": "ok", "code": "2.05", "latencyMs": 0.31, "retransmits": 0}``
+
+where "t" is the scheduled and "sent" the actual offset from the start, and
+outcome is "ok", "lost", or "reset". Both files are streamed: the capture is read one
+line ahead of the send time, and only outstanding requests are kept, so
+memory use does not grow with the size of the capture.
+
+Options:
+   | -a <hostAddr> -- Host address
+   | -p <port> -- Host port; defaults to 5683
+   | -b <backend> -- Transport engine: asyncore, asyncio, or uvloop
+   | -i <file> -- Capture to replay; defaults to stdin
+   | -o <file> -- Outcome records; defaults to stdout
+   | -x <speed> -- Speed multiplier; 2 replays twice as fast. 0 replays as
+   |              fast as possible. Defaults to 1.
+   | -T <secs> -- Timeout; initial ACK timeout for a confirmable request
+
+Replay a capture against a local tester with:
+   ``$ PYTHONPATH=.. python -m gcoaptest.replay -a ::1 -i capture.jsonl -o out.jsonl``
+'''
+from   __future__ import print_function
+import json
+import logging
+import sys
+import time
+from   soscoap  import MessageType
+from   soscoap  import OptionType
+from   soscoap  import COAP_PORT
+from   gcoaptest import coap
+from   gcoaptest import engine
+from   gcoaptest import logconfig
+from   gcoaptest.loadgen import LoadGenerator, METHODS, TICK_SECS, formatSummary
+
+log = logging.getLogger(__name__)
+
+# Most encoded request tails to remember
+_MAX_TAILS = 256
+
+# Most requests sent by a _sendDue() call, so the loop still reads responses
+# and runs timers when the replay falls behind, or runs with no delay
+_MAX_SENDS = 64
+
+
+def readRecords(lines):
+    '''Yields the request records from JSON lines, skipping blank and invalid
+    lines, lines without a path, lines with a path, query, or payload that is
+    not a string, and lines with an unknown method or a non-numeric time.
+
+    :param lines: iterable of string, like a file
+    '''
+    for lineNum, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            log.warning('Skipping line %s; not JSON', lineNum)
+            continue
+        if not isinstance(record, dict) or 'path' not in record:
+            log.warning('Skipping line %s; no request path', lineNum)
+            continue
+        if not (isinstance(record['path'], str)
+                and all(isinstance(record.get(field) or '', str)
+                        for field in ('query', 'payload'))):
+            log.warning('Skipping line %s; path, query, or payload not a string',
+                        lineNum)
+            continue
+        if record.get('method', 'GET') not in METHODS:
+            log.warning('Skipping line %s; unknown method', lineNum)
+            continue
+        t = record.get('t')
+        if t is not None and (isinstance(t, bool) or not isinstance(t, (int, float))):
+            log.warning('Skipping line %s; time not a number', lineNum)
+            continue
+        yield record
+
+
+class Replayer(LoadGenerator):
+    '''Replays request records, and writes an outcome record for each.
+
+    Attributes:
+        :_records: iterator of request records
+        :_output:  file for outcome records
+        :_speed:   float Speed multiplier, or 0 for no delay
+        :_firstT:  float Time in the first record
+        :_lastT:   float Time in the latest record
+        :_tails:   tuple:bytes Encoded options and payload for recent requests
+        :_seq:     int Sequence number of the latest record
+    '''
+    def __init__(self, hostAddr, records, output, hostPort=COAP_PORT,
+                 backend=engine.DEFAULT_BACKEND, speed=1.0, timeout=2.0):
+        super(Replayer, self).__init__(hostAddr, hostPort, backend, timeout=timeout)
+        self._records = iter(records)
+        self._output  = output
+        self._speed   = speed
+        self._firstT  = None
+        self._lastT   = 0.0
+        self._tails   = {}
+        self._seq     = 0
+
+    def run(self):
+        '''Replays all records, then waits for outstanding requests to complete
+        or time out. Returns when done.
+        '''
+        self._sending = True
+        self._started = time.time()
+        self._sendDue(self._nextRecord())
+        if self._sending or self._outstanding:
+            self._client.start()
+
+    def _nextRecord(self):
+        '''Returns the next record with its offset from the start, or None.'''
+        record = next(self._records, None)
+        if record is None:
+            return None
+        t = record.get('t')
+        if t is None:
+            t = self._lastT
+        elif self._firstT is None:
+            self._firstT = t
+        self._lastT = t
+        offset = (t - (self._firstT or 0.0)) / self._speed if self._speed else 0.0
+        return record, offset
+
+    def _sendDue(self, item):
+        '''Sends a record and those after it that are due within TICK_SECS,
+        then schedules the next one. Sending a little early saves a loop
+        wakeup for each request at high rates. Sends at most _MAX_SENDS, and
+        schedules the rest at once.
+        '''
+        sends = 0
+        while item:
+            record, offset = item
+            wait = offset - (time.time() - self._started)
+            if wait > TICK_SECS:
+                self._timers.schedule(wait, self._sendDue, item)
+                return
+            if sends >= _MAX_SENDS:
+                self._timers.schedule(0, self._sendDue, item)
+                return
+            self._sendRecord(record, offset)
+            sends += 1
+            item = self._nextRecord()
+        self._stopSending()
+
+    def _sendRecord(self, record, offset):
+        method  = record.get('method', 'GET')
+        key     = (record['path'], record.get('query'), record.get('payload'))
+        tail    = self._tails.get(key)
+        if tail is None:
+            if len(self._tails) >= _MAX_TAILS:
+                self._tails.clear()
+            tail = self._tails[key] = _encodeTail(*key)
+
+        self._seq += 1
+        context = {'seq': self._seq, 't': round(offset, 6),
+                   'sent': round(time.time() - self._started, 6),
+                   'method': method, 'path': record['path']}
+        self._sendRequest(METHODS[method], tail,
+                          MessageType.CON if record.get('con') else MessageType.NON,
+                          context)
+
+    def _completed(self, exchange, response):
+        outcome = exchange.context
+        if response is None:
+            outcome['outcome'] = 'lost'
+        elif response.messageType == MessageType.RST:
+            outcome['outcome'] = 'reset'
+        else:
+            outcome['outcome']   = 'ok'
+            outcome['code']      = '{0}.{1:02d}'.format(response.codeClass,
+                                                        response.codeDetail)
+            outcome['latencyMs'] = round((time.time() - exchange.firstSent) * 1000, 3)
+        outcome['retransmits'] = exchange.retries
+        self._output.write(json.dumps(outcome, sort_keys=True) + '\n')
+
+        super(Replayer, self)._completed(exchange, response)
+
+
+def _encodeTail(path, query, payload):
+    '''Returns the encoded options and payload for a request.'''
+    options = [coap.Option(OptionType.UriPath, segment)
+               for segment in path.strip('/').split('/') if segment]
+    if query:
+        options.append(coap.Option(coap.OPTION_URI_QUERY, query))
+    tail = coap.encodeOptions(options)
+    if payload:
+        tail += b'\xFF' + payload.encode('utf-8')
+    return tail
+
+# Run the replayer
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    # read command line
+    parser = OptionParser()
+    parser.add_option('-a', type='string', dest='hostAddr')
+    parser.add_option('-p', type='int', dest='hostPort', default=COAP_PORT)
+    parser.add_option('-b', type='choice', dest='backend', choices=engine.BACKENDS,
+                      default=engine.DEFAULT_BACKEND)
+    parser.add_option('-i', type='string', dest='inFile')
+    parser.add_option('-o', type='string', dest='outFile')
+    parser.add_option('-x', type='float', dest='speed', default=1.0)
+    parser.add_option('-T', type='float', dest='timeout', default=2.0)
+    parser.add_option('--log-level', type='choice', dest='logLevel',
+                      choices=logconfig.LEVELS, default='info')
+
+    (options, args) = parser.parse_args()
+    if not options.hostAddr:
+        parser.error('host address (-a) required')
+
+    logconfig.configureLogging('replay.log', options.logLevel)
+    inFile   = open(options.inFile) if options.inFile else sys.stdin
+    outFile  = open(options.outFile, 'w') if options.outFile else sys.stdout
+    replayer = None
+    status   = 0
+    try:
+        replayer = Replayer(options.hostAddr, readRecords(inFile), outFile,
+                            options.hostPort, options.backend, options.speed,
+                            options.timeout)
+        replayer.run()
+    except KeyboardInterrupt:
+        pass
+    except:
+        log.exception('Catch-all handler for replayer')
+        print('\nAborting; see log for exception.', file=sys.stderr)
+        status = 1
+    finally:
+        if outFile is not sys.stdout:
+            outFile.close()
+        if replayer and replayer.sent:
+            print(formatSummary(replayer.summary()), file=sys.stderr)
+        logconfig.stopLogging()
+    sys.exit(status)
@@ -0,0 +1,207 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Mutable configuration state for GcoapTester. LocalState serves a single
+process. SharedState keeps the state in a small shared memory block, so tester
+worker processes on the same port see a consistent configuration.
+
+Configuration is kept for each client, by host, so concurrent test sessions
+from different hosts do not affect each other. The client table is a flat
+array of longs, set associative like a CPU cache: a host hashes to a set of
+CLIENT_WAYS slots, and a new client replaces the least recently used slot in
+its set when the set is full. So a lookup scans a few slots, and memory is
+fixed at CLIENT_SETS * CLIENT_WAYS clients.
+
+A client has a slot only while it has configuration; a slot is freed when its
+delay and /ver ignores both return to zero. A client without a slot has the
+defaults. While no client has configuration, a lookup is a single read.
+'''
+import array
+import multiprocessing
+import time
+import zlib
+
+# Sets and slots per set in the client table
+CLIENT_SETS = 256
+CLIENT_WAYS = 8
+
+# Fields of a client slot, as longs
+_KEY         = 0
+_DELAY       = 1
+_VER_IGNORES = 2
+_USED        = 3
+_SLOT_LONGS  = 4
+
+# Header of the block, as longs
+_VERSION   = 0
+_EVICTIONS = 1
+_CLIENTS   = 2
+_TABLE     = 3
+_TABLE_LONGS = CLIENT_SETS * CLIENT_WAYS * _SLOT_LONGS
+
+
+def clientKey(host):
+    '''Returns a stable, non-zero key for a host, the same in every process,
+    unlike hash(). Fits a 64-bit long.
+    '''
+    data = host.encode('utf-8')
+    # crc32 in the low bits, which select the set
+    return ((zlib.adler32(data) & 0xFFFFFFFF) << 30
+            ^ (zlib.crc32(data) & 0xFFFFFFFF)) or 1
+
+
+class _NoLock(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class _State(object):
+    '''Tester state in a flat array of longs, as laid out by the module
+    constants. A subclass provides the array and its lock.
+
+    Reads go to the raw array without the lock. Writes take the lock, so a
+    read-modify-write like takeVerIgnore() is atomic across workers. A read
+    also marks the client's slot as used, without the lock; a lost update
+    only makes eviction less exact.
+
+    Attributes:
+        :_raw:  array of longs
+        :_lock: Lock for writes
+    '''
+    @property
+    def version(self):
+        '''int Incremented on a configuration change'''
+        return self._raw[_VERSION]
+
+    @property
+    def evictions(self):
+        '''int Clients evicted to make room for another'''
+        return self._raw[_EVICTIONS]
+
+    @property
+    def clientCount(self):
+        '''int Clients with configuration'''
+        return self._raw[_CLIENTS]
+
+    def _find(self, key):
+        '''Returns the index of the slot for key, or -1.'''
+        raw   = self._raw
+        start = _TABLE + (key % CLIENT_SETS) * CLIENT_WAYS * _SLOT_LONGS
+        for i in range(start, start + CLIENT_WAYS * _SLOT_LONGS, _SLOT_LONGS):
+            if raw[i] == key:
+                return i
+        return -1
+
+    def _read(self, host, field):
+        if not self._raw[_CLIENTS]:
+            return 0
+        slot = self._find(clientKey(host))
+        if slot < 0:
+            return 0
+        self._raw[slot + _USED] = int(time.time())
+        return self._raw[slot + field]
+
+    def _write(self, host, field, value):
+        '''Sets a field for a host, with the lock held. Allocates a slot,
+        evicting the least recently used in the set if full, or frees the
+        slot if the configuration returns to the defaults.
+        '''
+        raw  = self._raw
+        key  = clientKey(host)
+        slot = self._find(key)
+        if slot < 0:
+            if not value:
+                return
+            start = _TABLE + (key % CLIENT_SETS) * CLIENT_WAYS * _SLOT_LONGS
+            slot  = min(range(start, start + CLIENT_WAYS * _SLOT_LONGS, _SLOT_LONGS),
+                        key=lambda i: (raw[i + _KEY] != 0, raw[i + _USED]))
+            if raw[slot + _KEY]:
+                raw[_EVICTIONS] += 1
+            else:
+                raw[_CLIENTS] += 1
+            for i in range(slot, slot + _SLOT_LONGS):
+                raw[i] = 0
+            raw[slot + _KEY] = key
+        raw[slot + field] = value
+        raw[slot + _USED] = int(time.time())
+        if not raw[slot + _DELAY] and not raw[slot + _VER_IGNORES]:
+            raw[slot + _KEY] = 0
+            raw[_CLIENTS]   -= 1
+
+    def isConfigured(self, host):
+        '''Returns True if a client has any configuration.'''
+        return bool(self._raw[_CLIENTS]) and self._find(clientKey(host)) >= 0
+
+    def delay(self, host):
+        '''Returns the seconds to delay a response to a client.'''
+        return self._read(host, _DELAY)
+
+    def verIgnores(self, host):
+        '''Returns the count of /ver requests to ignore from a client.'''
+        return self._read(host, _VER_IGNORES)
+
+    def setDelay(self, host, delay):
+        with self._lock:
+            self._write(host, _DELAY, delay)
+            self._raw[_VERSION] += 1
+
+    def setVerIgnores(self, host, count):
+        with self._lock:
+            self._write(host, _VER_IGNORES, count)
+            self._raw[_VERSION] += 1
+
+    def takeVerIgnore(self, host):
+        '''Consumes one /ver ignore for a client if any remain.
+
+        :return: True if the request should be ignored
+        '''
+        if self.verIgnores(host) <= 0:
+            return False
+        with self._lock:
+            remaining = self.verIgnores(host)
+            if remaining > 0:
+                self._write(host, _VER_IGNORES, remaining - 1)
+                return True
+        return False
+
+
+class LocalState(_State):
+    '''Tester state for a single process.'''
+    def __init__(self):
+        self._raw  = array.array('l', [0]) * (_TABLE + _TABLE_LONGS)
+        self._lock = _NoLock()
+
+
+class SharedState(_State):
+    '''Tester state in shared memory, for worker processes. Create before
+    starting the workers.
+
+    Layout of the block, as C longs:
+        | 0 -- version
+        | 1 -- client evictions
+        | 2 -- clients with configuration
+        | 3.. -- client table, CLIENT_SETS * CLIENT_WAYS slots of
+                 (key, delay, /ver ignores, time last used)
+        | then -- request count for each worker
+    '''
+    def __init__(self, workerCount):
+        self._counts = _TABLE + _TABLE_LONGS
+        self._block  = multiprocessing.Array('l', self._counts + workerCount)
+        self._raw    = self._block.get_obj()
+        self._lock   = self._block.get_lock()
+        self.workerCount = workerCount
+
+    def setRequestCount(self, worker, count):
+        '''Records the request count for a worker; each worker writes only its
+        own slot.
+        '''
+        self._raw[self._counts + worker] = count
+
+    def requestCounts(self):
+        return list(self._raw[self._counts:])
@@ -13,28 +13,67 @@ Start the recorder on POSIX with:
 '''
 from   __future__ import print_function
 import logging
-import asyncore
+import multiprocessing
+import os
+import signal
 import sys
 import time
-from   soscoap  import MessageType
-from   soscoap  import RequestCode
 import soscoap
-from   soscoap.resource import SosResourceTransfer
-from   soscoap.msgsock  import MessageSocket
-from   soscoap.server   import CoapServer, IgnoreRequestException
+from   soscoap  import RequestCode
+from   gcoaptest import coap
+from   gcoaptest import engine
+from   gcoaptest import logconfig
+from   gcoaptest import metrics
+from   gcoaptest.engine import BadRequestException, IgnoreRequestException
+from   gcoaptest.exchange import ExchangeLayer, ACK_MODES
+from   gcoaptest.faults   import FaultInjector
+from   gcoaptest.pacing   import Pacer
+from   gcoaptest.notifier import Notifier
+from   gcoaptest.profiler import Profiler
+from   gcoaptest.state  import LocalState, SharedState
 
-logging.basicConfig(filename='tester.log', level=logging.DEBUG, 
-                    format='%(asctime)s %(module)s %(message)s')
 log = logging.getLogger(__name__)
 
 VERSION = '0.1'
 
+# Largest /payload body, in bytes
+MAX_PAYLOAD = 16 * 1024 * 1024
+# /payload body generated at start; grows on demand up to MAX_PAYLOAD
+_INITIAL_PAYLOAD = 64 * 1024
+# Repeated to fill a /payload body, so a client can check the bytes at any offset
+_PAYLOAD_PATTERN = b'0123456789'
+# Shortest interval between /obs notification timer runs; changes due since
+# the last run are sent together
+_OBS_TICK_SECS = 0.001
+_OBS_SEGMENTS  = ('obs',)
+
 class GcoapTester(object):
     '''Provides a server for testing gcoap client commands.
     
     Attributes:
-        :_server:   CoapServer Provides CoAP message protocol
-        :_delay:    Time in seconds to delay a response; useful for testing
+        :_server:   Transport engine; provides CoAP message protocol
+        :_metrics:  metrics.EngineMetrics Request metrics from the engine
+        :_exchanges: ExchangeLayer Deduplicates requests, and sends piggybacked
+                     or separate responses to CON requests
+        :_payload:  memoryview Pre-generated buffer for /payload bodies
+        :_notifier: Notifier Observers of /obs
+        :_faults:   FaultInjector Impairs requests and responses, per path and
+                    peer
+        :_pacer:    Pacer Limits the request rate, globally and per client
+        :_obsValue: int Current /obs value; incremented for each change
+        :_obsRate:  float /obs changes per second, or 0 for none
+        :_obsConfirm: boolean True to send /obs notifications confirmably
+        :_obsTimer: Timer entry for the next /obs change, or None
+        :_obsStart: tuple (time, value) when the rate was set
+        :_profiler: Profiler for the networking loop
+        :_profileAtStart: boolean True to start profiling in start()
+        :_state:    LocalState, or SharedState for a worker process, which
+                    holds configuration for each client host, so concurrent
+                    test sessions are isolated:
+                    delay -- Time in seconds to delay a response; useful for
+                    testing. The server schedules the delayed response, so
+                    other requests continue to be served meanwhile.
+                    verIgnores -- Count of /ver requests to ignore
     
     Usage:
         #. cr = GcoapTester()  -- Create instance
@@ -46,96 +85,410 @@ class GcoapTester(object):
         | /toobig -- GET large text payload. CoAP PDU exceeds 128-byte buffer
                      used by gcoap.
         | /ignore -- GET that does not respond.
-        | Configuration
+        | /payload?size=N -- GET N bytes of the digits '0123456789' repeated,
+                             up to MAX_PAYLOAD. Sent blockwise with Block2 if
+                             the client asks, or if longer than 1024 bytes.
+        | /metrics -- GET request metrics, in Prometheus text exposition format;
+                      see metrics.py
+        | /obs -- GET a counter; observable. Changes at the rate set by
+                  /cf/obs-rate, and notifies all observers of each change.
+        | Configuration; /cf/delay and /ver/ignores apply only to the requesting
+        | client's host, and are dropped for the least recently used host when
+        | the client table is full. See state.py.
         | /cf/delay -- POST integer seconds to delay future responses
         | /ver/ignores -- PUT count of /ver requests to ignore before responding;
                           tests client retry mechanism
+        | /cf/obs-rate -- POST '<rate> [con]', changes/sec for /obs; 0 stops.
+                          With 'con', notifications are confirmable. With
+                          worker processes, use a single worker for Observe.
+        | /cf/ack-mode -- POST 'piggyback' or 'separate'. In separate mode, a
+                          CON request is acknowledged ahead of any delay,
+                          and the response is sent as a CON message. With worker
+                          processes, affects only the worker that receives
+                          the request.
+        | /cf/faults -- POST fault rules, one per line or separated by ';', like
+                        '/ver * drop=0.1 latency=0.05 jitter=0.02'; replaces
+                        all rules, and an empty payload removes them. GET the
+                        rules. See faults.py. A '*' path also impairs /cf
+                        requests. With worker processes, affects only the
+                        worker that receives the request.
+        | /cf/rate -- POST name=value fields to pace requests with token
+                      buckets, like 'rate=100 burst=10 client=5 queue=50'.
+                      Excess requests are queued, or answered 5.03 with
+                      Max-Age when the queue is full. An empty payload turns
+                      off pacing. /cf requests are not paced. See pacing.py.
+                      With worker processes, each worker paces only its own
+                      requests.
+        | /cf/profile -- POST 'on' or 'off' to start or stop profiling; an empty
+                         payload toggles. Writes stats to a file when stopped;
+                         see profiler.py. With worker processes, affects only
+                         the worker that receives the request.
     '''
-    def __init__(self, port=soscoap.COAP_PORT):
+    def __init__(self, port=soscoap.COAP_PORT, backend=engine.DEFAULT_BACKEND,
+                 state=None, batchSize=0, profile=False, ackMode='piggyback',
+                 dedup=True):
         '''Pass in port for non-standard CoAP port.
+
+        :param backend: string Transport engine name, from engine.BACKENDS
+        :param state: SharedState if running as one of several worker
+                      processes on the port; otherwise None
+        :param batchSize: int If not zero, the engine receives and sends
+                          datagrams in batches of up to this size
+        :param profile: boolean If True, profiles from start() until close()
+                        or a /cf/profile command
+        :param ackMode: string Response to a CON request, from
+                        exchange.ACK_MODES
+        :param dedup: boolean If False, handles a duplicate request as new
         '''
-        self._server = CoapServer(port=port)
-        self._server.registerForResourceGet(self._getResource)
-        self._server.registerForResourcePut(self._putResource)
-        self._server.registerForResourcePost(self._postResource)
-        self._delay = 0
-        self._verIgnores = 0
+        self._server = engine.createEngine(backend, port, reusePort=bool(state),
+                                           batchSize=batchSize)
+        self._server.registerForNotFound(self._notFound)
+        if state:
+            self._state = state
+            # another worker may change configuration
+            self._server.cacheVersion = lambda: state.version
+        else:
+            self._state = LocalState()
+        # a client's configuration changes its responses
+        self._server.cacheFilter = lambda request: not self._state.isConfigured(
+                                                coap.normalizeHost(request.address[0]))
+        self._metrics  = metrics.EngineMetrics()
+        self._payload  = _generatePayload(_INITIAL_PAYLOAD)
+        self._notifier = Notifier(self._server)
+        self._obsValue = 0
+        self._obsRate  = 0
+        self._obsConfirm = False
+        self._obsTimer = None
+        self._obsStart = None
+        self._server.metrics = self._metrics
+        self._exchanges = ExchangeLayer(self._server, separate=(ackMode == 'separate'),
+                                        dedup=dedup)
+        self._server.exchanges = self._exchanges
+        self._faults   = FaultInjector(self._server)
+        self._pacer    = Pacer(self._server, exempt=('/cf',))
+        self._profiler = Profiler('tester')
+        self._profileAtStart = profile
+
+        self.addResource('/ver',         self._getVersion, static=True)
+        self.addResource('/toobig',      self._getToobig, static=True)
+        self.addResource('/ignore',      self._getIgnore)
+        self.addResource('/metrics',     self._getMetrics)
+        self.addResource('/payload',     self._getPayload)
+        self.addResource('/obs',         self._getObs)
+        self.addResource('/cf/obs-rate', self._postObsRate, (RequestCode.POST,))
+        self.addResource('/cf/delay',    self._postDelay, (RequestCode.POST,))
+        self.addResource('/ver/ignores', self._putVerIgnores, (RequestCode.PUT,))
+        self.addResource('/cf/ack-mode', self._postAckMode, (RequestCode.POST,))
+        self.addResource('/cf/faults',   self._faultsResource,
+                         (RequestCode.GET, RequestCode.POST))
+        self.addResource('/cf/rate',     self._postRate, (RequestCode.POST,))
+        self.addResource('/cf/profile',  self._postProfile, (RequestCode.POST,))
         
+    def addResource(self, path, handler, methods=(RequestCode.GET,), static=False):
+        '''Adds a resource to the tester, or replaces the handler for an existing
+        one. Allows a plugin to extend the tester before start().
+
+        :param path: string Resource path, like '/ver'
+        :param handler: Function that accepts a ResourceTransfer. For a GET,
+                        sets the resource type and value.
+        :param methods: Iterable of soscoap.RequestCode the handler accepts
+        :param static: boolean If True, the engine caches the encoded GET
+                       response until a PUT or POST to any tester resource.
+                       So the response may depend only on state changed by
+                       those requests, or on the client's configuration, like
+                       delay and verIgnores, which bypasses the cache.
+        '''
+        self._server.registerResource(path, handler, methods, static)
+
+    @property
+    def requestCount(self):
+        return self._server.requestCount
+
     def close(self):
         '''Releases system resources.
         '''
-        pass
+        self._profiler.stop()
+        self._server.close()
                 
-    def _getResource(self, resource):
-        '''Sets the value for the provided resource, for a GET request.
+    def _getVersion(self, resource):
+        '''Sets the value for /ver, for a GET request.
         '''
-        log.debug('Resource path is {0}'.format(resource.path))
-        if resource.path == '/ver':
-            if self._verIgnores > 0:
-                self._verIgnores = self._verIgnores - 1
-                raise IgnoreRequestException
-                return
-            else:
-                resource.type  = 'string'
-                resource.value = VERSION
-        elif resource.path == '/toobig':
-            resource.type  = 'string'
-            resource.value = '1234567890' * 13
-        elif resource.path == '/ignore':
-            time.sleep(self._delay)
+        if self._state.takeVerIgnore(_host(resource)):
             raise IgnoreRequestException
-            return
         else:
-            time.sleep(self._delay)
-            raise NotImplementedError('Unknown path')
-            return
+            resource.type  = 'string'
+            resource.value = VERSION
+            resource.delay = self._state.delay(_host(resource))
 
-        time.sleep(self._delay)
+    def _getToobig(self, resource):
+        '''Sets the value for /toobig, for a GET request.
+        '''
+        resource.type  = 'string'
+        resource.value = '1234567890' * 13
+        resource.delay = self._state.delay(_host(resource))
+
+    def _getIgnore(self, resource):
+        raise IgnoreRequestException
+
+    def _getPayload(self, resource):
+        '''Serves a slice of the payload buffer; the engine sends each block
+        as a further slice, so a request does not copy the body.
+        '''
+        query = resource.pathQuery or ''
+        try:
+            size = int(query[len('size='):] if query.startswith('size=') else query or 0)
+        except ValueError:
+            raise BadRequestException('Payload size not a number: {0}'.format(query))
+        if size < 0 or size > MAX_PAYLOAD:
+            raise BadRequestException('Payload size out of range: {0}'.format(size))
+        if size > len(self._payload):
+            self._payload = _generatePayload(max(size, 2 * len(self._payload)))
+
+        resource.type  = 'bytes'
+        resource.value = self._payload[:size]
+        resource.delay = self._state.delay(_host(resource))
+
+    def _getObs(self, resource):
+        self._notifier.handleGet(resource)
+        resource.type  = 'string'
+        resource.value = str(self._obsValue)
+        resource.delay = self._state.delay(_host(resource))
+
+    def _postObsRate(self, resource):
+        fields = resource.value.split()
+        rate   = float(fields[0]) if fields else 0
+        if rate < 0:
+            raise ValueError('Negative /obs rate: {0}'.format(rate))
+        self._obsRate    = rate
+        self._obsConfirm = len(fields) > 1 and fields[1] == 'con'
+        self._obsStart   = (time.time(), self._obsValue)
+        if self._obsTimer:
+            self._server.timers.cancel(self._obsTimer)
+            self._obsTimer = None
+        if rate:
+            self._obsTimer = self._server.timers.schedule(
+                                max(1.0 / rate, _OBS_TICK_SECS), self._changeObs)
+        log.debug('Post /obs rate: %s/s', rate)
+
+    def _changeObs(self):
+        '''Changes /obs, and notifies its observers, for each change due since
+        the rate was set.
+        '''
+        started, startValue = self._obsStart
+        due = startValue + int((time.time() - started) * self._obsRate) - self._obsValue
+        for i in range(due):
+            self._obsValue += 1
+            self._notifier.notify(_OBS_SEGMENTS, str(self._obsValue).encode('utf-8'),
+                                  self._obsConfirm)
+        self._obsTimer = self._server.timers.schedule(
+                            max(1.0 / self._obsRate, _OBS_TICK_SECS), self._changeObs)
+
+    def _getMetrics(self, resource):
+        resource.type  = 'string'
+        resource.value = self.metricsText()
+
+    def metricsText(self):
+        '''Returns the request metrics and configuration, in text exposition
+        format.
+        '''
+        waitTime = self._pacer.waitTime
+        return self._metrics.exposition((
+            ('gcoap_config_clients', 'Client hosts with configuration',
+             self._state.clientCount),
+            ('gcoap_config_client_evictions', 'Client configurations evicted',
+             self._state.evictions),
+            ('gcoap_pending_responses', 'Delayed responses waiting to be sent',
+             self._server.pendingResponses),
+            ('gcoap_observers', 'Observers registered for /obs',
+             self._notifier.observerCount),
+            ('gcoap_notifications_sent', 'Notifications sent, for each observer',
+             self._notifier.notifications),
+            ('gcoap_exchanges', 'Requests remembered for deduplication',
+             self._exchanges.exchangeCount),
+            ('gcoap_duplicate_requests', 'Duplicate requests received',
+             self._exchanges.duplicates),
+            ('gcoap_exchange_evictions', 'Requests evicted before EXCHANGE_LIFETIME',
+             self._exchanges.evictions),
+            ('gcoap_separate_retransmits', 'Separate responses retransmitted',
+             self._exchanges.retransmits),
+            ('gcoap_fault_rules', 'Fault injection rules', len(self._faults.rules)),
+            ('gcoap_fault_dropped_requests', 'Requests dropped by fault injection',
+             self._faults.dropped),
+            ('gcoap_fault_delayed_responses', 'Responses delayed by fault injection',
+             self._faults.delayed),
+            ('gcoap_fault_duplicated_responses',
+             'Responses duplicated by fault injection', self._faults.duplicated),
+            ('gcoap_fault_reordered_responses', 'Responses reordered by fault injection',
+             self._faults.reordered),
+            ('gcoap_fault_pending_responses',
+             'Impaired responses waiting to be sent', self._faults.pending),
+            ('gcoap_pacing_queue_depth', 'Requests waiting for a token',
+             self._pacer.depth),
+            ('gcoap_pacing_queue_max_depth', 'Highest count of requests waiting',
+             self._pacer.maxDepth),
+            ('gcoap_pacing_queued_requests', 'Requests queued for a token',
+             self._pacer.queued),
+            ('gcoap_pacing_rejected_requests', 'Requests answered 5.03 by pacing',
+             self._pacer.rejected),
+            ('gcoap_pacing_wait_seconds_p50', 'Median wait of a queued request',
+             (waitTime.percentile(50) or 0) / 1e6),
+            ('gcoap_pacing_wait_seconds_p99', '99th percentile wait of a queued request',
+             (waitTime.percentile(99) or 0) / 1e6)))
+
+    def _notFound(self, resource):
+        '''Delays the 4.04 response for an unknown GET or POST path.'''
+        log.debug('Unknown path %s', resource.path)
+        if resource.method != RequestCode.PUT:
+            resource.delay = self._state.delay(_host(resource))
     
-    def _postResource(self, resource):
-        '''Accepts the value for the provided resource, for a POST request.
+    def _postDelay(self, resource):
+        '''Accepts the value for /cf/delay, for a POST request.
         '''
-        log.debug('Resource path is {0}'.format(resource.path))
-        if resource.path == '/cf/delay':
-            self._delay = int(resource.value)
-            log.debug('Post delay value: {0}'.format(self._delay))
-        else:
-            time.sleep(self._delay)
-            raise NotImplementedError('Unknown path: {0}'.format(resource.path))
+        host = _host(resource)
+        self._state.setDelay(host, int(resource.value))
+        log.debug('Post delay value for %s: %s', host, self._state.delay(host))
     
-    def _putResource(self, resource):
-        '''Accepts the value for the provided resource, for a PUT request.
+    def _putVerIgnores(self, resource):
+        '''Accepts the value for /ver/ignores, for a PUT request.
         '''
-        if resource.path == '/ver/ignores':
-            self._verIgnores = int(resource.value)
-            log.debug('Ignores for /ver: {0}'.format(self._verIgnores))
+        host = _host(resource)
+        self._state.setVerIgnores(host, int(resource.value))
+        log.debug('Ignores for /ver for %s: %s', host, self._state.verIgnores(host))
+
+    def _postAckMode(self, resource):
+        mode = resource.value.strip()
+        if mode not in ACK_MODES:
+            raise ValueError('Unknown ACK mode: {0}'.format(mode))
+        self._exchanges.separate = (mode == 'separate')
+        log.debug('Post ACK mode: %s', mode)
+
+    def _faultsResource(self, resource):
+        if resource.method == RequestCode.POST:
+            self._faults.configure(resource.value)
         else:
-            raise NotImplementedError('Unknown path: {0}'.format(resource.path))
+            resource.type  = 'string'
+            resource.value = '\n'.join(str(rule) for rule in self._faults.rules)
+
+    def _postRate(self, resource):
+        self._pacer.configure(resource.value)
+
+    def _postProfile(self, resource):
+        filename = self._profiler.command(resource.value)
+        if filename:
+            print('Wrote profile {0}'.format(filename))
 
     def start(self):
         '''Creates the server, and opens the file for this recorder.
         
         :raises IOError: If cannot open file
         '''
+        if self._profileAtStart:
+            self._profiler.start()
         self._server.start()
 
+def _host(resource):
+    '''Returns the host of the client for a request, which keys its state.'''
+    return coap.normalizeHost(resource.request.address[0])
+
+def _generatePayload(size):
+    '''Returns a memoryview of size bytes of the payload pattern.'''
+    repeats = size // len(_PAYLOAD_PATTERN) + 1
+    return memoryview(_PAYLOAD_PATTERN * repeats)[:min(size, MAX_PAYLOAD)]
+
+def _runWorker(index, port, backend, state, batchSize, profile, metricsPort, ackMode,
+               dedup):
+    '''Runs a tester in a worker process until interrupted.'''
+    logconfig.restartLogging()
+    tester = None
+    try:
+        tester = GcoapTester(port, backend, state=state, batchSize=batchSize,
+                             profile=profile, ackMode=ackMode, dedup=dedup)
+        if metricsPort:
+            metrics.serveHttp(metricsPort + index, tester.metricsText)
+        tester.start()
+    except KeyboardInterrupt:
+        # may receive the interrupt from both the terminal and the parent
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    except:
+        log.exception('Catch-all handler for tester worker %s', index)
+    finally:
+        if tester:
+            state.setRequestCount(index, tester.requestCount)
+            tester.close()
+        logconfig.stopLogging()
+
+def runWorkers(port, backend, count, batchSize=0, profile=False, metricsPort=0,
+               ackMode='piggyback', dedup=True):
+    '''Runs count tester worker processes sharing the port via SO_REUSEPORT,
+    and reports the requests handled by each worker when they exit.
+
+    :param metricsPort: int If not zero, each worker serves its metrics over
+                        HTTP, on metricsPort plus its index
+    '''
+    state   = SharedState(count)
+    workers = [multiprocessing.Process(target=_runWorker,
+                                       args=(i, port, backend, state, batchSize,
+                                             profile, metricsPort, ackMode, dedup))
+               for i in range(count)]
+    for worker in workers:
+        worker.start()
+    print('Sock it to me! {0} workers'.format(count))
+
+    def stopWorkers(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGINT)
+    signal.signal(signal.SIGINT,  stopWorkers)
+    signal.signal(signal.SIGTERM, stopWorkers)
+
+    for worker in workers:
+        worker.join()
+
+    counts = state.requestCounts()
+    for i, requests in enumerate(counts):
+        print('Worker {0}: {1} requests'.format(i, requests))
+        log.info('Worker %s: %s requests', i, requests)
+    print('Total: {0} requests'.format(sum(counts)))
+
 # Start the tester
 if __name__ == '__main__':
     from optparse import OptionParser
 
-    formattedPath = '\n\t'.join(str(p) for p in sys.path)
-    log.info('Running gcoap tester with sys.path:\n\t{0}'.format(formattedPath))
-
     # read command line
     parser = OptionParser()
     parser.add_option('-p', type='int', dest='port', default=soscoap.COAP_PORT)
+    parser.add_option('-b', type='choice', dest='backend', choices=engine.BACKENDS,
+                      default=engine.DEFAULT_BACKEND)
+    parser.add_option('-w', type='int', dest='workers', default=1)
+    parser.add_option('-B', type='int', dest='batchSize', default=0)
+    parser.add_option('--profile', action='store_true', dest='profile', default=False)
+    parser.add_option('--metrics-port', type='int', dest='metricsPort', default=0)
+    parser.add_option('--ack-mode', type='choice', dest='ackMode', choices=ACK_MODES,
+                      default='piggyback')
+    parser.add_option('--no-dedup', action='store_false', dest='dedup', default=True)
+    parser.add_option('--log-level', type='choice', dest='logLevel',
+                      choices=logconfig.LEVELS, default='debug')
 
     (options, args) = parser.parse_args()
-    log.info('Using port {0}'.format(options.port))
+
+    logconfig.configureLogging('tester.log', options.logLevel)
+    formattedPath = '\n\t'.join(str(p) for p in sys.path)
+    log.info('Running gcoap tester with sys.path:\n\t%s', formattedPath)
+    log.info('Using port %s, %s backend', options.port, options.backend)
+
+    if options.workers > 1:
+        runWorkers(options.port, options.backend, options.workers, options.batchSize,
+                   options.profile, options.metricsPort, options.ackMode, options.dedup)
+        logconfig.stopLogging()
+        sys.exit(0)
 
     tester = None
     try:
-        tester = GcoapTester(options.port)
+        tester = GcoapTester(options.port, options.backend, batchSize=options.batchSize,
+                             profile=options.profile, ackMode=options.ackMode,
+                             dedup=options.dedup)
+        if options.metricsPort:
+            metrics.serveHttp(options.metricsPort, tester.metricsText)
         print('Sock it to me!')
 
         if tester:
@@ -149,5 +502,6 @@ if __name__ == '__main__':
         if tester:
             tester.close()
             log.info('gcoap tester closed')
+        logconfig.stopLogging()
 
 
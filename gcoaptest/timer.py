@@ -0,0 +1,69 @@
+# Copyright (c) 2017, Ken Bannister
+# All rights reserved.
+#
+# Released under the Mozilla Public License 2.0, as published at the link below.
+# http://opensource.org/licenses/MPL-2.0
+'''
+Timer queue for deferred work, driven from a networking event loop rather than
+by sleeping in a request handler.
+'''
+import heapq
+import itertools
+import time
+
+
+class TimerQueue(object):
+    '''Heap of callbacks ordered by due time.
+
+    The owning event loop asks for the time until the next callback with
+    timeout(), polls its sockets for at most that long, and then calls
+    runDue().
+
+    Attributes:
+        :_heap: list of [due, sequence, callback, args] entries
+        :_seq:  Tie-breaker, so entries due at the same time run in the order
+                scheduled
+    '''
+    def __init__(self, clock=time.time):
+        self._heap  = []
+        self._seq   = itertools.count()
+        self._clock = clock
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, delay, callback, *args):
+        '''Runs callback(*args) after delay seconds.
+
+        :return: Entry, which may be passed to cancel()
+        '''
+        entry = [self._clock() + delay, next(self._seq), callback, args]
+        heapq.heappush(self._heap, entry)
+        return entry
+
+    def cancel(self, entry):
+        '''Cancels a scheduled entry; it is dropped lazily when due.'''
+        entry[2] = None
+
+    def timeout(self, maxTimeout=None):
+        '''Returns seconds until the next entry is due, but no more than
+        maxTimeout. Returns maxTimeout if there are no entries.
+        '''
+        if not self._heap:
+            return maxTimeout
+        wait = max(0, self._heap[0][0] - self._clock())
+        return wait if maxTimeout is None else min(wait, maxTimeout)
+
+    def runDue(self):
+        '''Runs all entries that are due.
+
+        :return: int Count of callbacks run
+        '''
+        count = 0
+        now   = self._clock()
+        while self._heap and self._heap[0][0] <= now:
+            due, seq, callback, args = heapq.heappop(self._heap)
+            if callback:
+                callback(*args)
+                count += 1
+        return count